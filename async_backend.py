@@ -0,0 +1,167 @@
+# Asyncio interface to backend.py, works with aws_backend and tmux_backend
+#
+# Blocking backend calls run on a shared thread pool, and each call returns
+# an awaitable handle, so single event loop can drive many jobs and commands
+# at once.
+
+"""
+import aws_backend
+import async_backend
+
+async def main():
+  run = async_backend.make_run(aws_backend, 'helloworld', ami=ami, ...)
+  ps_job, worker_job = await asyncio.gather(
+    run.make_job('ps', num_tasks=1, instance_type='c5.xlarge'),
+    run.make_job('worker', num_tasks=4, instance_type='p3.2xlarge'))
+  await asyncio.gather(ps_job.wait_until_ready(), worker_job.wait_until_ready())
+
+  ps = ps_job.run('python train.py --role=ps')       # starts immediately
+  workers = worker_job.run('python train.py --role=worker')
+  results = await workers      # list of backend.TaskResult
+  ps.cancel()
+
+asyncio.run(main())
+"""
+
+import asyncio
+import concurrent.futures
+
+# max number of blocking backend calls in flight, mostly idle threads
+# waiting on SSH channels
+MAX_THREADS=256
+
+_executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_THREADS)
+
+
+def make_run(backend_module, name, **kwargs):
+  """Creates async Run using given backend module (aws_backend or
+  tmux_backend)."""
+  return Run(backend_module.make_run(name, **kwargs))
+
+
+class Handle:
+  """Awaitable handle for a backend call that's running in background.
+
+  Must be created while event loop is running, ie from a coroutine. Can be
+  awaited from event loop, or polled with done()/result()."""
+
+  def __init__(self, func, description=''):
+    self.description = description
+    loop = asyncio.get_running_loop()
+    self._future = loop.run_in_executor(_executor, func)
+
+  def __await__(self):
+    return self._future.__await__()
+
+  def done(self):
+    return self._future.done()
+
+  def result(self):
+    """Returns result of finished call, re-raising its exception."""
+    return self._future.result()
+
+  def cancel(self):
+    """Stops waiting for the call. Command that already started keeps running
+    on the task."""
+    return self._future.cancel()
+
+  def __repr__(self):
+    state = 'done' if self.done() else 'running'
+    return "Handle(%s, %s)"%(self.description, state)
+
+
+class CommandHandle(Handle):
+  """Handle for a command running on a task, result is the exit code."""
+
+  @property
+  def exit_code(self):
+    """Exit code of finished command, None if it's still running."""
+    if not self.done() or self._future.cancelled():
+      return None
+    if self._future.exception():
+      return None
+    return self.result()
+
+
+class Run:
+  def __init__(self, run):
+    self.backend_run = run
+
+  @property
+  def name(self):
+    return self.backend_run.name
+
+  @property
+  def logdir(self):
+    return self.backend_run.logdir
+
+  def make_job(self, role_name, num_tasks=1, **kwargs):
+    """Returns handle that resolves to Job."""
+    def func():
+      return Job(self.backend_run.make_job(role_name, num_tasks=num_tasks,
+                                           **kwargs))
+    return Handle(func, 'make_job '+role_name)
+
+  def log(self, message, *args):
+    self.backend_run.log(message, *args)
+
+
+class Job:
+  def __init__(self, job):
+    self.backend_job = job
+    self.tasks = [Task(task) for task in job.tasks]
+
+  @property
+  def name(self):
+    return self.backend_job.name
+
+  def wait_until_ready(self):
+    return Handle(self.backend_job.wait_until_ready,
+                  'wait_until_ready '+self.name)
+
+  def run(self, cmd, **kwargs):
+    """Runs command on every task, handle resolves to list of
+    backend.TaskResult. See backend.Job.run for arguments."""
+    return Handle(lambda: self.backend_job.run(cmd, **kwargs), cmd)
+
+  def upload(self, *args, **kwargs):
+    return Handle(lambda: self.backend_job.upload(*args, **kwargs), 'upload')
+
+  def __getattr__(self, name):
+    # ip, public_ip, port, connect_instructions, ...
+    return getattr(self.backend_job, name)
+
+
+class Task:
+  def __init__(self, task):
+    self.backend_task = task
+
+  @property
+  def id(self):
+    return self.backend_task.id
+
+  def wait_until_ready(self):
+    return Handle(self.backend_task.wait_until_ready, 'wait_until_ready')
+
+  def run(self, cmd, ignore_errors=False, **kwargs):
+    """Runs command on the task, returns CommandHandle."""
+    return CommandHandle(lambda: self.backend_task.run(
+      cmd, ignore_errors=ignore_errors, **kwargs), cmd)
+
+  def upload(self, *args, **kwargs):
+    return Handle(lambda: self.backend_task.upload(*args, **kwargs), 'upload')
+
+  def download(self, *args, **kwargs):
+    return Handle(lambda: self.backend_task.download(*args, **kwargs),
+                  'download')
+
+  def file_read(self, fn):
+    return Handle(lambda: self.backend_task.file_read(fn), 'file_read '+fn)
+
+  def file_write(self, fn, contents):
+    return Handle(lambda: self.backend_task.file_write(fn, contents),
+                  'file_write '+fn)
+
+  def __getattr__(self, name):
+    # ip, public_ip, port, output, connect_instructions, ...
+    return getattr(self.backend_task, name)
@@ -1,15 +1,20 @@
 # AWS implementation of backend.py
 
 # TODO: fix remote_fn must be absolute for uploading with check_with_existing
+import concurrent.futures
 import glob
 import os
 import shlex
+import stat
 import sys
+import threading
 import time
 
 import portpicker
 
 import backend
+import instance_pool
+import output_streamer
 import util as u
 
 TASKDIR_PREFIX='/tmp/tasklogs'
@@ -17,6 +22,20 @@ LOGDIR_PREFIX='/efs/runs'
 TIMEOUT_SEC=5
 MAX_RETRIES = 10
 DEFAULT_PORT=3000
+# markers of completed install script steps, see u.make_install_steps_script
+# Markers survive restart of instances from instance_pool, except for steps
+# like mounts or writing into /tmp, whose markers are kept per boot.
+INSTALL_STEPS_DIR='/var/tmp/install_steps'
+INSTALL_STEPS_BOOT_DIR=(INSTALL_STEPS_DIR+
+                        '/$(cat /proc/sys/kernel/random/boot_id)')
+# delay before reopening output stream that ended on live connection
+OUTPUT_RESTART_SEC=1
+# exit status of Task.run remote command when tmux send-keys fails, so it's
+# not mistaken for timeout of the command
+SEND_KEYS_FAILED_STATUS=200
+# polling settings for EC2 state waiters
+WAITER_DELAY_SEC=2
+WAITER_MAX_ATTEMPTS=300
 
 def make_run(name, **kwargs):
   return Run(name, **kwargs)
@@ -41,6 +60,7 @@ class Run(backend.Run):
 
     # TODO: document launch parameters
     job_name = u.format_job_name(role_name, self.name)
+    tracer = u.Tracer()  # launch phases of this job
     instances = u.lookup_aws_instances(job_name)
     kwargs = u.merge_kwargs(kwargs, self.kwargs)
     ami = kwargs['ami']
@@ -49,12 +69,13 @@ class Run(backend.Run):
     placement_group = kwargs.get('placement_group', '')
     install_script = kwargs.get('install_script','')
     linux_type = kwargs.get('linux_type', 'ubuntu')
+    use_pool = kwargs.get('use_pool', True)
+    pool_key = instance_pool.make_pool_key(ami, instance_type,
+                                           availability_zone, install_script,
+                                           placement_group)
 
     # TODO: also make sure instance type is the same
-    if instances:
-      assert len(instances) == num_tasks, ("Found job with same name, but number of tasks %d doesn't match requested %d, kill job manually." % (len(instances), num_tasks))
-      print("Found existing job "+job_name)
-    else:
+    if not instances:
       print("Launching new job %s into VPC %s" %(job_name, u.get_resource_name()))
 
       security_group = u.get_security_group_dict()[u.get_resource_name()]
@@ -63,15 +84,26 @@ class Run(backend.Run):
       subnet_dict = u.get_subnet_dict(vpc)
       assert availability_zone in subnet_dict, "Availability zone %s is not in subnet dict, available subnets are %s"%(availability_zone, ', '.join(subnet_dict.keys()))
       subnet = subnet_dict[availability_zone]
-      ec2 = u.create_ec2_resource()
       u.maybe_create_placement_group(placement_group)
 
-      self.log("Requesting %d %s" %(num_tasks, instance_type))
+      # restart stopped instances released by earlier jobs, they take lower
+      # task ids, remaining tasks get new instances
+      task_names = [u.format_task_name(task_id, role_name, self.name)
+                    for task_id in range(num_tasks)]
+      pooled_instances = []
+      if use_pool:
+        pooled_instances = instance_pool.acquire(pool_key, task_names, tracer)
+        if pooled_instances:
+          self.log("Restarted %d %s from instance pool",
+                   len(pooled_instances), instance_type)
+
+      self.log("Requesting %d %s" %(num_tasks-len(pooled_instances),
+                                    instance_type))
 
       args = {'ImageId': ami,
               'InstanceType': instance_type,
-              'MinCount': num_tasks,
-              'MaxCount': num_tasks,
+              'MinCount': 1,
+              'MaxCount': 1,
               'KeyName': keypair.name}
 
       # network setup
@@ -84,28 +116,45 @@ class Run(backend.Run):
       if placement_group: placement_arg['GroupName'] = placement_group
       args['Placement'] = placement_arg
 
-      instances = ec2.create_instances(**args)
-      assert len(instances) == num_tasks
-
-      # assign proper names to tasks
-      for instance in instances:
-        while True:
-          try:
-            # sometimes get "An error occurred (InvalidInstanceID.NotFound)"
-            task_name = u.format_task_name(instance.ami_launch_index, role_name,
-                                           self.name)
-            # TODO: use instance.create_tags instead like in create_resources.py
-            ec2.create_tags(Resources=[instance.id],
-                            Tags=u.make_name(task_name))
-            break
-          except Exception as e:
-            self.log("create_tags failed with %s, retrying in %d seconds"%(
-              str(e), TIMEOUT_SEC))
-            time.sleep(TIMEOUT_SEC)
+      # Each instance is launched with its own RunInstances call, so that it
+      # gets its task name at creation time and doesn't need separate tagging
+      def launch(task_id):
+        task_name = u.format_task_name(task_id, role_name, self.name)
+        task_args = dict(args)
+        task_args['TagSpecifications'] = [{'ResourceType': 'instance',
+                                           'Tags': u.make_name(task_name)}]
+        with tracer.span('create_instance', task=task_name):
+          return u.create_ec2_resource().create_instances(**task_args)[0]
+
+      new_task_ids = range(len(pooled_instances), num_tasks)
+      with concurrent.futures.ThreadPoolExecutor(
+          min(len(new_task_ids), u.MAX_CONCURRENCY) or 1) as executor:
+        futures = [executor.submit(launch, task_id) for task_id in
+                   new_task_ids]
+      new_instances = [future.result() for future in futures
+                       if not future.exception()]
+      errors = [future.exception() for future in futures
+                if future.exception()]
+      if errors:
+        self.log("%d of %d instances failed to launch, terminating the rest",
+                 len(errors), len(new_task_ids))
+        # don't leave partial job behind
+        for instance in new_instances:
+          instance.terminate()
+        if pooled_instances:
+          instance_pool.release(pooled_instances, pool_key)
+        raise errors[0]
+      instances = pooled_instances + new_instances
+    else:
+      assert len(instances) == num_tasks, ("Found job with same name, but number of tasks %d doesn't match requested %d, kill job manually." % (len(instances), num_tasks))
+      print("Found existing job "+job_name)
+      instances.sort(key=lambda instance: u.get_parsed_job_name(
+        instance.tags)[0])
 
     job = Job(self, job_name, instances=instances,
               install_script=install_script,
-              linux_type=linux_type)
+              linux_type=linux_type, tracer=tracer)
+    job.pool_key = pool_key
     return job
 
   @property
@@ -116,31 +165,81 @@ class Run(backend.Run):
 class Job(backend.Job):
   # TODO: get rid of linux_type
   def __init__(self, run, name, instances, install_script=None,
-               linux_type=None):
+               linux_type=None, tracer=None):
     self._run = run
     self.name = name
+    self.pool_key = None  # instance_pool key, set by Run.make_job
+    # launch phases of this job, other jobs launched by the same process have
+    # their own
+    self.tracer = tracer or u.Tracer()
 
 
     self._run_command_available = False, "Have you done wait_until_ready?"
     
-    # initialize list of tasks, in order of AMI launch index
-    self.tasks = [None]*len(instances)
-    for instance in instances:
-      task_id = instance.ami_launch_index
-      task = Task(instance, self, task_id, install_script=install_script,
-                             linux_type=linux_type)
-      self.tasks[task_id] = task
+    # initialize list of tasks, instances are given in order of task id
+    self.tasks = []
+    for task_id, instance in enumerate(instances):
+      self.tasks.append(Task(instance, self, task_id,
+                             install_script=install_script,
+                             linux_type=linux_type))
 
   def _initialize(self):
     for task in self.tasks:
       task._initialize()
 
   # todo: rename to initialize
-  def wait_until_ready(self):
-    """Waits until all tasks in the job are available and initialized."""
+  def wait_until_ready(self, max_concurrency=None):
+    """Waits until all tasks in the job are available and initialized.
+
+    Tasks are brought up concurrently, at most max_concurrency at a time
+    (default is u.MAX_CONCURRENCY). If any task fails to initialize, remaining tasks
+    that haven't started are cancelled and the exception is re-raised here."""
+    # todo: initialization should start async in constructor instead of here
+    backend.fanout(self.tasks, lambda task: task.wait_until_ready(),
+                   max_concurrency=max_concurrency, description='initialize')
+    self._save_launch_trace()
+
+  def release(self):
+    """Stops instances of this job and puts them into instance pool for reuse
+    by later jobs with the same launch parameters. Instances of tasks that
+    didn't finish install script get terminated instead."""
+    assert self.pool_key, "Job wasn't created by Run.make_job"
+    pooled_instances = []
     for task in self.tasks:
-      task.wait_until_ready()
-      # todo: initialization should start async in constructor instead of here
+      if task.ssh:
+        initialized = task._is_initialized_file_present()
+        task.ssh.close()
+      else:
+        initialized = False
+      if initialized:
+        pooled_instances.append(task.instance)
+      else:
+        task.log("Terminating uninitialized instance %s", task.instance.id)
+        task.instance.terminate()
+    print("Releasing %d instances of %s into pool"%(len(pooled_instances),
+                                                    self.name))
+    instance_pool.release(pooled_instances, self.pool_key)
+
+  @property
+  def trace_fn(self):
+    """Local location of Chrome trace of this job's launch phases."""
+    return '%s/%s.launch_trace.json'%(TASKDIR_PREFIX, self.name)
+
+  def _save_launch_trace(self):
+    """Saves launch phase trace locally and into run logdir, prints critical
+    path of the launch."""
+    if not self.tasks:
+      return
+    # cached AWS lookups are shared between jobs and recorded in u.tracer,
+    # include the ones made while this job was launching
+    self.tracer.add_spans_from(u.tracer, self.tracer.start_time)
+    self.tracer.write_chrome_trace(self.trace_fn)
+    print(self.tracer.summary())
+    task = self.tasks[0]
+    remote_fn = '%s/%s.launch_trace.json'%(self._run.logdir, self.name)
+    task.run('mkdir -p '+self._run.logdir)
+    task.upload(self.trace_fn, remote_fn)
+    print("Launch trace saved to %s and %s"%(self.trace_fn, remote_fn))
 
 
 class Task(backend.Task):
@@ -153,8 +252,11 @@ class Task(backend.Task):
     self.id = task_id
     self.install_script = install_script
     self._run_counter = 0
+    self._run_lock = threading.Lock()
     self.cached_ip = None
     self.cached_public_ip = None
+    self.ssh = None  # u.SshConnection, created in _initialize
+    self.output = None  # output_streamer.TaskOutput, created in _initialize
     
     self.initialized = False
 
@@ -164,6 +266,8 @@ class Task(backend.Task):
                                                    job.name, self.id,
                                                    0) # u.now_micros())
     self.remote_scratch = '/tmp/tmux'
+    # tmux session on the instance that runs commands, window 0 is used
+    self.tmux_session = 'tmux'
     self.log("Creating local scratch dir %s", self.scratch)
     self._ossystem('rm -Rf '+self.scratch)  # TODO: don't delete this?
     self._ossystem('mkdir -p '+self.scratch)
@@ -196,62 +300,166 @@ class Task(backend.Task):
 
 
   def _setup_tmux(self):
-    self._run_ssh('tmux kill-session -t tmux')
-    self._run_ssh('tmux new-session -s tmux -n 0 -d')
+    self._run_ssh('tmux kill-session -t '+self.tmux_session)
+    # PROMPT_COMMAND hooks from .bashrc (ie, pyenv-virtualenv) run after
+    # every command and delay the next one by tens of ms
+    self._run_ssh('tmux new-session -s %s -n 0 -d && '
+                  'tmux send-keys -t %s:0 %s Enter'%(
+                    self.tmux_session, self.tmux_session,
+                    shlex.quote('unset PROMPT_COMMAND')))
     self._run_command_available = True
 
+  def _start_output_stream(self):
+    """Mirrors tmux pane into remote log file, and streams that file into
+    local log file next to scratch dir over a long-lived SSH channel."""
+    remote_log_fn = self.remote_scratch+'/output.log'
+    self._run_ssh("rm -f {fn}; tmux pipe-pane -t {session}:0 'cat >> {fn}'".format(
+      fn=remote_log_fn, session=self.tmux_session))
+    local_log_fn = os.path.dirname(self.scratch)+'/output.log'
+    if self.output is None:
+      self.output = output_streamer.TaskOutput(self, local_log_fn)
+    # bytes of local output received before remote log file was started
+    self._output_start = self.output.bytes_received
+    self._output_channel = None
+    self._output_lock = threading.Lock()
+    self._open_output_channel()
+    # channel doesn't survive loss of connection, resume on a new one
+    self.ssh.add_reconnect_callback(self._open_output_channel)
+
+  def _open_output_channel(self):
+    """Starts streaming remote log file from the first byte that wasn't
+    received yet, replacing previous output channel. Previous channel isn't
+    closed here, output streamer closes it once it sees end of stream, so its
+    file descriptor can't be reused while streamer still watches it."""
+    remote_log_fn = self.remote_scratch+'/output.log'
+    with self._output_lock:
+      offset = self.output.bytes_received - self._output_start
+      channel = self.ssh.open_channel('tail -c +%d -F %s'%(offset+1,
+                                                           remote_log_fn),
+                                      idempotent=True)
+      self._output_channel = channel
+    output_streamer.get_streamer().add_channel(
+      channel, self.output, lambda: self._output_channel_ended(channel))
+
+  def _output_channel_ended(self, channel):
+    """Called by output streamer thread when output channel closed."""
+    with self._output_lock:
+      if channel is not self._output_channel:   # replaced by a new channel
+        return
+    if self.ssh.is_active():
+      self.log("Output stream ended, restarting it in %d seconds",
+               OUTPUT_RESTART_SEC)
+      # don't block output streamer thread on SSH round trip
+      def restart():
+        time.sleep(OUTPUT_RESTART_SEC)
+        with self._output_lock:
+          if channel is not self._output_channel:  # reconnect restarted it
+            return
+        self._open_output_channel()
+      threading.Thread(target=restart, daemon=True).start()
+    else:
+      self.log("Output stream ended with lost SSH connection, it resumes "
+               "after reconnect")
+
   def _mount_efs(self):
     self.log("Mounting EFS")
     region = u.get_region()
-    efs_id = u.get_efs_dict()[u.get_resource_name()]
+    efs_id = u.get_efs_id(u.get_resource_name())
     dns = "{efs_id}.efs.{region}.amazonaws.com".format(**locals())
     self.run('sudo mkdir -p /efs')
     self.run('sudo chmod 777 /efs')
     # ignore error on remount
     self.run("sudo mount -t nfs -o nfsvers=4.1,rsize=1048576,wsize=1048576,hard,timeo=600,retrans=2 %s:/ /efs"%(dns,), ignore_errors=True) 
 
+  def _span(self, name):
+    """Records launch phase of this task in job's tracer."""
+    return self.job.tracer.span(name, process=self.job.name, thread='task %d'%(
+      self.id,))
+
   def _initialize(self):
     """Tries to initialize the task."""
 
     self.log("Running initialize")
     self.initialize_called = True
-    public_ip = self.public_ip # todo: add retry logic to public_ip property
-
-    while True:
-      self.ssh_client = u.ssh_to_host(self.public_ip, self.keypair_fn,
-                                      self.username)
-      if self.ssh_client is None:
-        self.log("SSH into %s:%s failed, retrying in %d seconds" %(self.job.name, self.id,TIMEOUT_SEC))
-        time.sleep(TIMEOUT_SEC)
-      else:
-        break
+    # instances launched by make_job may still be pending, each task starts
+    # initializing as soon as its own instance is running
+    with self._span('wait_running'):
+      self.instance.wait_until_running(WaiterConfig={
+        'Delay': WAITER_DELAY_SEC, 'MaxAttempts': WAITER_MAX_ATTEMPTS})
+      self.cached_public_ip = None
+      public_ip = self.public_ip # todo: add retry logic to public_ip property
+
+    self.ssh = u.SshConnection(self.public_ip, self.keypair_fn, self.username)
+    with self._span('ssh_connect') as span_args:
+      span_args['retries'] = 0
+      while True:
+        if not self.ssh.connect():
+          self.log("SSH into %s:%s failed, retrying in %d seconds" %(self.job.name, self.id,TIMEOUT_SEC))
+          span_args['retries']+=1
+          time.sleep(TIMEOUT_SEC)
+        else:
+          break
 
     # todo: install tmux
-    self._setup_tmux()
-    self.run('mkdir -p '+self.remote_scratch)
-    self._mount_efs()
+    with self._span('setup_tmux'):
+      self._setup_tmux()
+      self.run('mkdir -p '+self.remote_scratch)
+      self._start_output_stream()
+    with self._span('mount_efs'):
+      self._mount_efs()
     
-    # run initialization commands here
-    if self._is_initialized_file_present():
-      self.log("reusing previous initialized state")
-    else:
-      self.log("running install script")
-
-      self.install_script+='\necho ok > /tmp/is_initialized\n'
-      self.file_write('install.sh', u._add_echo(self.install_script))
+    # run initialization commands here. Steps completed during previous
+    # initialization are skipped, so this is fast for unchanged scripts
+    self.log("running install script")
+    with self._span('install_script'):
+      timings_fn = '%s/timings.%d'%(INSTALL_STEPS_DIR, u.now_micros())
+      script = u.make_install_steps_script(self.install_script,
+                                           INSTALL_STEPS_DIR, timings_fn,
+                                           INSTALL_STEPS_BOOT_DIR)
+      script+='echo ok > /tmp/is_initialized\n'
+      self.file_write('install.sh', script)
       self.run('bash -e install.sh') # fail on errors
       # TODO(y): propagate error messages printed on console to the user
       # right now had to log into tmux to see it
+    self._report_install_timings(timings_fn)
 
     assert self._is_initialized_file_present()
+    with self._span('start_metrics_agent'):
+      self.start_metrics_agent()
 
     self.connect_instructions = """
 ssh -i %s -o StrictHostKeyChecking=no %s@%s
 tmux a
 """.strip() % (self.keypair_fn, self.username, self.public_ip)
-    self.log("Initialize complete")
+    self.log("Initialize complete, opened %d exec channels, %d sftp sessions",
+             self.ssh.channels_opened, self.ssh.sftp_sessions_opened)
 
 
+  def _report_install_timings(self, timings_fn):
+    """Logs how long each step of install script took, slowest first."""
+    timings = self.file_read_many([timings_fn])[0]
+    if timings is None:   # no steps in install script
+      return
+    ran_steps = []
+    num_skipped = 0
+    for line in timings.strip().split('\n'):
+      status, millis, cmd = line.split(' ', 2)
+      if status == 'ran':
+        ran_steps.append((int(millis), cmd))
+      else:
+        num_skipped+=1
+    self.log("install script ran %d steps in %.1f seconds, skipped %d "
+             "previously completed steps", len(ran_steps),
+             sum(millis for millis, cmd in ran_steps)/1000., num_skipped)
+    for millis, cmd in sorted(ran_steps, reverse=True):
+      self.log("%8.1f sec  %s", millis/1000., cmd)
+
+  @property
+  def ssh_client(self):
+    """Underlying paramiko client of the persistent SSH connection."""
+    assert self.ssh, "SSH connection not available, call wait_until_ready"
+    return self.ssh.client
+
   # todo: rename wait_until_ready to wait_until_initialized
   def wait_until_ready(self):
     if not self.initialize_called:
@@ -296,12 +504,15 @@ tmux a
     self.upload(source, target)
     
 
-  def upload(self, local_fn, remote_fn=None, skip_existing=False):
+  def upload(self, local_fn, remote_fn=None, skip_existing=False,
+             incremental=False):
     """Uploads file to remote instance. If location not specified, dumps it
-    in default directory."""
-    # TODO: self.ssh_client is sometimes None
+    in default directory.
+
+    If incremental is True, directories are synced with u.sync_dir, which
+    only sends files that changed since last incremental upload, and deletes
+    files that were removed from local_fn since then."""
     self.log('uploading '+local_fn)
-    sftp = self.ssh_client.open_sftp()
     
     if remote_fn is None:
       remote_fn = os.path.basename(local_fn)
@@ -309,21 +520,32 @@ tmux a
       self.log("Remote file %s exists, skipping"%(remote_fn,))
       return
 
-    if os.path.isdir(local_fn):
-      u.put_dir(sftp, local_fn, remote_fn)
+    if os.path.isdir(local_fn) and incremental:
+      bytes_sent, bytes_skipped = u.sync_dir(self.ssh, local_fn, remote_fn)
+      self.log("synced %s, sent %d bytes, skipped %d unchanged bytes",
+               local_fn, bytes_sent, bytes_skipped)
+    elif os.path.isdir(local_fn):
+      u.put_dir(self.ssh.sftp, local_fn, remote_fn)
     else:
       assert os.path.isfile(local_fn), "%s is not a file"%(local_fn,)
-      sftp.put(local_fn, remote_fn)
+      self.ssh.sftp_call('put', local_fn, remote_fn)
 
 
   def download(self, remote_fn, local_fn=None):
-    # TODO: self.ssh_client is sometimes None
+    """Downloads file or directory from remote instance, like cp -R.
+    Directories are sent as a single tar stream with u.get_dir."""
     self.log("downloading %s"%(remote_fn))
-    sftp = self.ssh_client.open_sftp()
     if local_fn is None:
-      local_fn = os.path.basename(local_fn)
+      local_fn = os.path.basename(remote_fn)
       self.log("downloading %s to %s"%(remote_fn, local_fn))
-    sftp.get(remote_fn, local_fn)
+    if not remote_fn.startswith('/'):
+      remote_fn = self.taskdir + '/'+remote_fn
+    if stat.S_ISDIR(self.ssh.sftp_call('stat', remote_fn).st_mode):
+      if os.path.isdir(local_fn):
+        local_fn = os.path.join(local_fn, os.path.basename(remote_fn))
+      u.get_dir(self.ssh, remote_fn, local_fn)
+    else:
+      self.ssh.sftp_call('get', remote_fn, local_fn)
 
 
   def file_exists(self, remote_fn):
@@ -331,28 +553,26 @@ tmux a
     if not remote_fn.startswith('/'):
       remote_fn = self.taskdir + '/'+remote_fn
     assert remote_fn.startswith('/'), "Remote fn must be absolute"
-    stdin, stdout, stderr = self.ssh_client.exec_command('stat '+remote_fn,
-                                                    get_pty=True)
-    stdout_bytes = stdout.read()
-    stdout_str = stdout_bytes.decode()  # AWS linux uses unicode quotes
-    stderr_bytes = stderr.read()
-    stderr_str = stderr_bytes.decode()
-    if 'No such file' in stdout_str:
+    # stat over existing SFTP session instead of opening exec channel
+    try:
+      self.ssh.sftp_call('stat', remote_fn)
+    except FileNotFoundError:
       return False
-    else:
-      return True
+    return True
   
   def file_write(self, remote_fn, contents):
-    tmp_fn = self.scratch+'/'+str(u.now_micros())
-    open(tmp_fn, 'w').write(contents)
-    self.upload(tmp_fn, remote_fn)
+    self.ssh.file_write(remote_fn, contents)
   
 
   def file_read(self, remote_fn):
     self.log("file_read")
-    tmp_fn = self.scratch+'/'+str(u.now_micros())
-    self.download(remote_fn, tmp_fn)
-    return open(tmp_fn).read()
+    return self.ssh.file_read(remote_fn)
+
+  def file_exists_many(self, remote_fns):
+    return self.ssh.file_exists_many(remote_fns)
+
+  def file_read_many(self, remote_fns):
+    return self.ssh.file_read_many(remote_fns)
 
   def _run_ssh(self, cmd):
     """Runs given cmd in the task using current SSH session, returns
@@ -366,67 +586,84 @@ tmux a
     minimal dependencies (no tmux)
     """
     self.log("run_ssh: %s"%(cmd,))
-    stdin, stdout, stderr = self.ssh_client.exec_command(cmd, get_pty=True)
-    stdout_str = stdout.read().decode()
-    stderr_str = stderr.read().decode()
+    _, stdout_str, stderr_str = self.ssh.exec_command(cmd, get_pty=True)
     self.log("run_ssh returned: " + stdout_str)
         
     return stdout_str, stderr_str
     
-  def run(self, cmd, sync=True, ignore_errors=False,
-          max_wait_sec=600, check_interval=1):
+  def run_background(self, cmd, log_fn):
+    self.log("background> %s", cmd)
+    # without pty and with all streams redirected, exec channel closes as soon
+    # as cmd is started, nohup keeps it alive after that
+    status, _, stderr_str = self.ssh.exec_command(
+      'cd %s && nohup sh -c %s > %s 2>&1 < /dev/null &'%(
+        self.taskdir, shlex.quote(cmd), shlex.quote(log_fn)))
+    assert status == 0, "Starting %s failed with %s"%(cmd, stderr_str)
+
+  def shell_pid(self):
+    _, stdout_str, _ = self.ssh.exec_command(
+      "tmux display-message -p -t %s:0 '#{pane_pid}'"%(self.tmux_session,),
+      idempotent=True)
+    return int(stdout_str)
+
+  def run(self, cmd, sync=True, ignore_errors=False, max_wait_sec=600):
     """Runs command in tmux session. No need for multiple tmux sessions per
-    task, so assume tmux session/window is always called tmux:0"""
+    task, so assume tmux window is always window 0 of self.tmux_session
+
+    For sync commands, completion is signalled through a tmux wait-for
+    channel, so the client is notified as soon as command finishes instead
+    of polling for the status file."""
 
     assert self._run_command_available
     cmd = cmd.strip()
     
-    self._run_counter+=1
+    # run can be called from several threads, ie by async_backend handles
+    with self._run_lock:
+      self._run_counter+=1
+      run_id = self._run_counter
     self.log("tmux> %s", cmd)
 
     # todo: match logic in tmux_session (upload magic handling done
     # in init instead of run)
     if cmd.startswith('%upload'):
       self._upload_handler(cmd)
-      return
+      return 0 if sync else None
 
     # locking to wait for command to finish
     ts = str(u.now_micros())
-    cmd_fn_out = self.remote_scratch+'/'+str(self._run_counter)+'.'+ts+'.out'
+    cmd_fn_out = self.remote_scratch+'/'+str(run_id)+'.'+ts+'.out'
+    channel = 'cmd.%d.%s'%(run_id, ts)
 
     cmd = _strip_comment(cmd)
     assert not '&' in cmd, "cmd '%s' contains &, that breaks things"%(cmd,)
     modified_cmd = '%s; echo $? > %s'%(cmd, cmd_fn_out)
-    tmux_window = 'tmux:0'
+    if sync:
+      modified_cmd += '; tmux wait-for -S %s'%(channel,)
+    tmux_window = self.tmux_session+':0'
     tmux_cmd = "tmux send-keys -t {} {} Enter".format(tmux_window,
                                                         shlex.quote(modified_cmd))
-    self._run_ssh(tmux_cmd)
     if not sync:
-      return
-    
-    start_time = time.time()
-
-    while True:
-      if time.time() - start_time > max_wait_sec:
-        assert False, "Timeout %s exceeded for %s" %(max_wait_sec, cmd)
-      if not self.file_exists(cmd_fn_out):
-        self.log("waiting %s for %s"%(check_interval, cmd))
-        time.sleep(check_interval)
-        continue
-    
-      contents = self.file_read(cmd_fn_out)
-      # if empty wait a bit to allow for race condition
-      if len(contents) == 0:
-        time.sleep(check_interval)
-        contents = task.file_read(cmd_fn_out)
-
-      contents = contents.strip()
-      if contents != '0':
-        if not ignore_errors:
-          assert False, "Command %s returned status %s"%(cmd, contents)
-        else:
-          self.log("Warning: command %s returned status %s"%(cmd, contents))
-      break    
+      self._run_ssh(tmux_cmd)
+      return None
+
+    # Send keys and block on the wait-for channel in a single exec round
+    # trip. If the signal fires before wait-for starts, tmux remembers it and
+    # wait-for returns immediately.
+    wait_cmd = '%s || exit %d; timeout %d tmux wait-for %s; cat %s'%(
+      tmux_cmd, SEND_KEYS_FAILED_STATUS, max_wait_sec, channel, cmd_fn_out)
+    status, stdout_str, stderr_str = self.ssh.exec_command(wait_cmd)
+    assert status != SEND_KEYS_FAILED_STATUS, (
+      "Sending %s to tmux failed (%s)"%(cmd, stderr_str.strip()))
+    contents = stdout_str.strip()
+    assert contents, "Timeout %s exceeded for %s (%s)" %(max_wait_sec, cmd,
+                                                         stderr_str.strip())
+
+    if contents != '0':
+      if not ignore_errors:
+        assert False, "Command %s returned status %s"%(cmd, contents)
+      else:
+        self.log("Warning: command %s returned status %s"%(cmd, contents))
+    return int(contents)
 
 
   # todo: follow same logic as in def ip(self)
@@ -2,11 +2,26 @@
 # Job launcher Python API: https://docs.google.com/document/d/1yTkb4IPJXOUaEWksQPCH7q0sjqHgBf3f70cWzfoFboc/edit
 # AWS job launcher (concepts): https://docs.google.com/document/d/1IbVn8_ckfVO3Z9gIiE0b9K3UrBRRiO9HYZvXSkPXGuw/edit
 
+import concurrent.futures
 import os
 import glob
+import hashlib
+import json
+import shlex
+import time
 
+import network_probe
 import util as u
 
+# ports used by broadcast_relay.py, task i listens on BROADCAST_PORT+i
+BROADCAST_PORT=6100
+# how often metrics_agent.py samples host metrics of every task
+METRICS_INTERVAL_SEC=5
+# ports used by network_probe.py servers, task i listens on PROBE_PORT+i
+PROBE_PORT=6200
+# time to measure latency and start probe in addition to duration_sec
+PROBE_OVERHEAD_SEC=10
+
 # aws_backend.py
 # tmux_backend.py
 
@@ -69,25 +84,282 @@ class Run:
     print("%s %s: %s"%(ts, self.name, message))
 
 
+class TaskResult:
+  """Outcome of running an operation on a single task of a job."""
+
+  def __init__(self, task_id, exit_code=None, duration=0., output_tail='',
+               error=None):
+    self.task_id = task_id
+    self.exit_code = exit_code   # None if operation raised
+    self.duration = duration     # seconds
+    self.output_tail = output_tail
+    self.error = error           # exception raised by operation, if any
+
+  @property
+  def ok(self):
+    return self.error is None and self.exit_code == 0
+
+  def __repr__(self):
+    return "TaskResult(task_id=%s, exit_code=%s, duration=%.2f, error=%r)"%(
+      self.task_id, self.exit_code, self.duration, self.error)
+
+
+def fanout(tasks, func, max_concurrency=None, best_effort=False,
+           output_tail_lines=0, description='operation'):
+  """Runs func(task) on all tasks concurrently, at most max_concurrency at a
+  time (default is u.MAX_CONCURRENCY). func returns exit code, None is
+  treated as success.
+
+  Returns list of TaskResult ordered like tasks. In default (all must
+  succeed) mode, the first failure cancels tasks that haven't started yet and
+  assert fails with the failing task's result. In best_effort mode every task
+  runs to completion and failures are only reported in the results.
+
+  If output_tail_lines is set, last lines of task output are attached to each
+  result. They are taken from task.output buffer kept by output streaming, so
+  no remote call is made."""
+
+  if not tasks:
+    return []
+  if not max_concurrency:
+    max_concurrency = u.MAX_CONCURRENCY
+  max_concurrency = min(max_concurrency, len(tasks))
+
+  start_time = time.time()
+  def call(task):
+    task_start_time = time.time()
+    result = TaskResult(task.id)
+    try:
+      exit_code = func(task)
+      result.exit_code = 0 if exit_code is None else exit_code
+    except Exception as e:
+      result.error = e
+    result.duration = time.time() - task_start_time
+    output = getattr(task, 'output', None)
+    if output_tail_lines and output:
+      result.output_tail = '\n'.join(output.tail(output_tail_lines))
+    return result
+
+  executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_concurrency)
+  futures = [executor.submit(call, task) for task in tasks]
+  results = [None]*len(tasks)
+  num_done = 0
+  try:
+    for future in concurrent.futures.as_completed(futures):
+      if future.cancelled():
+        continue
+      result = future.result()
+      i = futures.index(future)
+      task = tasks[i]
+      results[i] = result
+      num_done+=1
+      if result.ok:
+        task.log("%s finished in %.1f seconds (%d/%d done, %.1f elapsed)",
+                 description, result.duration, num_done, len(tasks),
+                 time.time() - start_time)
+        continue
+
+      task.log("%s failed with exit code %s, error %s", description,
+               result.exit_code, result.error)
+      if not best_effort:
+        for other_future in futures:
+          other_future.cancel()
+        if result.error is not None:
+          raise result.error
+        assert False, "%s failed on task %s: %s"%(description, task.id, result)
+  finally:
+    # don't block on tasks still running when failing fast
+    executor.shutdown(wait=False)
+  return results
+
+
 class Job:
+  network = None  # result of probe_network
+
   def __init__(self):
     self.tasks = []
 
   def run_async(self, cmd, *args, **kwargs):
     self.run(cmd, sync=False, *args, **kwargs)
     
-  def run(self, cmd, *args, **kwargs):
-    """Runs command on every task in the job."""
-    
-    for task in self.tasks:
-      task.run(cmd, *args, **kwargs)
+  def run(self, cmd, *args, max_concurrency=None, best_effort=False,
+          output_tail_lines=0, **kwargs):
+    """Runs command on every task in the job concurrently, returns list of
+    TaskResult, one per task. See fanout for meaning of max_concurrency,
+    best_effort and output_tail_lines. Commands that fail are treated as
+    success if ignore_errors=True is passed."""
+
+    ignore_errors = kwargs.pop('ignore_errors', False)
+    if not kwargs.get('sync', True):
+      output_tail_lines = 0    # nothing to report until command finishes
+
+    def run_task(task):
+      exit_code = task.run(cmd, *args, ignore_errors=True, **kwargs)
+      if ignore_errors:
+        return 0
+      return exit_code
+
+    return fanout(self.tasks, run_task, max_concurrency=max_concurrency,
+                  best_effort=best_effort, output_tail_lines=output_tail_lines,
+                  description=cmd)
   
-  def upload(self, *args, **kwargs):
-    """Runs command on every task in the job."""
-    
+  def wait_until_ready(self):
+    """Waits until all tasks in the job are available and initialized."""
+    fanout(self.tasks, lambda task: task.wait_until_ready(),
+           description='initialize')
+
+  def add_output_callback(self, callback):
+    """Calls callback(task, line) for every line of output of every task."""
     for task in self.tasks:
-      task.upload(*args, **kwargs)
+      task.add_output_callback(callback)
+
+  def upload(self, *args, max_concurrency=None, best_effort=False,
+             broadcast=False, **kwargs):
+    """Uploads file to every task in the job concurrently, returns list of
+    TaskResult, one per task.
+
+    With broadcast=True, file is uploaded only to the first task and
+    forwarded to other tasks over the network between tasks, see
+    _broadcast_upload. All tasks of the relay chain run at once, so
+    max_concurrency can't be used with broadcast. With best_effort, tasks
+    behind a failed task in the chain fail too."""
+
+    if broadcast and len(self.tasks) > 1:
+      assert max_concurrency is None, ("max_concurrency isn't supported with "
+                                       "broadcast=True")
+      return self._broadcast_upload(*args, best_effort=best_effort, **kwargs)
+    return fanout(self.tasks, lambda task: task.upload(*args, **kwargs),
+                  max_concurrency=max_concurrency, best_effort=best_effort,
+                  description='upload')
+
+  def _broadcast_upload(self, local_fn, remote_fn=None, best_effort=False):
+    """Uploads single file to first task, which streams it through chain of
+    remaining tasks with broadcast_relay.py. Every task verifies checksum."""
+    assert os.path.isfile(local_fn), "Can only broadcast files, got "+local_fn
+    if remote_fn is None:
+      remote_fn = os.path.basename(local_fn)
+
+    sha1 = hashlib.sha1()
+    with open(local_fn, 'rb') as f:
+      for chunk in iter(lambda: f.read(1<<20), b''):
+        sha1.update(chunk)
+
+    script_fn = (os.path.dirname(os.path.abspath(__file__))+
+                 '/broadcast_relay.py')
+    fanout(self.tasks, lambda task: task.upload(script_fn, 'broadcast_relay.py'),
+           description='upload broadcast_relay.py')
+    self.tasks[0].upload(local_fn, remote_fn)
+
+    def relay(task):
+      i = self.tasks.index(task)
+      cmd = 'python broadcast_relay.py %s --sha1=%s'%(remote_fn,
+                                                      sha1.hexdigest())
+      if i > 0:
+        cmd+=' --listen-port=%d'%(BROADCAST_PORT+i,)
+      if i+1 < len(self.tasks):
+        cmd+=' --next=%s:%d'%(self.tasks[i+1].ip, BROADCAST_PORT+i+1)
+      return task.run(cmd)
+    # every relay waits for the next one in the chain, so all must run at once
+    return fanout(self.tasks, relay, max_concurrency=len(self.tasks),
+                  best_effort=best_effort, description='broadcast '+remote_fn)
   
+  def stage_dataset(self, src, dst, max_concurrency=None, **kwargs):
+    """Stages dataset on every task in the job concurrently, see
+    Task.stage_dataset. Returns list of TaskResult, one per task."""
+    start_time = time.time()
+    stats = [None]*len(self.tasks)
+    def stage(task):
+      stats[self.tasks.index(task)] = task.stage_dataset(src, dst, **kwargs)
+    results = fanout(self.tasks, stage, max_concurrency=max_concurrency,
+                     description='stage_dataset')
+    bytes_copied = sum(task_stats['bytes_copied'] for task_stats in stats)
+    elapsed = time.time() - start_time
+    print("Staged %s on %d tasks, %.1f MB/s aggregate"%(
+      src, len(self.tasks), bytes_copied/1e6/elapsed))
+    return results
+
+  def probe_network(self, duration_sec=2, cache_fn=None):
+    """Measures latency and bandwidth between all pairs of tasks with
+    network_probe.py. Pairs are probed in rounds where each task talks to at
+    most one other task, so measurements in a round run concurrently.
+
+    Result is saved in self.network and in cache_fn (by default in /tmp), and
+    reused while job has the same task ips. Returns dictionary with ips,
+    latency_ms and mb_per_sec, where mb_per_sec[i][j] is measured between
+    tasks i and j."""
+    ips = [task.ip for task in self.tasks]
+    if cache_fn is None:
+      cache_fn = '/tmp/network_probe.%s.json'%(self.name,)
+    if os.path.exists(cache_fn):
+      with open(cache_fn) as f:
+        network = json.load(f)
+      if network['ips'] == ips:
+        print("Using cached network probe from "+cache_fn)
+        self.network = network
+        return network
+
+    num_tasks = len(self.tasks)
+    latency_ms = [[0.]*num_tasks for task in self.tasks]
+    mb_per_sec = [[0.]*num_tasks for task in self.tasks]
+    script_fn = (os.path.dirname(os.path.abspath(__file__))+
+                 '/network_probe.py')
+    rounds = network_probe.round_robin_pairs(num_tasks)
+    # servers are stopped at the end, timeout only matters if this client
+    # dies, and must cover all rounds since some servers get their first
+    # client in the last round
+    server_timeout_sec = (len(rounds)*(duration_sec+PROBE_OVERHEAD_SEC)+
+                          network_probe.IDLE_TIMEOUT_SEC)
+    def start_server(task):
+      task.upload(script_fn, 'network_probe.py')
+      task.run_background('python network_probe.py --serve=%d '
+                          '--timeout-sec=%d'%(PROBE_PORT+task.id,
+                                              server_timeout_sec),
+                          'network_probe.log')
+    fanout(self.tasks, start_server, description='start probe server')
+
+    try:
+      for pairs in rounds:
+        peers = dict(pairs)
+        def probe(task):
+          peer = self.tasks[peers[task.id]]
+          stats_fn = 'network_probe.%d.json'%(u.now_micros(),)
+          task.run('python network_probe.py --peer=%s:%d --duration-sec=%s '
+                   '--stats-fn=%s'%(peer.ip, PROBE_PORT+peer.id, duration_sec,
+                                    stats_fn))
+          stats = json.loads(task.file_read(stats_fn))
+          for i, j in [(task.id, peer.id), (peer.id, task.id)]:
+            latency_ms[i][j] = stats['latency_ms']
+            mb_per_sec[i][j] = stats['mb_per_sec']
+        fanout([self.tasks[i] for i, j in pairs], probe,
+               description='network probe')
+    finally:
+      fanout(self.tasks, lambda task: task.run(
+        'python network_probe.py --stop=127.0.0.1:%d'%(PROBE_PORT+task.id,)),
+             best_effort=True, description='stop probe server')
+
+    self.network = {'ips': ips, 'latency_ms': latency_ms,
+                    'mb_per_sec': mb_per_sec}
+    with open(cache_fn, 'w') as f:
+      json.dump(self.network, f)
+    for i in range(num_tasks):
+      print("task %2d MB/s: %s"%(i, ' '.join('%8.1f'%(mb_per_sec[i][j],)
+                                            for j in range(num_tasks))))
+    return self.network
+
+  def suggest_ring_order(self):
+    """Returns task ids ordered for ring all-reduce, so that slowest link
+    between neighbors is as fast as possible. Uses probe_network."""
+    if self.network is None:
+      self.probe_network()
+    return network_probe.ring_order(self.network['mb_per_sec'])
+
+  def suggest_ps_tasks(self, num_ps):
+    """Returns ids of num_ps tasks with highest bandwidth to the rest of the
+    job, to run parameter servers on. Uses probe_network."""
+    if self.network is None:
+      self.probe_network()
+    return network_probe.central_tasks(self.network['mb_per_sec'], num_ps)
+
   # these methods redirect to the first task
   @property
   def ip(self):
@@ -108,11 +380,30 @@ class Job:
     
 class Task:
   def run(self, cmd, sync, ignore_errors):
-    """Runs command on given task."""
+    """Runs command on given task. For sync commands, returns exit code of
+    cmd as int, also when ignore_errors lets a failure pass. With sync=False,
+    returns None as soon as cmd is sent, since it's still running."""
     raise NotImplementedError()    
 
+  def add_output_callback(self, callback):
+    """Calls callback(task, line) for every line of output printed in the
+    task. Output is streamed to local log file self.output.log_fn, and
+    self.output.tail() gives recent lines without a round trip to the task."""
+    assert self.output, "Output streaming hasn't started, call wait_until_ready"
+    self.output.add_callback(callback)
+
   def run_async(self, cmd, *args, **kwargs):
     self.run(cmd, sync=False, *args, **kwargs)
+
+  def run_background(self, cmd, log_fn):
+    """Starts cmd in task directory as background process outside of the
+    task's shell, with stdout and stderr redirected into log_fn, and returns
+    without waiting for it. Unlike run, cmd can contain &."""
+    raise NotImplementedError()
+
+  def shell_pid(self):
+    """Returns pid of the shell that runs the task's commands."""
+    raise NotImplementedError()
     
   def _upload_handler(self, line):
     """Handle following types of commands.
@@ -144,6 +435,39 @@ class Task:
     """Downloads remote file to current directory."""
     raise NotImplementedError()
 
+  def stage_dataset(self, src, dst, num_streams=32, chunk_mb=64):
+    """Copies directory src on the task (ie, dataset on EFS) into dst (ie,
+    tmpfs or local NVMe) using num_streams parallel streams of chunk_mb
+    chunks. Files staged earlier with unchanged size and mtime are skipped.
+    Returns dictionary of copy statistics, see stage_dataset.py."""
+    src = os.path.normpath(src)
+    dst = os.path.normpath(dst)
+    script_fn = os.path.dirname(os.path.abspath(__file__))+'/stage_dataset.py'
+    self.upload(script_fn, 'stage_dataset.py')
+    stats_fn = 'stage_dataset.%d.json'%(u.now_micros(),)
+    self.run('python stage_dataset.py %s %s --num-streams=%d --chunk-mb=%d '
+             '--stats-fn=%s'%(shlex.quote(src), shlex.quote(dst), num_streams,
+                              chunk_mb, stats_fn))
+    stats = json.loads(self.file_read(stats_fn))
+    self.run('rm '+stats_fn)
+    self.log("Staged %s into %s: copied %d files, %.1f MB/s, skipped %d files",
+             src, dst, stats['files_copied'], stats['mb_per_sec'],
+             stats['files_skipped'])
+    return stats
+
+  def start_metrics_agent(self, interval_sec=METRICS_INTERVAL_SEC):
+    """Starts metrics_agent.py with run_background, outside of the task's
+    tmux shell, sampling host metrics into run logdir/metrics/<task
+    name>.tsv. Agent is given pid of the shell with --parent-pid and exits
+    together with it."""
+    script_fn = os.path.dirname(os.path.abspath(__file__))+'/metrics_agent.py'
+    self.upload(script_fn, 'metrics_agent.py')
+    name = '%d.%s'%(self.id, self.job.name)
+    self.run_background('python metrics_agent.py --logdir=%s --name=%s '
+                        '--interval-sec=%s --parent-pid=%d'%(
+                          self.job._run.logdir, name, interval_sec,
+                          self.shell_pid()), 'metrics_agent.log')
+
   @property
   def ip(self):
     return self._ip
@@ -184,6 +508,18 @@ class Task:
     """Return true if file exists in task current directory."""
     raise NotImplementedError()
 
+  def file_exists_many(self, fns):
+    """Returns list of booleans telling which of given files exist. Backends
+    override this to check all files in a single round trip."""
+    return [self.file_exists(fn) for fn in fns]
+
+  def file_read_many(self, fns):
+    """Returns list with contents of given files as strings, None for files
+    that don't exist. Backends override this to read all files in a single
+    round trip."""
+    return [self.file_read(fn) if self.file_exists(fn) else None
+            for fn in fns]
+
   def _ossystem(self, cmd):
     self.log(cmd)
     os.system(cmd)
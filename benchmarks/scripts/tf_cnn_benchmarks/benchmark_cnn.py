@@ -84,6 +84,15 @@ _DEFAULT_PARAMS = {
         _ParamSpec('integer', 1,
                    'number of groups of batches processed in the image '
                    'producer.'),
+    'adaptive_image_producer':
+        _ParamSpec('boolean', False,
+                   'If true, the image producer stages more groups of '
+                   'batches ahead when the model waits for input, within '
+                   'image_producer_memory_mb.'),
+    'image_producer_memory_mb':
+        _ParamSpec('integer', 2048,
+                   'Memory budget for batches staged ahead by the adaptive '
+                   'image producer.'),
     'num_batches':
         _ParamSpec('integer', 100, 'number of batches to run, excluding '
                    'warmup'),
@@ -98,6 +107,11 @@ _DEFAULT_PARAMS = {
     'display_every':
         _ParamSpec('integer', 10,
                    'Number of local steps after which progress is printed out'),
+    'step_time_stats_dir':
+        _ParamSpec('string', None,
+                   'Directory where each worker writes statistics of its step '
+                   'times, which the chief merges into cluster-wide step time '
+                   'percentiles at the end. Pass None to disable.'),
     'data_dir':
         _ParamSpec('string', None,
                    'Path to dataset in TFRecord format (aka Example '
@@ -131,6 +145,17 @@ _DEFAULT_PARAMS = {
                    'times. The purpose of this flag is to make it possible '
                    'to write regression tests that are not bottlenecked by CNS '
                    'throughput.'),
+    'decoded_cache_dir':
+        _ParamSpec('string', None,
+                   'Directory on local disk for cache of decoded images. If '
+                   'set, input images are decoded and resized once into '
+                   'memory-mapped shards, and later epochs only apply random '
+                   'crop and flip to cached images. Color distortions are '
+                   'not applied to cached images. Requires use_datasets.'),
+    'decoded_cache_size_mb':
+        _ParamSpec('integer', 100000,
+                   'Maximum size of decoded image cache in MB. Images of input '
+                   'files beyond the budget are decoded every epoch.'),
     'local_parameter_device':
         _ParamSpec('string', 'gpu',
                    'Device to use as parameter server: cpu or gpu. For '
@@ -321,6 +346,26 @@ _DEFAULT_PARAMS = {
                    'using NCCL then ring reduce across workers.\n'
                    '"pscpu:32k:xring" == use pscpu algorithm for tensors of '
                    'size up to 32kB, then xring for larger tensors.'),
+    'gradient_bucket_bytes':
+        _ParamSpec('integer', 0,
+                   'If > 0, in replicated and distributed_all_reduce modes '
+                   'gradients are packed, starting from the last layer, into '
+                   'buffers of about this many bytes, and each buffer is '
+                   'reduced as soon as its gradients are computed, '
+                   'overlapping the reduction with backprop. 0 reduces every '
+                   'gradient separately.'),
+    'gradient_wire_dtype':
+        _ParamSpec('string', None,
+                   'float16 or bfloat16. If set, in distributed_all_reduce and '
+                   'distributed_replicated modes gradients are cast to this '
+                   'type before they are sent to other tasks, and back before '
+                   'they are applied. Gradients are multiplied by the loss '
+                   'scale and clamped to the range of the type before the '
+                   'cast. Halves gradient traffic between tasks. Note that '
+                   'the loss scale is 1 unless use_fp16 is set, and with a '
+                   'loss scale of 1 float16 gives no protection against small '
+                   'gradients underflowing to zero; bfloat16 has the range '
+                   'of float32.'),
 
     # Distributed training parameters.
     'job_name':
@@ -486,6 +531,10 @@ def create_config_proto(params):
   if params.xla:
     config.graph_options.optimizer_options.global_jit_level = (
         tf.OptimizerOptions.ON_1)
+  if params.device == 'cpu' and params.num_gpus > 1:
+    # One virtual CPU device per tower, so multi-device modes such as
+    # replicated can be run on machines without GPUs.
+    config.device_count['CPU'] = params.num_gpus
   return config
 
 
@@ -512,12 +561,15 @@ def benchmark_one_step(sess,
                        fetches,
                        step,
                        batch_size,
-                       step_train_times,
+                       step_stats,
                        trace_filename,
                        image_producer,
                        params,
                        summary_op=None):
-  """Advance one step of benchmarking."""
+  """Advance one step of benchmarking.
+
+  Adds time of the step to step_stats, a cnn_util.StepTimeStats.
+  """
   if trace_filename is not None and step == -1:
     run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
     run_metadata = tf.RunMetadata()
@@ -538,14 +590,19 @@ def benchmark_one_step(sess,
     lossval = 0.
   image_producer.notify_image_consumption()
   train_time = time.time() - start_time
-  step_train_times.append(train_time)
+  step_stats.add(train_time)
   if step >= 0 and (step == 0 or (step + 1) % params.display_every == 0):
     log_str = '%i\t%s\t%.3f' % (
-        step + 1, get_perf_timing_str(batch_size, step_train_times), lossval)
+        step + 1, get_perf_timing_str(batch_size, step_stats), lossval)
     if 'top_1_accuracy' in results:
       log_str += '\t%.3f\t%.3f' % (results['top_1_accuracy'],
                                    results['top_5_accuracy'])
     log_fn(log_str)
+    wait_str = 'step time: %s, input wait: %.1f ms/step' % (
+        get_step_time_str(step_stats), image_producer.pop_wait_time() * 1000)
+    if image_producer.status_str():
+      wait_str += ', ' + image_producer.status_str()
+    log_fn(wait_str)
   if trace_filename is not None and step == -1:
     log_fn('Dumping trace to %s' % trace_filename)
     trace = timeline.Timeline(step_stats=run_metadata.step_stats)
@@ -554,20 +611,48 @@ def benchmark_one_step(sess,
   return summary_str
 
 
-def get_perf_timing_str(batch_size, step_train_times, scale=1):
-  times = np.array(step_train_times)
-  speeds = batch_size / times
-  speed_mean = scale * batch_size / np.mean(times)
+def get_perf_timing_str(batch_size, step_stats, scale=1):
+  """Returns images/sec of steps in step_stats, a cnn_util.StepTimeStats."""
+  speed_mean = scale * batch_size / step_stats.mean
   if scale == 1:
-    speed_uncertainty = np.std(speeds) / np.sqrt(float(len(speeds)))
-    speed_madstd = 1.4826 * np.median(np.abs(speeds - np.median(speeds)))
-    speed_jitter = speed_madstd
+    # Spread of speeds is derived from spread of step times, since individual
+    # step times aren't kept.
+    speed_uncertainty = (batch_size * step_stats.stddev / step_stats.mean**2 /
+                         np.sqrt(float(step_stats.count)))
+    speed_iqr = (batch_size / step_stats.quantile(0.25) -
+                 batch_size / step_stats.quantile(0.75))
+    speed_jitter = 1.4826 * speed_iqr / 2
     return 'images/sec: %.1f +/- %.1f (jitter = %.1f)' % (
         speed_mean, speed_uncertainty, speed_jitter)
   else:
     return 'images/sec: %.1f' % speed_mean
 
 
+def get_step_time_str(step_stats):
+  step_time_str = 'p50 %.1f p90 %.1f p99 %.1f ms' % (
+      step_stats.quantile(0.5) * 1000, step_stats.quantile(0.9) * 1000,
+      step_stats.quantile(0.99) * 1000)
+  if step_stats.window:
+    step_time_str += ', last %d steps %.1f ms/step' % (
+        len(step_stats.window), step_stats.window_mean() * 1000)
+  return step_time_str
+
+
+def get_step_time_summary(batch_size, step_stats):
+  """Returns tf.Summary with step time statistics and throughput."""
+  summary = tf.Summary()
+  summary.value.add(tag='step_time/mean_ms', simple_value=step_stats.mean * 1000)
+  summary.value.add(tag='step_time/stddev_ms',
+                    simple_value=step_stats.stddev * 1000)
+  for q in [50, 90, 99]:
+    summary.value.add(tag='step_time/p%d_ms' % q,
+                      simple_value=step_stats.quantile(q / 100.) * 1000)
+  if step_stats.window_mean() > 0:
+    summary.value.add(tag='images_per_sec',
+                      simple_value=batch_size / step_stats.window_mean())
+  return summary
+
+
 def load_checkpoint(saver, sess, ckpt_dir):
   ckpt = tf.train.get_checkpoint_state(ckpt_dir)
   if ckpt and ckpt.model_checkpoint_path:
@@ -715,6 +800,17 @@ class BenchmarkCNN(object):
       raise ValueError('--all_reduce_spec=nccl is invalid in a '
                        'multi-worker job')
 
+    wire_dtypes = {'float16': tf.float16, 'bfloat16': tf.bfloat16}
+    if self.params.gradient_wire_dtype:
+      if self.params.gradient_wire_dtype not in wire_dtypes:
+        raise ValueError('Invalid gradient_wire_dtype: %s' %
+                         self.params.gradient_wire_dtype)
+      if self.params.variable_update not in ('distributed_all_reduce',
+                                             'distributed_replicated'):
+        raise ValueError('gradient_wire_dtype requires variable_update of '
+                         'distributed_all_reduce or distributed_replicated')
+    wire_dtype = wire_dtypes.get(self.params.gradient_wire_dtype)
+
     # PS server is used for distributed jobs not using all-reduce.
     use_ps_server = self.job_name and (
         self.params.variable_update != 'distributed_all_reduce')
@@ -799,19 +895,23 @@ class BenchmarkCNN(object):
         raise ValueError('Invalid variable_update in distributed mode: %s' %
                          self.params.variable_update)
       self.variable_mgr = variable_mgr.VariableMgrLocalReplicated(
-          self, self.params.all_reduce_spec)
+          self, self.params.all_reduce_spec,
+          bucket_bytes=self.params.gradient_bucket_bytes)
     elif self.params.variable_update == 'distributed_all_reduce':
       assert self.params.cross_replica_sync
       self.variable_mgr = variable_mgr.VariableMgrDistributedAllReduce(
           self, self.params.all_reduce_spec,
           'worker' if len(self.worker_hosts) > 1 else 'localhost',
-          len(self.worker_hosts))
+          len(self.worker_hosts),
+          bucket_bytes=self.params.gradient_bucket_bytes,
+          wire_dtype=wire_dtype)
     elif self.params.variable_update == 'distributed_replicated':
       assert self.params.cross_replica_sync
       if not self.job_name:
         raise ValueError('Invalid variable_update in local mode: %s' %
                          self.params.variable_update)
-      self.variable_mgr = variable_mgr.VariableMgrDistributedReplicated(self)
+      self.variable_mgr = variable_mgr.VariableMgrDistributedReplicated(
+          self, wire_dtype=wire_dtype)
     elif self.params.variable_update == 'independent':
       if self.job_name:
         raise ValueError('Invalid variable_update in distributed mode: %s' %
@@ -880,6 +980,10 @@ class BenchmarkCNN(object):
     if (self.params.variable_update == 'replicated' or
         self.params.variable_update == 'distributed_all_reduce'):
       log_fn('AllReduce:   %s' % self.params.all_reduce_spec)
+      if self.params.gradient_bucket_bytes > 0:
+        log_fn('Buckets:     %d bytes' % self.params.gradient_bucket_bytes)
+    if self.params.gradient_wire_dtype:
+      log_fn('Wire dtype:  %s' % self.params.gradient_wire_dtype)
     if self.job_name:
       log_fn('Sync:        %s' % self.params.cross_replica_sync)
     if self.params.staged_vars:
@@ -958,8 +1062,7 @@ class BenchmarkCNN(object):
       sess.run(local_var_init_op_group)
       if self.dataset.queue_runner_required():
         tf.train.start_queue_runners(sess=sess)
-      image_producer = cnn_util.ImageProducer(sess, image_producer_ops,
-                                              self.batch_group_size)
+      image_producer = self._make_image_producer(sess, image_producer_ops)
       image_producer.start()
       for i in xrange(len(enqueue_ops)):
         sess.run(enqueue_ops[:(i+1)])
@@ -1079,7 +1182,7 @@ class BenchmarkCNN(object):
         save_model_secs=self.params.save_model_secs,
         summary_writer=summary_writer)
 
-    step_train_times = []
+    step_stats = cnn_util.StepTimeStats(window_size=self.params.display_every)
     start_standard_services = (self.params.summary_verbosity >= 1 or
                                self.dataset.queue_runner_required())
     if self.job_name == 'controller':
@@ -1090,8 +1193,7 @@ class BenchmarkCNN(object):
         master=master_target,
         config=create_config_proto(self.params),
         start_standard_services=start_standard_services) as sess:
-      image_producer = cnn_util.ImageProducer(sess, image_producer_ops,
-                                              self.batch_group_size)
+      image_producer = self._make_image_producer(sess, image_producer_ops)
       image_producer.start()
       for i in xrange(len(enqueue_ops)):
         sess.run(enqueue_ops[:(i+1)])
@@ -1138,23 +1240,28 @@ class BenchmarkCNN(object):
           if self.params.print_training_accuracy or self.params.forward_only:
             header_str += '\ttop_1_accuracy\ttop_5_accuracy'
           log_fn(header_str)
-          assert len(step_train_times) == self.num_warmup_batches
+          assert step_stats.count == self.num_warmup_batches
           # reset times to ignore warm up batch
-          step_train_times = []
+          step_stats = cnn_util.StepTimeStats(
+              window_size=self.params.display_every)
           loop_start_time = time.time()
         if (summary_writer and
             (local_step + 1) % self.params.save_summaries_steps == 0):
           fetch_summary = summary_op
         else:
           fetch_summary = None
+        step_batch_size = self.batch_size * (len(self.worker_hosts)
+                                             if self.single_session else 1)
         summary_str = benchmark_one_step(
-            sess, fetches, local_step,
-            self.batch_size * (len(self.worker_hosts)
-                               if self.single_session else 1),
-            step_train_times, self.trace_filename, image_producer, self.params,
-            fetch_summary)
+            sess, fetches, local_step, step_batch_size, step_stats,
+            self.trace_filename, image_producer, self.params, fetch_summary)
         if summary_str is not None and is_chief:
           sv.summary_computed(sess, summary_str)
+        if (summary_writer and local_step >= 0 and
+            (local_step + 1) % self.params.display_every == 0):
+          summary_writer.add_summary(
+              get_step_time_summary(step_batch_size, step_stats),
+              self.init_global_step + local_step + 1)
         local_step += 1
       loop_end_time = time.time()
       # Waits for the global step to be done, regardless of done_fn.
@@ -1176,8 +1283,16 @@ class BenchmarkCNN(object):
 
       log_fn('-' * 64)
       log_fn('total images/sec: %.2f' % images_per_sec)
+      if step_stats.count:
+        log_fn('step time: %s' % get_step_time_str(step_stats))
+      wire_bytes = self.variable_mgr.get_wire_bytes_per_step()
+      if wire_bytes is not None and step_stats.count:
+        log_fn('gradient traffic: %.1f MB/step, %.1f MB/sec per worker' % (
+            wire_bytes / 1e6, wire_bytes / 1e6 / step_stats.mean))
       log_fn('-' * 64)
       image_producer.done()
+      if self.params.step_time_stats_dir:
+        self._save_step_time_stats(step_stats)
       if is_chief:
         store_benchmarks({'total_images_per_sec': images_per_sec}, self.params)
       # Save the model checkpoint.
@@ -1191,6 +1306,8 @@ class BenchmarkCNN(object):
         # Wait for other workers to reach the end, so this worker doesn't
         # go away underneath them.
         sess.run([execution_barrier])
+      if self.params.step_time_stats_dir and is_chief:
+        self._log_cluster_step_times()
     sv.stop()
     return {
         'num_workers': num_workers,
@@ -1199,6 +1316,44 @@ class BenchmarkCNN(object):
         'images_per_sec': images_per_sec
     }
 
+  def _step_time_stats_filename(self, task_index):
+    return os.path.join(self.params.step_time_stats_dir,
+                        'step_time_stats.%d.json' % task_index)
+
+  def _save_step_time_stats(self, step_stats):
+    """Writes step time statistics of this worker for the chief to merge."""
+    if not gfile.Exists(self.params.step_time_stats_dir):
+      gfile.MakeDirs(self.params.step_time_stats_dir)
+    step_stats.save(self._step_time_stats_filename(self.task_index))
+
+  def _log_cluster_step_times(self):
+    """Logs step time percentiles over steps of all workers.
+
+    Workers that haven't written their statistics yet (no execution barrier
+    in asynchronous mode) are left out.
+    """
+    num_workers = 1 if self.single_session else len(self.worker_hosts)
+    filenames = [self._step_time_stats_filename(i) for i in xrange(num_workers)]
+    num_found = len([fn for fn in filenames if gfile.Exists(fn)])
+    merged = cnn_util.merge_step_time_stats(filenames)
+    if merged is not None:
+      log_fn('cluster step time (%d of %d workers, %d steps): %s' % (
+          num_found, num_workers, merged.count, get_step_time_str(merged)))
+
+  def _make_image_producer(self, sess, image_producer_ops):
+    """Returns image producer that runs image_producer_ops in background."""
+    if not self.params.adaptive_image_producer:
+      return cnn_util.ImageProducer(sess, image_producer_ops,
+                                    self.batch_group_size)
+    image_size = self.model.get_image_size()
+    # self.batch_size already covers all devices
+    group_bytes = (self.batch_size * self.batch_group_size *
+                   image_size * image_size * 3 *
+                   get_data_type(self.params).size)
+    max_depth = self.params.image_producer_memory_mb * (1 << 20) // group_bytes
+    return cnn_util.AdaptiveImageProducer(sess, image_producer_ops,
+                                          self.batch_group_size, max_depth)
+
   def _build_image_processing(self, shift_ratio=0):
     """"Build the image (pre)processing portion of the model graph."""
     with tf.device(self.cpu_device):
@@ -1375,6 +1530,10 @@ class BenchmarkCNN(object):
         self.variable_mgr.append_apply_gradients_ops(
             gradient_state, opt, clipped_grads, training_ops)
     train_op = tf.group(*(training_ops + update_ops))
+    wire_bytes = self.variable_mgr.get_wire_bytes_per_step()
+    if wire_bytes is not None:
+      log_fn('Gradient bytes sent to other tasks: %d per worker per step' %
+             wire_bytes)
 
     with tf.device(self.cpu_device):
       if self.task_index == 0 and self.params.summary_verbosity >= 1:
@@ -1653,7 +1812,7 @@ class BenchmarkCNN(object):
 
     processor_class = self.dataset.get_image_preprocessor()
     assert processor_class
-    return processor_class(
+    preprocessor = processor_class(
         image_size,
         image_size,
         self.batch_size * self.batch_group_size,
@@ -1666,6 +1825,15 @@ class BenchmarkCNN(object):
         summary_verbosity=self.params.summary_verbosity,
         distort_color_in_yiq=self.params.distort_color_in_yiq,
         fuse_decode_and_crop=self.params.fuse_decode_and_crop)
+    if self.params.decoded_cache_dir:
+      if not hasattr(preprocessor, 'set_decoded_cache'):
+        raise ValueError('decoded_cache_dir is not supported for dataset %s' %
+                         self.dataset.name)
+      if not self.params.use_datasets:
+        raise ValueError('decoded_cache_dir requires use_datasets=true')
+      preprocessor.set_decoded_cache(self.params.decoded_cache_dir,
+                                     self.params.decoded_cache_size_mb)
+    return preprocessor
 
   def add_sync_queues_and_barrier(self, name_prefix,
                                   enqueue_after_list):
@@ -16,8 +16,12 @@
 """Utilities for CNN benchmarks."""
 from __future__ import print_function
 
+import collections
+import json
+import math
 import sys
 import threading
+import time
 
 import tensorflow as tf
 tf.flags.DEFINE_boolean('use_python32_barrier', False,
@@ -128,6 +132,9 @@ class ImageProducer(object):
       self.put_barrier = threading.Barrier(2)
     else:
       self.put_barrier = Barrier(2)
+    # time the main thread spent blocked on the producer, see pop_wait_time()
+    self.wait_time = 0.
+    self.wait_steps = 0
 
   def _should_put(self):
     return self.num_gets % self.batch_group_size == 0
@@ -152,10 +159,269 @@ class ImageProducer(object):
     the model computation.
     """
     if self._should_put():
+      start_time = time.time()
       self.put_barrier.wait()
+      self.wait_time += time.time() - start_time
     self.num_gets += 1
+    self.wait_steps += 1
+
+  def pop_wait_time(self):
+    """Returns average time in seconds that main thread was blocked waiting
+    for input per step since last call."""
+    wait_time = self.wait_time / max(self.wait_steps, 1)
+    self.wait_time = 0.
+    self.wait_steps = 0
+    return wait_time
+
+  def status_str(self):
+    """Returns description of producer state for logging."""
+    return ''
 
   def _loop_producer(self):
     while not self.done_event.isSet():
       self.sess.run([self.put_ops])
       self.put_barrier.wait()
+
+
+class AdaptiveImageProducer(ImageProducer):
+  """Image producer that stages a variable number of batch groups ahead.
+
+  Instead of running `put_ops` in lockstep with the main thread, the producer
+  thread runs ahead by up to `depth` groups of batches. Whenever the main
+  thread has to wait for input for more than `stall_threshold` of its group
+  time, depth is increased, up to `max_depth`, which is derived from the
+  memory budget for staged images. After `shrink_after` groups without stalls
+  depth is decreased again to free memory. With depth 1 this behaves like
+  ImageProducer.
+  """
+
+  def __init__(self, sess, put_ops, batch_group_size, max_depth,
+               stall_threshold=0.05, shrink_after=100):
+    super(AdaptiveImageProducer, self).__init__(sess, put_ops,
+                                                batch_group_size)
+    self.depth = 1
+    self.max_depth = max(1, max_depth)
+    self.stall_threshold = stall_threshold
+    self.shrink_after = shrink_after
+    self.cond = threading.Condition(threading.Lock())
+    self.groups_ready = 0   # groups staged but not yet taken by main thread
+    self.groups_without_stall = 0
+    self.last_take_time = None
+    # moving averages of seconds per group
+    self.producer_time = 0.
+    self.consumer_time = 0.
+
+  def done(self):
+    """Stop the image producer."""
+    with self.cond:
+      self.done_event.set()
+      self.cond.notify_all()
+    self.thread.join()
+
+  def notify_image_consumption(self):
+    """Increment the counter of image_producer by 1, blocking until the next
+    group of batches is staged if this step starts a new group."""
+    if self._should_put():
+      start_time = time.time()
+      with self.cond:
+        while self.groups_ready == 0 and not self.done_event.isSet():
+          self.cond.wait()
+        self.groups_ready -= 1
+        self.cond.notify_all()
+      now = time.time()
+      wait_time = now - start_time
+      self.wait_time += wait_time
+      if self.last_take_time is not None:
+        group_time = start_time - self.last_take_time
+        self.consumer_time = _moving_average(self.consumer_time, group_time)
+        self._adapt(wait_time, group_time)
+      self.last_take_time = now
+    self.num_gets += 1
+    self.wait_steps += 1
+
+  def _adapt(self, wait_time, group_time):
+    if wait_time > self.stall_threshold * max(group_time, 1e-6):
+      self.groups_without_stall = 0
+      if self.depth < self.max_depth:
+        with self.cond:
+          self.depth += 1
+          self.cond.notify_all()
+        log_fn('Input stall of %.1f ms, staging %d groups of batches ahead' %
+               (wait_time * 1000, self.depth))
+    else:
+      self.groups_without_stall += 1
+      if self.groups_without_stall >= self.shrink_after and self.depth > 1:
+        self.groups_without_stall = 0
+        with self.cond:
+          self.depth -= 1
+        log_fn('No input stalls, staging %d groups of batches ahead' %
+               self.depth)
+
+  def status_str(self):
+    return ('staging depth %d, producer %.1f ms/group, consumer %.1f ms/group'
+            % (self.depth, self.producer_time * 1000,
+               self.consumer_time * 1000))
+
+  def _loop_producer(self):
+    while not self.done_event.isSet():
+      with self.cond:
+        while (self.groups_ready >= self.depth and
+               not self.done_event.isSet()):
+          self.cond.wait()
+      if self.done_event.isSet():
+        break
+      start_time = time.time()
+      self.sess.run([self.put_ops])
+      self.producer_time = _moving_average(self.producer_time,
+                                           time.time() - start_time)
+      with self.cond:
+        self.groups_ready += 1
+        self.cond.notify_all()
+
+
+def _moving_average(average, value, decay=0.9):
+  if average == 0.:
+    return value
+  return decay * average + (1 - decay) * value
+
+
+class QuantileSketch(object):
+  """Mergeable sketch of distribution of positive values.
+
+  Values are counted in buckets with logarithmically spaced boundaries, so
+  quantiles have relative error of at most `relative_accuracy` and memory
+  only grows with log of the range of values, not with number of values.
+  Sketches with the same accuracy can be merged, ie across workers.
+  """
+
+  def __init__(self, relative_accuracy=0.01):
+    self.relative_accuracy = relative_accuracy
+    self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+    self.log_gamma = math.log(self.gamma)
+    self.buckets = collections.defaultdict(int)
+    self.count = 0
+
+  def add(self, value):
+    value = max(value, 1e-9)
+    self.buckets[int(math.ceil(math.log(value) / self.log_gamma))] += 1
+    self.count += 1
+
+  def quantile(self, q):
+    """Returns approximate q-quantile, 0 <= q <= 1."""
+    if not self.count:
+      return 0.
+    rank = q * (self.count - 1)
+    seen = 0
+    for key in sorted(self.buckets):
+      seen += self.buckets[key]
+      if seen > rank:
+        break
+    # middle of the bucket in terms of relative error
+    return 2 * self.gamma ** key / (self.gamma + 1)
+
+  def merge(self, other):
+    assert self.relative_accuracy == other.relative_accuracy
+    for key, count in other.buckets.items():
+      self.buckets[key] += count
+    self.count += other.count
+
+  def to_dict(self):
+    return {'relative_accuracy': self.relative_accuracy,
+            'buckets': dict((str(k), v) for k, v in self.buckets.items())}
+
+  @classmethod
+  def from_dict(cls, d):
+    sketch = cls(d['relative_accuracy'])
+    for key, count in d['buckets'].items():
+      sketch.buckets[int(key)] = count
+      sketch.count += count
+    return sketch
+
+
+class StepTimeStats(object):
+  """Streaming statistics of step times with constant memory.
+
+  Keeps running mean and variance (Welford), a QuantileSketch for
+  percentiles, and the last `window_size` step times for current throughput.
+  """
+
+  def __init__(self, window_size=100):
+    self.count = 0
+    self.mean = 0.
+    self.m2 = 0.   # sum of squared differences from the mean
+    self.sketch = QuantileSketch()
+    self.window = collections.deque(maxlen=window_size)
+
+  def __len__(self):
+    return self.count
+
+  def add(self, step_time):
+    self.count += 1
+    delta = step_time - self.mean
+    self.mean += delta / self.count
+    self.m2 += delta * (step_time - self.mean)
+    self.sketch.add(step_time)
+    self.window.append(step_time)
+
+  @property
+  def stddev(self):
+    if self.count < 2:
+      return 0.
+    return math.sqrt(self.m2 / (self.count - 1))
+
+  def quantile(self, q):
+    return self.sketch.quantile(q)
+
+  def window_mean(self):
+    if not self.window:
+      return 0.
+    return sum(self.window) / len(self.window)
+
+  def merge(self, other):
+    """Adds step times of other stats, ie of another worker. Window is kept
+    as is."""
+    count = self.count + other.count
+    if not count:
+      return
+    delta = other.mean - self.mean
+    self.m2 += other.m2 + delta * delta * self.count * other.count / count
+    self.mean += delta * other.count / count
+    self.count = count
+    self.sketch.merge(other.sketch)
+
+  def to_dict(self):
+    return {'count': self.count, 'mean': self.mean, 'm2': self.m2,
+            'sketch': self.sketch.to_dict()}
+
+  @classmethod
+  def from_dict(cls, d):
+    stats = cls()
+    stats.count = d['count']
+    stats.mean = d['mean']
+    stats.m2 = d['m2']
+    stats.sketch = QuantileSketch.from_dict(d['sketch'])
+    return stats
+
+  def save(self, filename):
+    with tf.gfile.Open(filename, 'w') as f:
+      f.write(json.dumps(self.to_dict()))
+
+  @classmethod
+  def load(cls, filename):
+    with tf.gfile.Open(filename) as f:
+      return cls.from_dict(json.loads(f.read()))
+
+
+def merge_step_time_stats(filenames):
+  """Returns StepTimeStats of all steps in given files, ie written by
+  different workers, or None if none of the files exist."""
+  merged = None
+  for filename in filenames:
+    if not tf.gfile.Exists(filename):
+      continue
+    stats = StepTimeStats.load(filename)
+    if merged is None:
+      merged = stats
+    else:
+      merged.merge(stats)
+  return merged
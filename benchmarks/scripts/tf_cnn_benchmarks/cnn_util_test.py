@@ -0,0 +1,127 @@
+# Copyright 2017 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for cnn_util."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import cnn_util
+
+
+class StepTimeStatsTest(tf.test.TestCase):
+
+  def _stats(self, step_times):
+    stats = cnn_util.StepTimeStats(window_size=10)
+    for step_time in step_times:
+      stats.add(step_time)
+    return stats
+
+  def testMomentsAndWindow(self):
+    step_times = np.random.RandomState(0).uniform(0.1, 0.5, 1000)
+    stats = self._stats(step_times)
+    self.assertEqual(1000, len(stats))
+    self.assertAllClose(np.mean(step_times), stats.mean)
+    self.assertAllClose(np.std(step_times, ddof=1), stats.stddev)
+    self.assertAllClose(np.mean(step_times[-10:]), stats.window_mean())
+
+  def testQuantilesWithinRelativeAccuracy(self):
+    step_times = np.random.RandomState(0).lognormal(-2., 1., 10000)
+    stats = self._stats(step_times)
+    sorted_times = np.sort(step_times)
+    for q in [0., 0.5, 0.9, 0.99, 1.]:
+      expected = sorted_times[int(q * (len(step_times) - 1))]
+      self.assertAllClose(expected, stats.quantile(q), rtol=0.02)
+
+  def testMergeMatchesCombinedStats(self):
+    step_times = np.random.RandomState(0).uniform(0.1, 0.5, 1000)
+    merged = self._stats(step_times[:300])
+    merged.merge(self._stats(step_times[300:]))
+    combined = self._stats(step_times)
+    self.assertEqual(combined.count, merged.count)
+    self.assertAllClose(combined.mean, merged.mean)
+    self.assertAllClose(combined.stddev, merged.stddev)
+    for q in [0.5, 0.9]:
+      self.assertAllClose(combined.quantile(q), merged.quantile(q))
+
+  def testDictRoundTrip(self):
+    stats = self._stats([0.1, 0.2, 0.4])
+    restored = cnn_util.StepTimeStats.from_dict(
+        json.loads(json.dumps(stats.to_dict())))
+    self.assertEqual(stats.count, restored.count)
+    self.assertAllClose(stats.mean, restored.mean)
+    self.assertAllClose(stats.stddev, restored.stddev)
+    self.assertAllClose(stats.quantile(0.5), restored.quantile(0.5))
+
+
+class _FakeSession(object):
+  """Session whose run() takes `run_time` seconds and records how many
+  groups the producer staged ahead of the consumer."""
+
+  def __init__(self, run_time):
+    self.run_time = run_time
+    self.producer = None
+    self.max_groups_ready = 0
+    self.lock = threading.Lock()
+
+  def run(self, unused_ops):
+    time.sleep(self.run_time)
+    with self.lock:
+      self.max_groups_ready = max(self.max_groups_ready,
+                                  self.producer.groups_ready + 1)
+
+
+class AdaptiveImageProducerTest(tf.test.TestCase):
+
+  def _producer(self, run_time, max_depth, **kwargs):
+    sess = _FakeSession(run_time)
+    producer = cnn_util.AdaptiveImageProducer(
+        sess, [], batch_group_size=1, max_depth=max_depth, **kwargs)
+    sess.producer = producer
+    return sess, producer
+
+  def testDepthGrowsOnStallsUpToMaxDepth(self):
+    sess, producer = self._producer(0.02, max_depth=3)
+    producer.start()
+    for _ in range(20):
+      producer.notify_image_consumption()
+    producer.done()
+    self.assertEqual(3, producer.depth)
+    self.assertLessEqual(sess.max_groups_ready, 3)
+    self.assertGreater(producer.pop_wait_time(), 0.)
+    self.assertEqual(0., producer.pop_wait_time())
+
+  def testDepthShrinksWithoutStalls(self):
+    _, producer = self._producer(0., max_depth=4, shrink_after=3)
+    producer.depth = 3
+    for _ in range(5):
+      producer._adapt(wait_time=0., group_time=1.)
+    self.assertEqual(2, producer.depth)
+    producer._adapt(wait_time=0.5, group_time=1.)
+    self.assertEqual(3, producer.depth)
+    for _ in range(100):
+      producer._adapt(wait_time=0., group_time=1.)
+    self.assertEqual(1, producer.depth)
+
+
+if __name__ == '__main__':
+  tf.test.main()
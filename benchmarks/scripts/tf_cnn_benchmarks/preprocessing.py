@@ -15,7 +15,14 @@
 
 """Image pre-processing utilities.
 """
+import errno
+import hashlib
+import json
 import math
+import os
+import shutil
+import socket
+import numpy as np
 from six.moves import xrange  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
@@ -432,6 +439,183 @@ def distort_color(image, batch_position=0, distort_color_in_yiq=False,
     return image
 
 
+class DecodedImageCache(object):
+  """Cache of decoded images on local disk.
+
+  Images are decoded once, resized to image_size x image_size and stored as
+  uint8 numpy shards, which are memory-mapped when reading, so later epochs
+  read images at memory bandwidth instead of decoding JPEGs again. Aspect
+  ratio of images is not preserved.
+
+  The cache is kept in a subdirectory of cache_dir named after name of the
+  cache (ie, subset) and hash of the input files and resize settings, so
+  changing them invalidates the cache. Only whole input files are cached until
+  size_budget_mb is reached, images of remaining files have to be decoded
+  every epoch.
+  """
+
+  PREFIX = 'decoded_cache.'
+
+  def __init__(self, cache_dir, file_names, image_size, resize_method,
+               size_budget_mb, images_per_shard=1024, name='default',
+               images_per_slice=256):
+    self.cache_dir = cache_dir
+    self.name = name
+    self.file_names = sorted(file_names)
+    self.image_size = image_size
+    # round_robin and crop don't apply to cached images, which are resized
+    # once up front
+    if resize_method not in ('nearest', 'bilinear', 'bicubic', 'area'):
+      resize_method = 'bilinear'
+    self.resize_method = resize_method
+    self.size_budget_mb = size_budget_mb
+    self.images_per_shard = images_per_shard
+    self.images_per_slice = images_per_slice
+    settings = {'files': self.file_names, 'image_size': image_size,
+                'resize_method': resize_method,
+                'images_per_shard': images_per_shard}
+    key = hashlib.sha1(json.dumps(settings, sort_keys=True).encode())
+    self.path = os.path.join(cache_dir, '%s%s.%s' % (self.PREFIX, name,
+                                                     key.hexdigest()[:16]))
+
+  def _shard_fn(self, path, shard_index, kind):
+    return os.path.join(path, '%s-%05d.npy' % (kind, shard_index))
+
+  def load_index(self):
+    """Returns index of completely built cache, or None if there is none."""
+    try:
+      with open(os.path.join(self.path, 'index.json')) as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def _decode_and_resize(self, record, file_index):
+    image_buffer, label, _, _ = parse_example_proto(record)
+    image = tf.image.decode_jpeg(image_buffer, channels=3,
+                                 dct_method='INTEGER_FAST')
+    image = tf.image.resize_images(
+        image, [self.image_size, self.image_size],
+        get_image_resize_method(self.resize_method), align_corners=False)
+    image = tf.cast(tf.clip_by_value(tf.round(image), 0, 255), tf.uint8)
+    return image, label, file_index
+
+  def _is_stale(self, name):
+    """Tells if entry of cache_dir is an outdated cache of the same name, or
+    leftover of a build on this host by a process that's no longer running.
+    Other entries, like caches of other names or builds in progress, are
+    never stale."""
+    prefix = '%s%s.' % (self.PREFIX, self.name)
+    if (not name.startswith(prefix) or
+        os.path.join(self.cache_dir, name) == self.path):
+      return False
+    # <hash> for complete caches, <hash>.tmp.<host>.<pid> during build
+    _, sep, build = name[len(prefix):].partition('.')
+    if not sep:
+      return True
+    if not build.startswith('tmp.'):
+      return False
+    host, _, pid = build[len('tmp.'):].rpartition('.')
+    if host != socket.gethostname() or not pid.isdigit():
+      return False
+    try:
+      os.kill(int(pid), 0)
+    except OSError as e:
+      return e.errno == errno.ESRCH
+    return False
+
+  def build(self):
+    """Decodes input files into the cache and returns its index. Outdated
+    caches of the same name in cache_dir are deleted, see _is_stale. Readers
+    of a deleted cache keep working, since its shards are memory-mapped."""
+    if os.path.isdir(self.cache_dir):
+      for name in os.listdir(self.cache_dir):
+        if self._is_stale(name):
+          shutil.rmtree(os.path.join(self.cache_dir, name), ignore_errors=True)
+    tmp_path = '%s.tmp.%s.%d' % (self.path, socket.gethostname(), os.getpid())
+    os.makedirs(tmp_path)
+
+    image_bytes = self.image_size * self.image_size * 3
+    max_images = self.size_budget_mb * (1 << 20) // image_bytes
+    shape = [self.image_size, self.image_size, 3]
+    num_images = 0    # images written into shards
+    num_cached = 0    # images of completely cached files
+    num_files = 0     # number of completely cached files
+    last_file_index = 0
+    with tf.Graph().as_default():
+      files = tf.data.Dataset.from_tensor_slices(
+          (self.file_names, tf.range(len(self.file_names))))
+      ds = files.flat_map(
+          lambda fn, i: tf.data.TFRecordDataset(fn).map(lambda r: (r, i)))
+      ds = ds.map(self._decode_and_resize, num_parallel_calls=16)
+      ds = ds.batch(self.images_per_shard).prefetch(2)
+      next_batch = ds.make_one_shot_iterator().get_next()
+      with tf.Session() as sess:
+        while num_images < max_images:
+          try:
+            images, labels, file_indices = sess.run(next_batch)
+          except tf.errors.OutOfRangeError:
+            num_cached = num_images
+            num_files = len(self.file_names)
+            break
+          # images before start of a new file belong to completely cached
+          # files
+          for i in xrange(len(file_indices)):
+            if (file_indices[i] != last_file_index and
+                num_images + i <= max_images):
+              num_cached = num_images + i
+              num_files = file_indices[i]
+            last_file_index = file_indices[i]
+          shard_index = num_images // self.images_per_shard
+          np.save(self._shard_fn(tmp_path, shard_index, 'images'), images)
+          np.save(self._shard_fn(tmp_path, shard_index, 'labels'),
+                  labels.reshape([-1]))
+          num_images += len(images)
+
+    index = {'num_images': num_cached, 'num_files': int(num_files),
+             'num_shards': -(-num_cached // self.images_per_shard),
+             'image_shape': shape}
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as f:
+      json.dump(index, f)
+    try:
+      os.rename(tmp_path, self.path)
+    except OSError:   # another process finished building the same cache
+      shutil.rmtree(tmp_path, ignore_errors=True)
+    cnn_util.log_fn('Cached %d decoded images of %d/%d files in %s' %
+                    (num_cached, num_files, len(self.file_names), self.path))
+    return index
+
+  def dataset(self, index):
+    """Returns dataset of (uint8 image, label) read from the cache.
+
+    Images are read as contiguous slices of images_per_slice images of the
+    memory-mapped shards, in different random order of slices every epoch, so
+    Python only runs once per slice. Order of images within a slice is fixed,
+    so callers should follow with a shuffle buffer."""
+    images = [np.load(self._shard_fn(self.path, i, 'images'), mmap_mode='r')
+              for i in xrange(index['num_shards'])]
+    labels = [np.load(self._shard_fn(self.path, i, 'labels')).reshape([-1, 1])
+              for i in xrange(index['num_shards'])]
+    num_images = index['num_images']
+    slices = []     # (shard index, start, end) of every slice
+    for shard_index in xrange(index['num_shards']):
+      shard_start = shard_index * self.images_per_shard
+      shard_size = min(self.images_per_shard, num_images - shard_start)
+      for start in xrange(0, shard_size, self.images_per_slice):
+        slices.append((shard_index, start,
+                       min(start + self.images_per_slice, shard_size)))
+
+    def generator():
+      for i in np.random.permutation(len(slices)):
+        shard_index, start, end = slices[i]
+        yield (images[shard_index][start:end],
+               labels[shard_index][start:end])
+
+    ds = tf.data.Dataset.from_generator(
+        generator, (tf.uint8, tf.int32),
+        ([None] + index['image_shape'], [None, 1]))
+    return ds.apply(batching.unbatch())
+
+
 class RecordInputImagePreprocessor(object):
   """Preprocessor for images with RecordInput format."""
 
@@ -466,6 +650,13 @@ class RecordInputImagePreprocessor(object):
           (self.batch_size, self.num_splits))
     self.batch_size_per_split = self.batch_size // self.num_splits
     self.summary_verbosity = summary_verbosity
+    self.decoded_cache_dir = None
+    self.decoded_cache_size_mb = 0
+
+  def set_decoded_cache(self, cache_dir, size_budget_mb):
+    """Enables cache of decoded images in cache_dir, see DecodedImageCache."""
+    self.decoded_cache_dir = cache_dir
+    self.decoded_cache_size_mb = size_budget_mb
 
   def preprocess(self, image_buffer, bbox, batch_position):
     """Preprocessing image_buffer as a function of its batch position."""
@@ -492,6 +683,39 @@ class RecordInputImagePreprocessor(object):
     image = self.preprocess(image_buffer, bbox, batch_position)
     return (label_index, image)
 
+  def crop_and_flip_cached(self, image, label_index):
+    """Preprocesses image read from DecodedImageCache. Training images get
+    random crop and flip, eval images are center cropped."""
+    if self.train:
+      image = tf.random_crop(image, [self.height, self.width, 3])
+      image = tf.image.random_flip_left_right(image)
+    else:
+      shape = image.get_shape().as_list()
+      image = tf.slice(image, [(shape[0] - self.height) // 2,
+                               (shape[1] - self.width) // 2, 0],
+                       [self.height, self.width, 3])
+    return (label_index, tf.cast(image, tf.float32))
+
+  def _decoded_cache_dataset(self, file_names, subset):
+    """Returns dataset of (label, image) from decoded image cache, followed by
+    images of input files that didn't fit into the cache."""
+    # stored images are larger than model input so that random crops vary
+    cached_size = int(math.ceil(max(self.height, self.width) * 1.15))
+    cache = DecodedImageCache(self.decoded_cache_dir, file_names, cached_size,
+                              self.resize_method, self.decoded_cache_size_mb,
+                              name=subset)
+    index = cache.load_index() or cache.build()
+    ds = cache.dataset(index).map(self.crop_and_flip_cached,
+                                  num_parallel_calls=self.num_splits * 4)
+    uncached_files = cache.file_names[index['num_files']:]
+    if uncached_files:
+      uncached = tf.data.TFRecordDataset(uncached_files)
+      uncached = tf.data.Dataset.zip(
+          (uncached, tf.data.Dataset.range(self.batch_size).repeat()))
+      ds = ds.concatenate(uncached.map(self.parse_and_preprocess,
+                                       num_parallel_calls=self.num_splits * 4))
+    return ds
+
   def minibatch(self, dataset, subset, use_datasets, cache_data,
                 shift_ratio=-1):
     if shift_ratio < 0:
@@ -506,23 +730,29 @@ class RecordInputImagePreprocessor(object):
         if not file_names:
           raise ValueError('Found no files in --data_dir matching: {}'
                            .format(glob_pattern))
-        ds = tf.data.TFRecordDataset.list_files(file_names)
-        ds = ds.apply(
-            interleave_ops.parallel_interleave(
-                tf.data.TFRecordDataset, cycle_length=10))
-        if cache_data:
-          ds = ds.take(1).cache().repeat()
-        counter = tf.data.Dataset.range(self.batch_size)
-        counter = counter.repeat()
-        ds = tf.data.Dataset.zip((ds, counter))
-        ds = ds.prefetch(buffer_size=self.batch_size)
-        ds = ds.shuffle(buffer_size=10000)
-        ds = ds.repeat()
-        ds = ds.apply(
-            batching.map_and_batch(
-                map_func=self.parse_and_preprocess,
-                batch_size=self.batch_size_per_split,
-                num_parallel_batches=self.num_splits))
+        if self.decoded_cache_dir:
+          ds = self._decoded_cache_dataset(file_names, subset)
+          ds = ds.shuffle(buffer_size=10000)
+          ds = ds.repeat()
+          ds = ds.batch(self.batch_size_per_split)
+        else:
+          ds = tf.data.TFRecordDataset.list_files(file_names)
+          ds = ds.apply(
+              interleave_ops.parallel_interleave(
+                  tf.data.TFRecordDataset, cycle_length=10))
+          if cache_data:
+            ds = ds.take(1).cache().repeat()
+          counter = tf.data.Dataset.range(self.batch_size)
+          counter = counter.repeat()
+          ds = tf.data.Dataset.zip((ds, counter))
+          ds = ds.prefetch(buffer_size=self.batch_size)
+          ds = ds.shuffle(buffer_size=10000)
+          ds = ds.repeat()
+          ds = ds.apply(
+              batching.map_and_batch(
+                  map_func=self.parse_and_preprocess,
+                  batch_size=self.batch_size_per_split,
+                  num_parallel_batches=self.num_splits))
         ds = ds.prefetch(buffer_size=self.num_splits)
         ds_iterator = ds.make_one_shot_iterator()
         for d in xrange(self.num_splits):
@@ -0,0 +1,89 @@
+# Copyright 2017 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for preprocessing."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import json
+import os
+import socket
+import subprocess
+
+import numpy as np
+import tensorflow as tf
+
+import preprocessing
+
+
+class DecodedImageCacheTest(tf.test.TestCase):
+
+  def _cache(self, cache_dir, file_names, name='train'):
+    return preprocessing.DecodedImageCache(
+        cache_dir, file_names, image_size=4, resize_method='bilinear',
+        size_budget_mb=1, images_per_shard=8, name=name, images_per_slice=3)
+
+  def testOnlyStaleCachesOfSameNameAreDeleted(self):
+    cache_dir = self.get_temp_dir()
+    cache = self._cache(cache_dir, ['train-0'])
+    old_train = self._cache(cache_dir, ['train-old']).path
+    eval_cache = self._cache(cache_dir, ['eval-0'], name='validation').path
+    dead = subprocess.Popen(['true'])
+    dead.wait()
+    host = socket.gethostname()
+    self.assertFalse(cache._is_stale(os.path.basename(cache.path)))
+    self.assertTrue(cache._is_stale(os.path.basename(old_train)))
+    self.assertFalse(cache._is_stale(os.path.basename(eval_cache)))
+    self.assertFalse(cache._is_stale('user_data'))
+    # builds of other live processes and other hosts are left alone
+    self.assertFalse(cache._is_stale(os.path.basename(
+        '%s.tmp.%s.%d' % (old_train, host, os.getpid()))))
+    self.assertFalse(cache._is_stale(os.path.basename(
+        '%s.tmp.otherhost.%d' % (old_train, dead.pid))))
+    self.assertTrue(cache._is_stale(os.path.basename(
+        '%s.tmp.%s.%d' % (cache.path, host, dead.pid))))
+
+  def testDatasetReadsAllCachedImages(self):
+    cache = self._cache(self.get_temp_dir(), ['train-0'])
+    os.makedirs(cache.path)
+    num_images = 13   # last shard is partially cached
+    images = np.arange(num_images * 48, dtype=np.uint8).reshape([-1, 4, 4, 3])
+    for shard_index in range(2):
+      shard = slice(shard_index * 8, (shard_index + 1) * 8)
+      np.save(cache._shard_fn(cache.path, shard_index, 'images'),
+              images[shard])
+      np.save(cache._shard_fn(cache.path, shard_index, 'labels'),
+              np.arange(num_images, dtype=np.int32)[shard])
+    index = {'num_images': num_images - 2, 'num_files': 1, 'num_shards': 2,
+             'image_shape': [4, 4, 3]}
+    with open(os.path.join(cache.path, 'index.json'), 'w') as f:
+      json.dump(index, f)
+
+    next_element = cache.dataset(index).make_one_shot_iterator().get_next()
+    labels = []
+    with self.test_session() as sess:
+      while True:
+        try:
+          image, label = sess.run(next_element)
+        except tf.errors.OutOfRangeError:
+          break
+        self.assertAllEqual(image, images[label[0]])
+        labels.append(label[0])
+    self.assertEqual(sorted(labels), list(range(num_images - 2)))
+
+
+if __name__ == '__main__':
+  tf.test.main()
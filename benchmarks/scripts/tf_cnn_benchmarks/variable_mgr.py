@@ -20,6 +20,7 @@
 from __future__ import print_function
 
 import collections as pycoll
+import functools
 import operator
 import re
 
@@ -187,6 +188,11 @@ class VariableMgr(object):
     """Returns ops that should run post-initialization."""
     return []
 
+  def get_wire_bytes_per_step(self):
+    """Returns estimated gradient bytes each worker sends to other tasks per
+    step, or None if not known. Valid after get_gradients_to_apply."""
+    return None
+
   def get_devices(self):
     """Returns devices to use for computation; includes replica selection."""
     assert False, 'Must be implemented in subclass'
@@ -630,7 +636,7 @@ class VariableMgrLocalReplicated(VariableMgr):
      gradients to all towers.
   """
 
-  def __init__(self, benchmark_cnn, all_reduce_spec):
+  def __init__(self, benchmark_cnn, all_reduce_spec, bucket_bytes=0):
     super(VariableMgrLocalReplicated, self).__init__(benchmark_cnn)
     if all_reduce_spec:
       spec = parse_all_reduce_spec(all_reduce_spec)
@@ -640,6 +646,7 @@ class VariableMgrLocalReplicated(VariableMgr):
       self._all_reduce_spec = spec[0]
     else:
       self._all_reduce_spec = None
+    self._bucket_bytes = bucket_bytes
 
   def each_tower_has_variables(self):
     return True
@@ -648,19 +655,26 @@ class VariableMgrLocalReplicated(VariableMgr):
     return tf.variable_scope('v%s' % device_num)
 
   def preprocess_device_grads(self, device_grads):
+    if self._bucket_bytes > 0:
+      aggregated_device_grads = sum_gradients_in_buckets(
+          device_grads, self._bucket_bytes, self._sum_gradients)
+    else:
+      aggregated_device_grads = self._sum_gradients(device_grads)
+    return (self.benchmark_cnn.devices, aggregated_device_grads)
+
+  def _sum_gradients(self, device_grads):
     if self._all_reduce_spec:
-      aggregated_device_grads = sum_gradients_all_reduce(
+      return sum_gradients_all_reduce(
           ['/job:localhost'], device_grads, 1,
           self._all_reduce_spec.alg,
           self._all_reduce_spec.shards, self.benchmark_cnn.gpu_indices)
-    else:
-      agg_grads = aggregate_gradients_using_copy_with_device_selection(
-          self.benchmark_cnn, device_grads, use_mean=False)
-      aggregated_device_grads = []
-      for arr in device_grads:
-        aggregated_device_grads.append(
-            [(g, v) for (_, v), (g, _) in zip(arr, agg_grads)])
-    return (self.benchmark_cnn.devices, aggregated_device_grads)
+    agg_grads = aggregate_gradients_using_copy_with_device_selection(
+        self.benchmark_cnn, device_grads, use_mean=False)
+    aggregated_device_grads = []
+    for arr in device_grads:
+      aggregated_device_grads.append(
+          [(g, v) for (_, v), (g, _) in zip(arr, agg_grads)])
+    return aggregated_device_grads
 
   def get_gradients_to_apply(self, device_num, gradient_state):
     device_grads = gradient_state
@@ -703,7 +717,7 @@ class VariableMgrDistributedAllReduce(VariableMgr):
   """
 
   def __init__(self, benchmark_cnn, all_reduce_spec, job_name,
-               num_workers):
+               num_workers, bucket_bytes=0, wire_dtype=None):
     super(VariableMgrDistributedAllReduce, self).__init__(benchmark_cnn)
     if not all_reduce_spec:
       raise ValueError(
@@ -712,6 +726,10 @@ class VariableMgrDistributedAllReduce(VariableMgr):
     self._all_reduce_device_prefixes = build_all_reduce_device_prefixes(
         job_name, num_workers)
     self._num_workers = num_workers
+    self._bucket_bytes = bucket_bytes
+    # Only worth packing when gradients leave the task.
+    self._wire_dtype = wire_dtype if num_workers > 1 else None
+    self._wire_bytes = None
     if not self._all_reduce_spec:
       raise ValueError('all_reduce_spec must be specified')
 
@@ -732,6 +750,27 @@ class VariableMgrDistributedAllReduce(VariableMgr):
     return tf.variable_scope('v%s' % device_num)
 
   def preprocess_device_grads(self, device_grads):
+    full_device_set = []
+    for grads in device_grads:
+      g, v = grads[0]
+      del v
+      full_device_set.append(g.device)
+
+    loss_scale = self.benchmark_cnn.loss_scale
+    if self._wire_dtype:
+      # Every gradient is summed over all towers, the sum must still fit.
+      num_summands = len(device_grads)
+      packed_device_grads = []
+      for grads in device_grads:
+        with tf.device(grads[0][0].device):
+          packed_device_grads.append(
+              [(pack_gradient(g, self._wire_dtype, loss_scale, num_summands),
+                v) for g, v in grads])
+      device_grads = packed_device_grads
+    self._wire_bytes = int(
+        2. * (self._num_workers - 1) / self._num_workers *
+        sum(gradient_bytes(g) for g, _ in device_grads[0]))
+
     remaining_grads = device_grads
     aggregated_grads = []
     for spec_tuple in self._all_reduce_spec:
@@ -742,9 +781,16 @@ class VariableMgrDistributedAllReduce(VariableMgr):
         (this_grads, remaining_grads) = split_grads_by_size(
             spec_tuple.limit, remaining_grads)
       if this_grads:
-        range_agg_grads = sum_gradients_all_reduce(
-            self._all_reduce_device_prefixes, this_grads, self._num_workers,
-            spec_tuple.alg, spec_tuple.shards, self.benchmark_cnn.gpu_indices)
+        sum_fn = functools.partial(
+            sum_gradients_all_reduce, self._all_reduce_device_prefixes,
+            num_workers=self._num_workers, alg=spec_tuple.alg,
+            num_shards=spec_tuple.shards,
+            gpu_indices=self.benchmark_cnn.gpu_indices)
+        if self._bucket_bytes > 0:
+          range_agg_grads = sum_gradients_in_buckets(
+              this_grads, self._bucket_bytes, sum_fn)
+        else:
+          range_agg_grads = sum_fn(this_grads)
         if not aggregated_grads:
           aggregated_grads = range_agg_grads
         else:
@@ -752,11 +798,14 @@ class VariableMgrDistributedAllReduce(VariableMgr):
           for i in range(len(aggregated_grads)):
             aggregated_grads[i] += range_agg_grads[i]
     assert not remaining_grads
-    full_device_set = []
-    for grads in device_grads:
-      g, v = grads[0]
-      del v
-      full_device_set.append(g.device)
+    if self._wire_dtype:
+      unpacked_grads = []
+      for device, grads in zip(full_device_set, aggregated_grads):
+        with tf.device(device):
+          unpacked_grads.append(
+              [(unpack_gradient(g, loss_scale, v.dtype.base_dtype), v)
+               for g, v in grads])
+      aggregated_grads = unpacked_grads
     return (full_device_set, aggregated_grads)
 
   def get_gradients_to_apply(self, device_num, gradient_state):
@@ -766,6 +815,10 @@ class VariableMgrDistributedAllReduce(VariableMgr):
                        (device_num, len(device_grads)))
     return device_grads[device_num]
 
+  def get_wire_bytes_per_step(self):
+    """Bytes sent by bandwidth optimal all-reduce, ie ring, between tasks."""
+    return self._wire_bytes
+
   def get_post_init_ops(self):
     """Copy initialized values for variables to other devices."""
     global_vars = tf.global_variables()
@@ -867,6 +920,11 @@ class VariableMgrDistributedReplicated(VariableMgr):
      all-reduce for replicating within a server.
   """
 
+  def __init__(self, benchmark_cnn, wire_dtype=None):
+    super(VariableMgrDistributedReplicated, self).__init__(benchmark_cnn)
+    self._wire_dtype = wire_dtype
+    self._wire_bytes = None
+
   def each_tower_has_variables(self):
     return True
 
@@ -886,15 +944,30 @@ class VariableMgrDistributedReplicated(VariableMgr):
 
     # Make shadow variable on a parameter server for each original trainable
     # variable.
+    loss_scale = self.benchmark_cnn.loss_scale
+    self._wire_bytes = 0
     for i, (g, v) in enumerate(avg_grads):
       my_name = PS_SHADOW_VAR_PREFIX + '/' + v.name
       if my_name.endswith(':0'): my_name = my_name[:-2]
       new_v = tf.get_variable(my_name, dtype=v.dtype.base_dtype,
                               initializer=v.initial_value,
                               trainable=True)
+      if self._wire_dtype:
+        # Pack on this worker, unpack on the parameter server.
+        with tf.device(g.device):
+          g = pack_gradient(g, self._wire_dtype, loss_scale, 1)
+        with tf.device(new_v.device):
+          g = unpack_gradient(g, loss_scale, new_v.dtype.base_dtype)
+        self._wire_bytes += gradient_bytes(g, self._wire_dtype)
+      else:
+        self._wire_bytes += gradient_bytes(g)
       avg_grads[i] = (g, new_v)
     return avg_grads
 
+  def get_wire_bytes_per_step(self):
+    """Bytes of gradients sent to parameter servers."""
+    return self._wire_bytes
+
   def append_apply_gradients_ops(self, gradient_state, opt,
                                  grads, training_ops):
     device_grads = gradient_state  # From 2nd result of preprocess_device_grads.
@@ -971,6 +1044,47 @@ class VariableMgrDistributedReplicated(VariableMgr):
     return self.benchmark_cnn.raw_devices
 
 
+# Largest finite values of dtypes gradients can be packed into.
+_WIRE_DTYPE_MAX = {
+    tf.float16: 65504.,
+    tf.bfloat16: 3.3895e38,
+}
+
+
+def gradient_bytes(grad, dtype=None):
+  """Returns size of grad in bytes, as dtype if given."""
+  return grad.get_shape().num_elements() * (dtype or grad.dtype).size
+
+
+def pack_gradient(grad, wire_dtype, loss_scale, num_summands):
+  """Cast gradient to half precision for sending to other tasks.
+
+  Args:
+    grad: fp32 gradient, already divided by the loss scale.
+    wire_dtype: tf.float16 or tf.bfloat16.
+    loss_scale: the gradient is multiplied by this again before the cast, so
+      small values don't underflow in fp16.
+    num_summands: number of packed gradients added together before unpacking.
+      Values are clamped so that their sum stays finite in wire_dtype.
+
+  Returns:
+    the packed gradient.
+  """
+  if loss_scale != 1.:
+    grad *= loss_scale
+  max_value = _WIRE_DTYPE_MAX[wire_dtype] / num_summands
+  grad = tf.clip_by_value(grad, -max_value, max_value)
+  return tf.cast(grad, wire_dtype)
+
+
+def unpack_gradient(grad, loss_scale, dtype=tf.float32):
+  """Reverse pack_gradient."""
+  grad = tf.cast(grad, dtype)
+  if loss_scale != 1.:
+    grad *= 1. / loss_scale
+  return grad
+
+
 def split_grads_by_size(threshold_size, device_grads):
   """Break gradients into two sets according to tensor size.
 
@@ -1003,6 +1117,89 @@ def split_grads_by_size(threshold_size, device_grads):
   return small_grads, large_grads
 
 
+def group_grads_into_buckets(grads, bucket_bytes):
+  """Group gradients of a tower into buckets of about bucket_bytes.
+
+  Gradients are taken in reverse order of their variables, which is roughly
+  the order in which backprop computes them, so the first bucket is complete
+  while gradients of the first layers are still being computed.
+
+  Args:
+    grads: list of gradient tensors of a tower, in order of variables.
+    bucket_bytes: int, a bucket is closed when adding the next gradient would
+      exceed this size. Gradients larger than this get a bucket of their own.
+
+  Returns:
+    list of lists of indices into grads. Gradients in a bucket have the same
+      dtype.
+  """
+  buckets = []
+  bucket = []
+  size = 0
+  for i in reversed(range(len(grads))):
+    num_bytes = grads[i].get_shape().num_elements() * grads[i].dtype.size
+    if bucket and (size + num_bytes > bucket_bytes or
+                   grads[i].dtype != grads[bucket[0]].dtype):
+      buckets.append(bucket)
+      bucket = []
+      size = 0
+    bucket.append(i)
+    size += num_bytes
+  if bucket:
+    buckets.append(bucket)
+  return buckets
+
+
+def sum_gradients_in_buckets(device_grads, bucket_bytes, sum_fn):
+  """Sum gradients across towers, reducing fused buckets of gradients.
+
+  Gradients of each tower are flattened and concatenated into one buffer per
+  bucket, see group_grads_into_buckets, sum_fn reduces the buffers and the
+  results are split back into gradients. Each bucket only depends on its own
+  gradients, so its reduction overlaps with backprop of the earlier layers.
+  Packing of a bucket waits for packing of the previous bucket on the same
+  device, so buckets are issued in the same order on every device. All
+  buckets are passed to a single sum_fn call, so that it spreads them over
+  its aggregation devices like it does for separate gradients.
+
+  Args:
+    device_grads: List of lists of (gradient, variable) tuples. The outer list
+      is over towers, the inner list is over individual gradients.
+    bucket_bytes: int, size of a bucket.
+    sum_fn: function that takes device_grads and returns them summed across
+      towers, ie sum_gradients_all_reduce with all other args bound.
+
+  Returns:
+    list of lists of (summed gradient, variable), in the order of device_grads.
+  """
+  buckets = group_grads_into_buckets([g for g, _ in device_grads[0]],
+                                     bucket_bytes)
+  packed_grads = []
+  for grads in device_grads:
+    tower_packed = []
+    for b, bucket in enumerate(buckets):
+      bucket_grads = [grads[i][0] for i in bucket]
+      deps = [tower_packed[-1][0]] if tower_packed else []
+      with tf.device(bucket_grads[0].device), tf.control_dependencies(deps):
+        packed = tf.concat([tf.reshape(g, [-1]) for g in bucket_grads], 0,
+                           name='gradient_bucket_%d' % b)
+      tower_packed.append((packed, None))
+    packed_grads.append(tower_packed)
+  summed_packed = sum_fn(packed_grads)
+
+  summed = [[None] * len(grads) for grads in device_grads]
+  for t, tower_packed in enumerate(summed_packed):
+    for bucket, (packed, _) in zip(buckets, tower_packed):
+      sizes = [device_grads[0][i][0].get_shape().num_elements()
+               for i in bucket]
+      with tf.device(packed.device):
+        parts = tf.split(packed, sizes)
+        for i, part in zip(bucket, parts):
+          g, v = device_grads[t][i]
+          summed[t][i] = (tf.reshape(part, g.get_shape()), v)
+  return summed
+
+
 def sum_grad_and_var_all_reduce(grad_and_vars, num_workers, alg, gpu_indices,
                                 aux_devices=None, num_shards=1):
   """Apply all-reduce algorithm over specified gradient tensors."""
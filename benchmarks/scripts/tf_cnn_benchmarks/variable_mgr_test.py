@@ -0,0 +1,185 @@
+# Copyright 2017 The TensorFlow Authors. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+# ==============================================================================
+"""Tests for variable_mgr."""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+import tensorflow as tf
+
+import variable_mgr
+
+
+class _FakeBenchmarkCNN(object):
+  """Attributes of BenchmarkCNN used by the variable managers under test."""
+
+  def __init__(self, loss_scale=1., devices=None):
+    self.loss_scale = loss_scale
+    self.gpu_indices = [0]
+    self.devices = self.raw_devices = devices or ['/cpu:0']
+    self.local_parameter_device_flag = 'gpu'
+    self.param_server_device = '/cpu:0'
+
+
+class GradientWireTest(tf.test.TestCase):
+
+  def _round_trip(self, values, wire_dtype, loss_scale=1., num_summands=1,
+                  dtype=tf.float32):
+    grad = tf.constant(values, dtype=tf.float32)
+    packed = variable_mgr.pack_gradient(grad, wire_dtype, loss_scale,
+                                        num_summands)
+    self.assertEqual(wire_dtype, packed.dtype)
+    unpacked = variable_mgr.unpack_gradient(packed, loss_scale, dtype)
+    self.assertEqual(dtype, unpacked.dtype)
+    with self.test_session() as sess:
+      return sess.run(unpacked)
+
+  def testFloat16RoundTrip(self):
+    values = [0., 1e-3, -1.5, 3000., -60000., 65504.]
+    self.assertAllClose(values, self._round_trip(values, tf.float16),
+                        rtol=1e-3)
+
+  def testFloat16ClampsToRange(self):
+    result = self._round_trip([1e6, -1e6, 70000.], tf.float16)
+    self.assertAllEqual([65504., -65504., 65504.], result)
+
+  def testFloat16ClampLeavesRoomForSum(self):
+    num_summands = 4
+    grads = [tf.constant([1e6, -1e6, 20000.]) for _ in range(num_summands)]
+    packed = [variable_mgr.pack_gradient(g, tf.float16, 1., num_summands)
+              for g in grads]
+    summed = variable_mgr.unpack_gradient(tf.add_n(packed), 1.)
+    with self.test_session() as sess:
+      result = sess.run(summed)
+    self.assertTrue(np.all(np.isfinite(result)))
+    # values are clamped to 65504 / 4 before the sum
+    self.assertAllClose([65504., -65504., 65504.], result, rtol=1e-3)
+
+  def testFloat16LossScaleAvoidsUnderflow(self):
+    values = [1e-8, -2e-8]
+    self.assertAllEqual([0., 0.], self._round_trip(values, tf.float16))
+    self.assertAllClose(values,
+                        self._round_trip(values, tf.float16, loss_scale=1024.),
+                        rtol=1e-2)
+
+  def testBfloat16KeepsFloat32Range(self):
+    values = [1e-30, -1e30, 1.5]
+    self.assertAllClose(values, self._round_trip(values, tf.bfloat16),
+                        rtol=1e-2)
+
+  def testUnpackDtype(self):
+    values = [0.5, -2.]
+    self.assertAllEqual(
+        values, self._round_trip(values, tf.float16, dtype=tf.float16))
+    self.assertAllEqual(
+        values, self._round_trip(values, tf.bfloat16, dtype=tf.float64))
+
+  def testGradientBytes(self):
+    grad = tf.zeros([3, 5])
+    self.assertEqual(60, variable_mgr.gradient_bytes(grad))
+    self.assertEqual(30, variable_mgr.gradient_bytes(grad, tf.float16))
+
+  def _wire_bytes_per_step(self, num_workers, wire_dtype):
+    mgr = variable_mgr.VariableMgrDistributedAllReduce(
+        _FakeBenchmarkCNN(), 'pscpu', 'worker', num_workers,
+        wire_dtype=wire_dtype)
+    device_grads = []
+    for task in range(num_workers):
+      device = '/job:worker/task:%d/cpu:0' % task
+      with tf.device(device), tf.variable_scope('v%d' % task):
+        v0 = tf.get_variable('v0', [10, 10])
+        v1 = tf.get_variable('v1', [25])
+        device_grads.append([(tf.ones([10, 10]), v0), (tf.ones([25]), v1)])
+    mgr.preprocess_device_grads(device_grads)
+    return mgr.get_wire_bytes_per_step()
+
+  def testWireBytesPerStep(self):
+    # ring all-reduce sends 2 * (W - 1) / W of the gradient bytes
+    with tf.Graph().as_default():
+      self.assertEqual(int(2. * 3 / 4 * 125 * 4),
+                       self._wire_bytes_per_step(4, None))
+    with tf.Graph().as_default():
+      self.assertEqual(int(2. * 3 / 4 * 125 * 2),
+                       self._wire_bytes_per_step(4, tf.float16))
+    with tf.Graph().as_default():
+      self.assertEqual(0, self._wire_bytes_per_step(1, tf.float16))
+
+
+class GradientBucketTest(tf.test.TestCase):
+
+  _NUM_DEVICES = 3
+  _SHAPES = [[3, 3], [100], [5], [2000], [7, 2]]
+
+  def _device_grads(self):
+    devices = ['/cpu:%d' % i for i in range(self._NUM_DEVICES)]
+    device_grads = []
+    for t, device in enumerate(devices):
+      with tf.device(device):
+        device_grads.append(
+            [(tf.random_uniform(shape, seed=t * 10 + i), None)
+             for i, shape in enumerate(self._SHAPES)])
+    return devices, device_grads
+
+  def _session(self):
+    config = tf.ConfigProto(device_count={'CPU': self._NUM_DEVICES})
+    return self.test_session(config=config)
+
+  def testGroupGradsIntoBuckets(self):
+    grads = [tf.zeros(shape) for shape in self._SHAPES]
+    # 4 bytes per element, taken from the last gradient
+    self.assertEqual([[4], [3], [2, 1, 0]],
+                     variable_mgr.group_grads_into_buckets(grads, 512))
+
+  def testBucketsMatchSeparateReduction(self):
+    devices, device_grads = self._device_grads()
+    for bucket_bytes in [0, 512]:
+      mgr = variable_mgr.VariableMgrLocalReplicated(
+          _FakeBenchmarkCNN(devices=devices), None, bucket_bytes=bucket_bytes)
+      _, summed = mgr.preprocess_device_grads(device_grads)
+      if bucket_bytes:
+        bucketed = summed
+      else:
+        separate = summed
+    with self._session() as sess:
+      bucketed_values, separate_values = sess.run(
+          [[[g for g, _ in grads] for grads in bucketed],
+           [[g for g, _ in grads] for grads in separate]])
+    for bucketed_grads, separate_grads in zip(bucketed_values,
+                                              separate_values):
+      for bucketed_grad, separate_grad, shape in zip(
+          bucketed_grads, separate_grads, self._SHAPES):
+        self.assertEqual(tuple(shape), bucketed_grad.shape)
+        self.assertAllClose(separate_grad, bucketed_grad)
+
+  def testBucketsRotateAggregationDevices(self):
+    devices, device_grads = self._device_grads()
+    summed_devices = []
+    def sum_fn(packed_grads):
+      aggregate = (
+          variable_mgr.aggregate_gradients_using_copy_with_device_selection)
+      summed = aggregate(_FakeBenchmarkCNN(devices=devices), packed_grads,
+                         use_mean=False)
+      summed_devices.extend(g.device for g, _ in summed)
+      return [[(g, v) for (_, v), (g, _) in zip(grads, summed)]
+              for grads in packed_grads]
+    variable_mgr.sum_gradients_in_buckets(device_grads, 512, sum_fn)
+    self.assertEqual(3, len(summed_devices))
+    self.assertEqual(3, len(set(summed_devices)))
+
+
+if __name__ == '__main__':
+  tf.test.main()
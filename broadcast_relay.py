@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Forwards a file along a chain of tasks, used by backend.Job.upload with
+# broadcast=True, which uploads this script to the tasks.
+#
+# Client uploads file to task 0 only. Task 0 streams it to task 1, which
+# writes it to disk while streaming it further to task 2, and so on, so the
+# file is pipelined through the chain over private network and client
+# upload cost doesn't grow with number of tasks. Every task checks SHA1 of
+# the data against the checksum computed by the client.
+#
+# task 0:  python broadcast_relay.py model.bin --sha1=... --next=10.0.0.2:6100
+# task 1:  python broadcast_relay.py model.bin --sha1=... --listen-port=6100 \
+#            --next=10.0.0.3:6100
+#
+# Only uses standard library since it runs on the instance.
+
+import argparse
+import hashlib
+import os
+import socket
+import sys
+import time
+
+CHUNK_BYTES=1<<20
+CONNECT_TIMEOUT_SEC=600     # how long to wait for next task to start listening
+
+parser = argparse.ArgumentParser(description='chained file broadcast')
+parser.add_argument('fn', type=str,
+                    help='file to send, or to receive into if --listen-port')
+parser.add_argument('--sha1', type=str, required=True,
+                    help='expected SHA1 of the file')
+parser.add_argument('--listen-port', type=int, default=0,
+                    help='receive file on this port instead of reading it')
+parser.add_argument('--next', type=str, default='',
+                    help='host:port of next task in the chain')
+
+
+def connect(address):
+  host, port = address.rsplit(':', 1)
+  start_time = time.time()
+  while True:
+    try:
+      return socket.create_connection((host, int(port)))
+    except socket.error:
+      if time.time() - start_time > CONNECT_TIMEOUT_SEC:
+        raise
+      time.sleep(0.1)
+
+
+def receive_from(port):
+  """Returns socket of the previous task in the chain."""
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  server.bind(('', port))
+  server.listen(1)
+  server.settimeout(CONNECT_TIMEOUT_SEC)
+  sock, _ = server.accept()
+  server.close()
+  sock.settimeout(None)
+  return sock
+
+
+def main():
+  args = parser.parse_args()
+  next_sock = connect(args.next) if args.next else None
+  if args.listen_port:
+    source = receive_from(args.listen_port).makefile('rb')
+    out_fn = args.fn+'.broadcast'
+    out = open(out_fn, 'wb')
+  else:
+    source = open(args.fn, 'rb')
+    out = None
+
+  start_time = time.time()
+  sha1 = hashlib.sha1()
+  num_bytes = 0
+  while True:
+    chunk = source.read(CHUNK_BYTES)
+    if not chunk:
+      break
+    sha1.update(chunk)
+    num_bytes+=len(chunk)
+    if out:
+      out.write(chunk)
+    if next_sock:
+      next_sock.sendall(chunk)
+  source.close()
+  if next_sock:
+    next_sock.close()
+
+  if sha1.hexdigest() != args.sha1:
+    if out:
+      out.close()
+      os.remove(out_fn)
+    print("Checksum mismatch for %s, got %s, expected %s"%(
+      args.fn, sha1.hexdigest(), args.sha1))
+    sys.exit(1)
+  if out:
+    out.close()
+    os.rename(out_fn, args.fn)
+  elapsed = time.time() - start_time
+  print("Relayed %d bytes of %s in %.1f sec, %.1f MB/s"%(
+    num_bytes, args.fn, elapsed, num_bytes/1e6/max(elapsed, 1e-6)))
+
+
+if __name__=='__main__':
+  main()
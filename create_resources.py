@@ -275,6 +275,9 @@ def create_resources():
     else:
       print("Giving up.")
 
+  # resources created above must be visible to later lookups
+  u.invalidate_aws_cache()
+
 if __name__=='__main__':
   print("Call create_resources_main.py instead")
 
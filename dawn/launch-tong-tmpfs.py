@@ -67,8 +67,8 @@ def main():
   # mount tmpfs
   job.run('mkdir -p /tmpfs')
   job.run('sudo mount -t tmpfs -o size=200g tmpfs /tmpfs')
-  job.run('mkdir /tmpfs/data')
-  job.run('time cp -R ~/data/imagenet /tmpfs/data/imagenet')
+  job.run('mkdir -p /tmpfs/data')
+  job.stage_dataset('~/data/imagenet', '/tmpfs/data/imagenet')
 
   job.run_async('python resnet.b512.baseline.py --data /tmpfs/data/imagenet --logdir=%s'%(logdir,))
 
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # Tools for EFS related tasks
 import boto3
+import concurrent.futures
 import sys
 import os
 
@@ -14,36 +15,53 @@ def list_efss():
     print(region)
     print('='*80)
     efs_client = boto3.client('efs', region_name=region)
-    response = efs_client.describe_file_systems()
-    assert u.is_good_response(response)
+    ec2_client = boto3.client('ec2', region_name=region)
+    file_systems = u.describe_all(efs_client, 'describe_file_systems',
+                                  'FileSystems')
+    #  {'CreationTime': datetime.datetime(2017, 12, 19, 10, 3, 44, tzinfo=tzlocal()),
+    # 'CreationToken': '1513706624330134',
+    # 'Encrypted': False,
+    # 'FileSystemId': 'fs-0f95ab46',
+    # 'LifeCycleState': 'available',
+    # 'Name': 'nexus01',
+    # 'NumberOfMountTargets': 0,
+    # 'OwnerId': '316880547378',
+    # 'PerformanceMode': 'generalPurpose',
+    # 'SizeInBytes': {'Value': 6144}},
 
-    for efs_response in response['FileSystems']:
-      #  {'CreationTime': datetime.datetime(2017, 12, 19, 10, 3, 44, tzinfo=tzlocal()),
-      # 'CreationToken': '1513706624330134',
-      # 'Encrypted': False,
-      # 'FileSystemId': 'fs-0f95ab46',
-      # 'LifeCycleState': 'available',
-      # 'Name': 'nexus01',
-      # 'NumberOfMountTargets': 0,
-      # 'OwnerId': '316880547378',
-      # 'PerformanceMode': 'generalPurpose',
-      # 'SizeInBytes': {'Value': 6144}},
+    # fetch tags and mount targets of all file systems concurrently
+    def get_mount_targets(efs_response):
+      response = efs_client.describe_mount_targets(
+        FileSystemId=efs_response['FileSystemId'])
+      assert u.is_good_response(response)
+      return response['MountTargets']
+
+    tags_list = u.get_efs_tags_list(efs_client, file_systems)
+    mount_targets_list = []
+    if file_systems:
+      with concurrent.futures.ThreadPoolExecutor(
+          min(len(file_systems), u.MAX_CONCURRENCY)) as executor:
+        mount_targets_list = list(executor.map(get_mount_targets,
+                                               file_systems))
+
+    # resolve zones of all subnets in one call
+    subnet_ids = [mount_response['SubnetId'] for mount_targets in
+                  mount_targets_list for mount_response in mount_targets]
+    subnet_zones = u.get_subnet_zones(subnet_ids, ec2_client)
+
+    for efs_response, tags, mount_targets in zip(file_systems, tags_list,
+                                                 mount_targets_list):
       efs_id = efs_response['FileSystemId']
-      tags_response = efs_client.describe_tags(FileSystemId=efs_id)
-      assert u.is_good_response(tags_response)
-      key = u.get_name(tags_response.get('Tags', ''))
+      key = u.get_name(tags)
       print("%-16s %-16s" %(efs_id, key))
       print('-'*40)
 
       # list mount points
-      response = efs_client.describe_mount_targets(FileSystemId=efs_id)
-      ec2 = boto3.resource('ec2', region_name=region)
-      if not response['MountTargets']:
+      if not mount_targets:
         print("<no mount targets>")
       else:
-       for mount_response in response['MountTargets']:
-         subnet = ec2.Subnet(mount_response['SubnetId'])
-         zone = subnet.availability_zone
+       for mount_response in mount_targets:
+         zone = subnet_zones[mount_response['SubnetId']]
          state = mount_response['LifeCycleState']
          id = mount_response['MountTargetId']
          ip = mount_response['IpAddress']
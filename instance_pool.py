@@ -0,0 +1,163 @@
+# Warm pool of stopped instances that already ran their install script.
+#
+# Job.release stops the instances of a job instead of terminating them and
+# tags them with pool key, a hash of (ami, instance_type, zone, placement
+# group, install script). Run.make_job restarts and renames matching pooled
+# instances before launching new ones, so their boot is a restart of an
+# instance that already has the AMI on disk and ran the install script.
+# Install steps completed before the restart are skipped, except for steps
+# whose effects don't survive reboot, like mounts, see
+# aws_backend.INSTALL_STEPS_DIR.
+#
+# Pool membership lives in EC2 tags, so it's shared between all clients of the
+# account. Pool is bounded by MAX_POOL_SIZE and MAX_IDLE_SEC, least recently
+# released instances get terminated first.
+#
+# Clients acquiring at the same time claim instances by writing a unique token
+# into POOL_CLAIM_TAG, and only restart instances that still carry their
+# token after CLAIM_SETTLE_SEC. Tag reads are eventually consistent, so this
+# relies on tag writes becoming visible within CLAIM_SETTLE_SEC.
+
+import hashlib
+import time
+import uuid
+
+import util as u
+
+MAX_POOL_SIZE=16             # max number of stopped instances in pool
+MAX_IDLE_SEC=3*24*3600       # pooled instances older than this get terminated
+POOL_KEY_TAG='pool-key'
+POOL_RELEASED_TAG='pool-released'
+POOL_CLAIM_TAG='pool-claim'
+CLAIM_SETTLE_SEC=2           # wait for concurrent claims before checking ours
+
+
+def get_pool_name():
+  """Name tag of pooled instances."""
+  return 'pool.'+u.get_resource_name()
+
+
+def make_pool_key(ami, instance_type, availability_zone, install_script='',
+                  placement_group=''):
+  """Returns key of instances that are interchangeable for a job."""
+  script_hash = hashlib.sha1(install_script.encode()).hexdigest()
+  key = '|'.join([ami, instance_type, availability_zone, placement_group,
+                  script_hash])
+  return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def _get_tag(instance, key):
+  for tag in instance.tags or []:
+    if tag['Key'] == key:
+      return tag['Value']
+  return ''
+
+
+def _released_time(instance):
+  try:
+    return float(_get_tag(instance, POOL_RELEASED_TAG))
+  except ValueError:
+    return 0
+
+
+def list_pool(pool_key=None):
+  """Returns pooled instances, most recently released first. If pool_key is
+  given, only instances with that key."""
+  ec2 = u.create_ec2_resource()
+  filters = [{'Name': 'instance-state-name', 'Values': ['stopping', 'stopped']},
+             {'Name': 'tag:Name', 'Values': [get_pool_name()]}]
+  if pool_key:
+    filters.append({'Name': 'tag:'+POOL_KEY_TAG, 'Values': [pool_key]})
+  instances = list(ec2.instances.filter(Filters=filters))
+  return sorted(instances, key=_released_time, reverse=True)
+
+
+def acquire(pool_key, task_names, tracer=None):
+  """Restarts up to len(task_names) pooled instances with given key, and
+  renames them to given task names. Returns list of restarted instances, in
+  order of task_names. Restarts are recorded in tracer, u.tracer by default.
+
+  Instances are claimed with a token unique to this call before restart,
+  instances claimed by a concurrent acquire are skipped, so fewer than
+  len(task_names) instances may be returned."""
+  if not task_names:
+    return []
+  # stopping instances can't be started yet
+  candidates = [instance for instance in list_pool(pool_key)
+                if instance.state['Name'] == 'stopped' and
+                not _get_tag(instance, POOL_CLAIM_TAG)][:len(task_names)]
+  if not candidates:
+    return []
+  ec2_client = u.create_ec2_client()
+  token = uuid.uuid4().hex
+  ec2_client.create_tags(Resources=[instance.id for instance in candidates],
+                         Tags=[{'Key': POOL_CLAIM_TAG, 'Value': token}])
+  time.sleep(CLAIM_SETTLE_SEC)
+  claimed = []
+  for instance in candidates:
+    instance.reload()
+    if _get_tag(instance, POOL_CLAIM_TAG) == token:
+      claimed.append(instance)
+    else:
+      print("Pooled instance %s was claimed by another client"%(instance.id,))
+
+  tracer = tracer or u.tracer
+  result = []
+  for instance in claimed:
+    task_name = task_names[len(result)]
+    with tracer.span('pool_acquire', task=task_name):
+      ec2_client.create_tags(Resources=[instance.id],
+                             Tags=u.make_name(task_name))
+      ec2_client.delete_tags(Resources=[instance.id],
+                             Tags=[{'Key': POOL_KEY_TAG},
+                                   {'Key': POOL_RELEASED_TAG},
+                                   {'Key': POOL_CLAIM_TAG}])
+      try:
+        instance.start()
+      except Exception as e:   # ie, InsufficientInstanceCapacity
+        print("Couldn't restart pooled instance %s (%s), terminating it"%(
+          instance.id, e))
+        instance.terminate()
+        continue
+    instance.reload()
+    result.append(instance)
+  return result
+
+
+def release(instances, pool_key):
+  """Stops instances and adds them to the pool under given key, then evicts
+  instances above pool limits."""
+  ec2_client = u.create_ec2_client()
+  for instance in instances:
+    ec2_client.delete_tags(Resources=[instance.id],
+                           Tags=[{'Key': POOL_CLAIM_TAG}])
+    ec2_client.create_tags(Resources=[instance.id],
+                           Tags=u.make_name(get_pool_name()) +
+                           [{'Key': POOL_KEY_TAG, 'Value': pool_key},
+                            {'Key': POOL_RELEASED_TAG,
+                             'Value': '%d'%(time.time(),)}])
+    try:
+      instance.stop()
+    except Exception as e:  # instance store backed instances can't be stopped
+      print("Couldn't stop %s (%s), terminating it"%(instance.id, e))
+      instance.terminate()
+  evict()
+
+
+def evict(max_size=MAX_POOL_SIZE, max_idle_sec=MAX_IDLE_SEC):
+  """Terminates pooled instances idle for longer than max_idle_sec, and least
+  recently released instances above max_size. Returns terminated instances."""
+  evicted = []
+  kept = []
+  for instance in list_pool():
+    if time.time() - _released_time(instance) > max_idle_sec:
+      evicted.append(instance)
+    elif len(kept) >= max_size:
+      evicted.append(instance)
+    else:
+      kept.append(instance)
+
+  for instance in evicted:
+    print("Evicting %s from instance pool"%(instance.id,))
+    instance.terminate()
+  return evicted
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# Benchmarks for hot paths of the job launcher itself.
+#
+# tmux_backend benchmarks run locally:
+# python launcher_benchmark.py --backend=tmux
+#
+# aws_backend benchmarks run against any SSH server standing in for an EC2
+# instance, ie sshd on localhost, EFS mounting is skipped:
+# python launcher_benchmark.py --backend=aws --ssh-host=127.0.0.1 \
+#   --ssh-user=$USER --ssh-key=~/.ssh/id_rsa
+#
+# API calls per make_job use boto3 with stubbed responses, no AWS account
+# needed:
+# python launcher_benchmark.py --backend=api
+#
+# Results are appended to --results-fn as one JSON record per run, so
+# regressions show up when comparing records.
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+parser = argparse.ArgumentParser(description='launcher benchmarks')
+parser.add_argument('--backend', type=str, default='tmux',
+                    help='tmux, aws or api')
+parser.add_argument('--name', type=str, default='launcherbench',
+                    help="name of the run used for benchmark jobs")
+parser.add_argument('--num-commands', type=int, default=100,
+                    help='number of sync commands for commands/sec')
+parser.add_argument('--big-file-mb', type=int, default=64,
+                    help='size of file for large file transfer benchmark')
+parser.add_argument('--num-small-files', type=int, default=1000,
+                    help='number of files for small file transfer benchmark')
+parser.add_argument('--small-file-kb', type=int, default=4,
+                    help='size of each small file')
+parser.add_argument('--num-tasks', type=int, default=4,
+                    help='number of tasks for job bring-up benchmark')
+parser.add_argument('--ssh-host', type=str, default='127.0.0.1',
+                    help='SSH server standing in for EC2 instances')
+parser.add_argument('--ssh-user', type=str, default=os.environ.get('USER', ''),
+                    help='username on SSH server')
+parser.add_argument('--ssh-key', type=str, default='~/.ssh/id_rsa',
+                    help='private RSA key for SSH server')
+parser.add_argument('--results-fn', type=str,
+                    default='/tmp/launcher_benchmark.json',
+                    help='file to append JSON results to')
+args = parser.parse_args()
+
+# region is needed by util, stubbed API benchmark doesn't talk to AWS
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-west-2')
+
+module_path=os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, module_path)
+import util as u
+
+
+def make_test_files(workdir):
+  """Creates big file and directory of small files, returns their names."""
+  big_fn = workdir+'/big.bin'
+  with open(big_fn, 'wb') as f:
+    for i in range(args.big_file_mb):
+      f.write(os.urandom(1<<20))
+
+  small_dir = workdir+'/small'
+  os.mkdir(small_dir)
+  for i in range(args.num_small_files):
+    subdir = '%s/%02d'%(small_dir, i%100)
+    if not os.path.exists(subdir):
+      os.mkdir(subdir)
+    with open('%s/%d.txt'%(subdir, i), 'wb') as f:
+      f.write(os.urandom(args.small_file_kb<<10))
+  return big_fn, small_dir
+
+
+def dir_size(dirname):
+  return sum(os.path.getsize(os.path.join(root, fn))
+             for root, dirs, files in os.walk(dirname) for fn in files)
+
+
+def benchmark_task(task, workdir):
+  """Runs per-task benchmarks, returns dictionary of results."""
+  results = {}
+
+  start_time = time.time()
+  for i in range(args.num_commands):
+    task.run('true')
+  results['sync_commands_per_sec'] = args.num_commands/(time.time()-start_time)
+
+  big_fn, small_dir = make_test_files(workdir)
+  big_mb = os.path.getsize(big_fn)/1e6
+  small_mb = dir_size(small_dir)/1e6
+
+  start_time = time.time()
+  task.upload(big_fn, 'bench_big.bin')
+  results['upload_big_file_mb_per_sec'] = big_mb/(time.time()-start_time)
+
+  start_time = time.time()
+  task.download('bench_big.bin', workdir+'/big.downloaded')
+  results['download_big_file_mb_per_sec'] = big_mb/(time.time()-start_time)
+
+  start_time = time.time()
+  task.upload(small_dir, 'bench_small')
+  results['upload_small_files_mb_per_sec'] = small_mb/(time.time()-start_time)
+  results['upload_small_files_per_sec'] = (args.num_small_files/
+                                           (time.time()-start_time))
+
+  start_time = time.time()
+  task.download('bench_small', workdir+'/small.downloaded')
+  results['download_small_files_mb_per_sec'] = small_mb/(time.time()-
+                                                         start_time)
+  task.run('rm -Rf bench_big.bin bench_small')
+  return results
+
+
+def benchmark_tmux(workdir):
+  import tmux_backend
+  run = tmux_backend.make_run(args.name, install_script='')
+
+  results = {}
+  start_time = time.time()
+  job = run.make_job('bringup', num_tasks=args.num_tasks)
+  job.wait_until_ready()
+  results['bringup_sec'] = time.time()-start_time
+
+  job = run.make_job('single', num_tasks=1)
+  results.update(benchmark_task(job.tasks[0], workdir))
+
+  for job_name in ['bringup', 'single']:
+    os.system('tmux kill-session -t %s-%s'%(args.name, job_name))
+  return results
+
+
+class LocalInstance:
+  """Stands in for boto3 EC2 instance, points at --ssh-host."""
+
+  def __init__(self, launch_index):
+    self.id = 'i-local%d'%(launch_index,)
+    self.ami_launch_index = launch_index
+    self.public_ip_address = args.ssh_host
+    self.private_ip_address = args.ssh_host
+
+  def load(self):
+    pass
+
+  def wait_until_running(self, **kwargs):
+    pass
+
+
+def make_local_ssh_job(run, role_name, num_tasks):
+  import aws_backend
+  instances = [LocalInstance(i) for i in range(num_tasks)]
+  job = aws_backend.Job(run, u.format_job_name(role_name, run.name),
+                        instances=instances, install_script='echo ok',
+                        linux_type='ubuntu')
+  for task in job.tasks:
+    task.username = args.ssh_user
+    task.keypair_fn = os.path.expanduser(args.ssh_key)
+    task.taskdir = os.path.expanduser('~'+args.ssh_user)
+    # all tasks share one host, so give each one its own scratch and session
+    task.remote_scratch = '/tmp/tmux.%s.%d'%(job.name, task.id)
+    task.tmux_session = 'bench.%s.%d'%(job.name.replace('.', '-'), task.id)
+    task._mount_efs = lambda: None   # no EFS outside of AWS
+  return job
+
+
+def benchmark_aws(workdir):
+  import aws_backend
+  run = aws_backend.make_run(args.name)
+
+  results = {}
+  start_time = time.time()
+  job = make_local_ssh_job(run, 'bringup', args.num_tasks)
+  job.wait_until_ready()
+  results['bringup_sec'] = time.time()-start_time
+
+  job = make_local_ssh_job(run, 'single', 1)
+  job.wait_until_ready()
+  task = job.tasks[0]
+  results.update(benchmark_task(task, workdir))
+  results['ssh_channels_opened'] = task.ssh.channels_opened
+  results['sftp_sessions_opened'] = task.ssh.sftp_sessions_opened
+  return results
+
+
+# canned responses for operations called by aws_backend.Run.make_job
+STUB_RESPONSES = {
+  'DescribeInstances': {'Reservations': []},
+  'DescribeSecurityGroups': {'SecurityGroups': [
+    {'GroupId': 'sg-1', 'GroupName': 'nexus',
+     'Tags': [{'Key': 'Name', 'Value': 'nexus'}]}]},
+  'DescribeKeyPairs': {'KeyPairs': [{'KeyName': 'nexus-bench'}]},
+  'DescribeVpcs': {'Vpcs': [{'VpcId': 'vpc-1',
+                             'Tags': [{'Key': 'Name', 'Value': 'nexus'}]}]},
+  'DescribeSubnets': {'Subnets': [{'SubnetId': 'subnet-1', 'VpcId': 'vpc-1',
+                                   'AvailabilityZone': 'us-west-2a'}]},
+  'CreateTags': {},
+}
+
+def _stub_api_call(model, params, **kwargs):
+  """Answers every API call with canned response instead of calling AWS.
+  params is the serialized request."""
+  from botocore.awsrequest import AWSResponse
+
+  if model.name == 'RunInstances':
+    response = {'Instances': [{'InstanceId': 'i-%d'%(i,), 'AmiLaunchIndex': i}
+                              for i in range(int(params['body']['MaxCount']))]}
+  else:
+    assert model.name in STUB_RESPONSES, "No stub for "+model.name
+    response = dict(STUB_RESPONSES[model.name])
+  response['ResponseMetadata'] = {'HTTPStatusCode': 200}
+  return AWSResponse(None, 200, {}, None), response
+
+
+def benchmark_api():
+  """Counts AWS API calls made by make_job, using stubbed botocore."""
+  import boto3
+  import aws_backend
+
+  os.environ['USER'] = 'bench'   # keypair name is nexus-bench
+  boto3.setup_default_session(region_name=os.environ['AWS_DEFAULT_REGION'],
+                              aws_access_key_id='stub',
+                              aws_secret_access_key='stub')
+  # runs after u.api_call_counts handler, which is registered per client
+  boto3.DEFAULT_SESSION.events.register_last('before-call', _stub_api_call)
+
+  run = aws_backend.make_run(args.name, ami='ami-1', instance_type='c5.large',
+                             availability_zone='us-west-2a')
+  results = {}
+  for attempt in ['cold', 'warm']:
+    u.api_call_counts.clear()
+    start_time = time.time()
+    run.make_job('api'+attempt, num_tasks=args.num_tasks)
+    results['make_job_%s_sec'%(attempt,)] = time.time()-start_time
+    results['make_job_%s_api_calls'%(attempt,)] = sum(
+      u.api_call_counts.values())
+    results['make_job_%s_api_calls_by_operation'%(attempt,)] = dict(
+      u.api_call_counts)
+  return results
+
+
+def main():
+  workdir = tempfile.mkdtemp(prefix='launcher_benchmark.')
+  try:
+    if args.backend == 'tmux':
+      results = benchmark_tmux(workdir)
+    elif args.backend == 'aws':
+      results = benchmark_aws(workdir)
+    elif args.backend == 'api':
+      results = benchmark_api()
+    else:
+      assert False, "Unknown backend "+args.backend
+  finally:
+    shutil.rmtree(workdir)
+
+  record = {'timestamp': u.current_timestamp(), 'backend': args.backend,
+            'args': vars(args), 'results': results}
+  for key, value in sorted(results.items()):
+    if isinstance(value, float):
+      print("%-40s %10.2f"%(key, value))
+    else:
+      print("%-40s %10s"%(key, value))
+  with open(args.results_fn, 'a') as f:
+    f.write(json.dumps(record)+'\n')
+  print("Results appended to "+args.results_fn)
+
+
+if __name__=='__main__':
+  main()
@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+# Samples host metrics of a task into a tab-separated time series, started in
+# background on every task by backend.Task.start_metrics_agent.
+#
+# Reads CPU, memory, network and disk counters from /proc, and GPU
+# utilization, memory and throttling from nvidia-smi when present. One line
+# is appended per sample, so series can be compared to tell whether the job
+# is compute bound (cpu/gpu util high), network bound (net MB/s near link
+# rate) or input bound (low util, high disk read or iowait).
+#
+# python metrics_agent.py --logdir=/efs/runs/myrun --name=0.worker.myrun
+# python metrics_agent.py --summarize=/efs/runs/myrun/metrics/0.worker.myrun.tsv
+#
+# Only uses standard library since it runs on the instance. Columns that
+# can't be read on the current platform (no /proc on MacOS) are left empty.
+
+import argparse
+import os
+import shutil
+import subprocess
+import time
+
+parser = argparse.ArgumentParser(description='host metrics sampler')
+parser.add_argument('--logdir', type=str, default='.',
+                    help='series is written into logdir/metrics/name.tsv')
+parser.add_argument('--name', type=str, default='task',
+                    help='name of the series, ie task name')
+parser.add_argument('--interval-sec', type=float, default=5,
+                    help='time between samples')
+parser.add_argument('--parent-pid', type=int, default=0,
+                    help='exit when process with this pid exits')
+parser.add_argument('--summarize', type=str, default='',
+                    help='print mean and max of columns of given series and '
+                    'exit')
+
+CPU_COLUMNS=['cpu_user', 'cpu_system', 'cpu_iowait', 'cpu_idle']
+COLUMNS=(['time'] + CPU_COLUMNS +
+         ['load1', 'mem_used_mb', 'net_rx_mb_s', 'net_tx_mb_s',
+          'disk_read_mb_s', 'disk_write_mb_s'])
+GPU_COLUMNS=['gpu_util', 'gpu_mem_mb', 'gpu_throttled']
+
+
+def read_lines(fn):
+  try:
+    with open(fn) as f:
+      return f.read().strip().split('\n')
+  except IOError:
+    return []
+
+
+def read_counters():
+  """Returns dictionary of cumulative counters, missing keys are
+  unavailable."""
+  counters = {}
+  for line in read_lines('/proc/stat'):
+    toks = line.split()
+    if toks[0] == 'cpu':
+      user, nice, system, idle, iowait = [int(tok) for tok in toks[1:6]]
+      counters['cpu_user'] = user+nice
+      counters['cpu_system'] = sum(int(tok) for tok in toks[3:4]+toks[6:8])
+      counters['cpu_iowait'] = iowait
+      counters['cpu_idle'] = idle
+      break
+
+  rx = tx = None
+  for line in read_lines('/proc/net/dev')[2:]:
+    interface, values = line.split(':', 1)
+    if interface.strip() == 'lo':
+      continue
+    values = values.split()
+    rx = (rx or 0) + int(values[0])
+    tx = (tx or 0) + int(values[8])
+  if rx is not None:
+    counters['net_rx'] = rx
+    counters['net_tx'] = tx
+
+  # whole disks only, partitions would be counted twice
+  disks = set(os.listdir('/sys/block')) if os.path.isdir('/sys/block') else ()
+  disk_lines = read_lines('/proc/diskstats')
+  if disk_lines:
+    counters['disk_read'] = counters['disk_write'] = 0
+  for line in disk_lines:
+    toks = line.split()
+    if toks[2] in disks and not toks[2].startswith(('loop', 'ram')):
+      counters['disk_read']+=int(toks[5])*512
+      counters['disk_write']+=int(toks[9])*512
+  return counters
+
+
+def read_memory_mb():
+  meminfo = {}
+  for line in read_lines('/proc/meminfo'):
+    key, value = line.split(':', 1)
+    meminfo[key] = int(value.split()[0])
+  if 'MemTotal' not in meminfo or 'MemAvailable' not in meminfo:
+    return None
+  return (meminfo['MemTotal'] - meminfo['MemAvailable'])/1024.
+
+
+def read_gpus():
+  """Returns list of (util %, memory MB, throttled) for each GPU."""
+  try:
+    output = subprocess.check_output(
+      ['nvidia-smi', '--query-gpu=utilization.gpu,memory.used,'
+       'clocks_throttle_reasons.hw_slowdown', '--format=csv,noheader,nounits'])
+  except (OSError, subprocess.CalledProcessError):
+    return []
+  result = []
+  for line in output.decode().strip().split('\n'):
+    util, memory, slowdown = [tok.strip() for tok in line.split(',')]
+    result.append((float(util), float(memory), int(slowdown == 'Active')))
+  return result
+
+
+def make_sample(previous, current, elapsed, memory_mb, gpus):
+  """Returns list of column values for period between two counter
+  readings."""
+  row = ['%.1f'%(time.time(),)]
+  cpu_total = sum(current.get(key, 0)-previous.get(key, 0)
+                  for key in CPU_COLUMNS)
+  for key in CPU_COLUMNS:
+    if key in current and cpu_total:
+      row.append('%.1f'%(100.*(current[key]-previous[key])/cpu_total,))
+    else:
+      row.append('')
+  row.append('%.2f'%(os.getloadavg()[0],))
+  row.append('%.0f'%(memory_mb,) if memory_mb is not None else '')
+  for key in ['net_rx', 'net_tx', 'disk_read', 'disk_write']:
+    if key in current:
+      row.append('%.2f'%((current[key]-previous[key])/1e6/elapsed,))
+    else:
+      row.append('')
+  for gpu in gpus:
+    if gpu is None:   # nvidia-smi failed for this sample
+      row.extend(['']*len(GPU_COLUMNS))
+    else:
+      row.extend(['%.0f'%(gpu[0],), '%.0f'%(gpu[1],), '%d'%(gpu[2],)])
+  return row
+
+
+def open_series(logdir, name):
+  """Opens series file in logdir/metrics, falling back to current directory
+  if logdir isn't writable (ie, no /efs on laptop)."""
+  for dirname in [logdir+'/metrics', 'metrics']:
+    try:
+      os.makedirs(dirname, exist_ok=True)
+      return open('%s/%s.tsv'%(dirname, name), 'a', buffering=1)
+    except OSError as e:
+      print("Can't write metrics into %s: %s"%(dirname, e))
+  assert False, "No writable location for metrics"
+
+
+def sample_forever(args):
+  series = open_series(args.logdir, args.name)
+  gpus = read_gpus() if shutil.which('nvidia-smi') else []
+  columns = list(COLUMNS)
+  for i in range(len(gpus)):
+    columns.extend('%s%d'%(column, i) for column in GPU_COLUMNS)
+  if series.tell() == 0:
+    series.write('\t'.join(columns)+'\n')
+
+  previous = read_counters()
+  previous_time = time.time()
+  while True:
+    time.sleep(args.interval_sec)
+    if args.parent_pid:
+      try:
+        os.kill(args.parent_pid, 0)
+      except OSError:   # parent is gone, ie tmux session was killed
+        return
+    current = read_counters()
+    now = time.time()
+    if gpus:
+      gpus = read_gpus() or [None]*len(gpus)
+    row = make_sample(previous, current, now-previous_time, read_memory_mb(),
+                      gpus)
+    series.write('\t'.join(row)+'\n')
+    previous, previous_time = current, now
+
+
+def summarize(fn):
+  """Prints mean and max of every column of given series."""
+  lines = read_lines(fn)
+  columns = lines[0].split('\t')
+  values = [[] for column in columns]
+  for line in lines[1:]:
+    for i, value in enumerate(line.split('\t')):
+      if value:
+        values[i].append(float(value))
+  print("%-16s %10s %10s"%('metric', 'mean', 'max'))
+  for column, column_values in zip(columns[1:], values[1:]):
+    if column_values:
+      print("%-16s %10.2f %10.2f"%(column, sum(column_values)/len(column_values),
+                                   max(column_values)))
+
+
+def main():
+  args = parser.parse_args()
+  if args.summarize:
+    summarize(args.summarize)
+  else:
+    sample_forever(args)
+
+
+if __name__=='__main__':
+  main()
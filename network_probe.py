@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# Measures bandwidth and latency between tasks of a job, used by
+# backend.Job.probe_network, which uploads this script to the tasks.
+#
+# Every task runs a server, and pairs of tasks are probed in rounds of a
+# round-robin schedule, so all pairs in a round are measured concurrently
+# without sharing a NIC. Resulting matrix is used to suggest task order for
+# ring all-reduce and placement of parameter servers.
+#
+# task 1:  python network_probe.py --serve=6200
+# task 0:  python network_probe.py --peer=10.0.0.2:6200 --stats-fn=probe.json
+# task 1:  python network_probe.py --stop=127.0.0.1:6200
+#
+# Only uses standard library since it runs on the instance.
+
+import argparse
+import json
+import socket
+import threading
+import time
+
+CHUNK_BYTES=1<<16
+CONNECT_TIMEOUT_SEC=120     # how long to wait for peer's server to start
+IDLE_TIMEOUT_SEC=60         # server exits after this long without clients
+LATENCY_PINGS=50
+
+parser = argparse.ArgumentParser(description='network probe')
+parser.add_argument('--serve', type=int, default=0,
+                    help='run probe server on this port')
+parser.add_argument('--peer', type=str, default='',
+                    help='host:port of server to probe')
+parser.add_argument('--stop', type=str, default='',
+                    help='host:port of server to stop')
+parser.add_argument('--timeout-sec', type=float, default=IDLE_TIMEOUT_SEC,
+                    help='server exits after this long without clients')
+parser.add_argument('--duration-sec', type=float, default=2,
+                    help='how long to measure bandwidth')
+parser.add_argument('--stats-fn', type=str, default='',
+                    help='file to write JSON results into')
+
+
+def _handle(sock, stop):
+  command = sock.recv(1)
+  if command == b'L':   # echo pings until client closes
+    while True:
+      data = sock.recv(1)
+      if not data:
+        break
+      sock.sendall(data)
+  elif command == b'B':   # count bytes until client stops sending
+    num_bytes = 0
+    while True:
+      data = sock.recv(CHUNK_BYTES)
+      if not data:
+        break
+      num_bytes+=len(data)
+    sock.sendall(('%d\n'%(num_bytes,)).encode())
+  elif command == b'S':
+    stop.set()
+  sock.close()
+
+
+def serve(port, timeout_sec=IDLE_TIMEOUT_SEC):
+  """Serves probes until stopped, or until there were no clients for
+  timeout_sec."""
+  server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+  server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+  server.bind(('', port))
+  server.listen(16)
+  server.settimeout(1)   # to check for stop between clients
+  stop = threading.Event()
+  last_client_time = time.time()
+  while not stop.is_set() and time.time() - last_client_time < timeout_sec:
+    try:
+      sock, _ = server.accept()
+    except socket.timeout:
+      continue
+    last_client_time = time.time()
+    sock.settimeout(None)
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    threading.Thread(target=_handle, args=(sock, stop), daemon=True).start()
+  server.close()
+
+
+def connect(address, command):
+  host, port = address.rsplit(':', 1)
+  start_time = time.time()
+  while True:
+    try:
+      sock = socket.create_connection((host, int(port)))
+      break
+    except socket.error:
+      if time.time() - start_time > CONNECT_TIMEOUT_SEC:
+        raise
+      time.sleep(0.1)
+  sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+  sock.sendall(command)
+  return sock
+
+
+def probe(address, duration_sec):
+  """Returns median round trip latency in ms and bandwidth in MB/s from this
+  host to server at address."""
+  sock = connect(address, b'L')
+  round_trips = []
+  for i in range(LATENCY_PINGS):
+    start_time = time.time()
+    sock.sendall(b'x')
+    sock.recv(1)
+    round_trips.append(time.time() - start_time)
+  sock.close()
+  latency_ms = sorted(round_trips)[len(round_trips)//2]*1000
+
+  sock = connect(address, b'B')
+  chunk = b'x'*CHUNK_BYTES
+  start_time = time.time()
+  while time.time() - start_time < duration_sec:
+    sock.sendall(chunk)
+  sock.shutdown(socket.SHUT_WR)
+  num_bytes = int(sock.makefile().readline())
+  elapsed = time.time() - start_time
+  sock.close()
+  return latency_ms, num_bytes/1e6/elapsed
+
+
+def round_robin_pairs(num_tasks):
+  """Returns list of rounds, each a list of (i, j) pairs where every task
+  appears at most once, covering all pairs of tasks (circle method)."""
+  ids = list(range(num_tasks))
+  if num_tasks % 2:
+    ids.append(None)   # task paired with None sits the round out
+  rounds = []
+  for round_idx in range(len(ids)-1):
+    pairs = []
+    for k in range(len(ids)//2):
+      i, j = ids[k], ids[-k-1]
+      if i is not None and j is not None:
+        pairs.append((min(i, j), max(i, j)))
+    rounds.append(pairs)
+    ids = [ids[0]] + [ids[-1]] + ids[1:-1]
+  return rounds
+
+
+def _ring_cost(order, bandwidth):
+  """Time per byte of slowest link of the ring."""
+  return max(1./max(bandwidth[order[i-1]][order[i]], 1e-6)
+             for i in range(len(order)))
+
+
+def ring_order(bandwidth):
+  """Returns task order for ring all-reduce that maximizes bandwidth of the
+  slowest link. bandwidth[i][j] is MB/s between tasks i and j. Uses greedy
+  nearest neighbor from task 0 followed by 2-opt improvement."""
+  num_tasks = len(bandwidth)
+  if num_tasks < 4:
+    return list(range(num_tasks))
+  order = [0]
+  while len(order) < num_tasks:
+    last = order[-1]
+    order.append(max((j for j in range(num_tasks) if j not in order),
+                     key=lambda j: bandwidth[last][j]))
+
+  improved = True
+  while improved:
+    improved = False
+    for i in range(1, num_tasks-1):
+      for j in range(i+1, num_tasks):
+        candidate = order[:i] + order[i:j+1][::-1] + order[j+1:]
+        if _ring_cost(candidate, bandwidth) < _ring_cost(order, bandwidth):
+          order = candidate
+          improved = True
+  return order
+
+
+def central_tasks(bandwidth, num_tasks):
+  """Returns ids of num_tasks tasks with highest total bandwidth to other
+  tasks, ie for placing parameter servers."""
+  totals = [sum(row[j] for j in range(len(row)) if j != i)
+            for i, row in enumerate(bandwidth)]
+  return sorted(range(len(bandwidth)), key=lambda i: -totals[i])[:num_tasks]
+
+
+def main():
+  args = parser.parse_args()
+  if args.serve:
+    serve(args.serve, args.timeout_sec)
+    return
+  if args.stop:
+    connect(args.stop, b'S').close()
+    return
+  latency_ms, mb_per_sec = probe(args.peer, args.duration_sec)
+  print("%s: latency %.3f ms, bandwidth %.1f MB/s"%(args.peer, latency_ms,
+                                                    mb_per_sec))
+  if args.stats_fn:
+    with open(args.stats_fn, 'w') as f:
+      json.dump({'latency_ms': latency_ms, 'mb_per_sec': mb_per_sec}, f)
+
+
+if __name__=='__main__':
+  main()
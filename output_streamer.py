@@ -0,0 +1,161 @@
+# Streams output of tasks to local log files, using single I/O thread for all
+# tasks in the process.
+#
+# Each task registers a source (SSH channel or local pipe that produces the
+# output of the task's tmux pane). The I/O thread multiplexes all sources
+# with select(), writes output to per-task log file with large buffered
+# writes, keeps last lines in a bounded ring buffer, and calls per-line
+# callbacks, ie to extract images/sec from training logs.
+
+import atexit
+import collections
+import os
+import select
+import threading
+import time
+
+LOG_BUFFER_BYTES=1<<20      # buffer size of per-task log files
+READ_CHUNK_BYTES=1<<16      # max bytes to read from a source at once
+FLUSH_INTERVAL_SEC=2        # how often to flush log files to disk
+DEFAULT_TAIL_LINES=1000     # number of lines kept in memory for each task
+
+
+class TaskOutput:
+  """Output of a single task: log file, tail of recent lines and callbacks."""
+
+  def __init__(self, task, log_fn, tail_lines=DEFAULT_TAIL_LINES):
+    self.task = task
+    self.log_fn = log_fn
+    self.log_file = open(log_fn, 'ab', buffering=LOG_BUFFER_BYTES)
+    self.lines = collections.deque(maxlen=tail_lines)
+    self.callbacks = []
+    self.bytes_received = 0
+    self._partial_line = b''
+    self._lock = threading.Lock()
+
+  def feed(self, data):
+    """Handles chunk of output received from the task."""
+    self.bytes_received+=len(data)
+    self.log_file.write(data)
+    lines = (self._partial_line + data).split(b'\n')
+    self._partial_line = lines.pop()
+    decoded_lines = [line.decode(errors='replace').rstrip('\r')
+                     for line in lines]
+    with self._lock:
+      self.lines.extend(decoded_lines)
+      callbacks = list(self.callbacks)
+    for line in decoded_lines:
+      for callback in callbacks:
+        try:
+          callback(self.task, line)
+        except Exception as e:
+          print("Output callback %s failed with %s"%(callback, e))
+
+  def add_callback(self, callback):
+    with self._lock:
+      self.callbacks.append(callback)
+
+  def tail(self, num_lines=20):
+    """Returns list of last num_lines lines of output."""
+    with self._lock:
+      lines = list(self.lines)
+    return lines[-num_lines:]
+
+  def flush(self):
+    self.log_file.flush()
+
+  def close(self):
+    if self._partial_line:
+      self.feed(b'\n')
+    self.log_file.close()
+
+
+class OutputStreamer:
+  """Single thread that moves data from all registered sources into their
+  TaskOutput."""
+
+  def __init__(self):
+    self._sources = {}   # fileno -> (read_func, close_func, output)
+    self._lock = threading.Lock()
+    self._wakeup_read, self._wakeup_write = os.pipe()
+    self._thread = None
+    self._last_flush_time = time.time()
+
+  def add_source(self, fileno, read_func, output, close_func=None,
+                 end_func=None):
+    """Starts streaming from file descriptor into output. read_func(n)
+    returns up to n bytes, or b'' at end of stream. end_func() is called
+    after stream ended and was closed."""
+    with self._lock:
+      self._sources[fileno] = (read_func, close_func, end_func, output)
+      if self._thread is None:
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+    os.write(self._wakeup_write, b'x')
+
+  def add_channel(self, channel, output, end_func=None):
+    """Streams stdout of paramiko channel into output. end_func() is called
+    when channel closes, ie when SSH connection is lost."""
+    channel.set_combine_stderr(True)
+    self.add_source(channel.fileno(), channel.recv, output, channel.close,
+                    end_func)
+
+  def add_fd(self, fd, output):
+    """Streams local file descriptor (pipe or fifo) into output, closes it at
+    end of stream."""
+    self.add_source(fd, lambda n: os.read(fd, n), output, lambda: os.close(fd))
+
+  def _remove_source(self, fileno):
+    with self._lock:
+      read_func, close_func, end_func, output = self._sources.pop(fileno)
+    if close_func:
+      close_func()
+    output.flush()
+    if end_func:
+      try:
+        end_func()
+      except Exception as e:
+        print("Stream end callback %s failed with %s"%(end_func, e))
+
+  def _loop(self):
+    while True:
+      with self._lock:
+        filenos = list(self._sources.keys())
+      readable, _, _ = select.select(filenos+[self._wakeup_read], [], [],
+                                     FLUSH_INTERVAL_SEC)
+      for fileno in readable:
+        if fileno == self._wakeup_read:
+          os.read(self._wakeup_read, READ_CHUNK_BYTES)
+          continue
+        read_func, _, _, output = self._sources[fileno]
+        try:
+          data = read_func(READ_CHUNK_BYTES)
+        except Exception:
+          data = b''
+        if data:
+          output.feed(data)
+        else:
+          self._remove_source(fileno)
+
+      if time.time() - self._last_flush_time > FLUSH_INTERVAL_SEC:
+        self.flush()
+
+  def flush(self):
+    with self._lock:
+      outputs = [source[-1] for source in self._sources.values()]
+    for output in outputs:
+      output.flush()
+    self._last_flush_time = time.time()
+
+
+_streamer = None
+_streamer_lock = threading.Lock()
+
+def get_streamer():
+  """Returns OutputStreamer shared by all tasks in this process."""
+  global _streamer
+  with _streamer_lock:
+    if _streamer is None:
+      _streamer = OutputStreamer()
+      atexit.register(_streamer.flush)
+    return _streamer
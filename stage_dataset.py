@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# Copies dataset directory to local disk with many parallel streams, used by
+# backend.Task.stage_dataset, which uploads this script to the task.
+#
+# Files are split into chunks and chunks of all files are copied
+# concurrently, so copy runs at line rate of NFS/EFS or local disk instead of
+# speed of single cp stream. Manifest of copied files is kept in target
+# directory, files already in the manifest with unchanged size and mtime are
+# skipped when staging again. Every staged file is checked to have the size of
+# its source, and files that changed while being copied fail the staging.
+#
+# python stage_dataset.py ~/data/imagenet /tmpfs/data/imagenet
+#
+# Only uses standard library since it runs on the instance.
+
+import argparse
+import concurrent.futures
+import json
+import os
+import threading
+import time
+
+MANIFEST_NAME='.stage_manifest.json'
+
+parser = argparse.ArgumentParser(description='parallel dataset copy')
+parser.add_argument('src', type=str, help='source directory')
+parser.add_argument('dst', type=str, help='target directory')
+parser.add_argument('--num-streams', type=int, default=32,
+                    help='number of chunks copied concurrently')
+parser.add_argument('--chunk-mb', type=int, default=64,
+                    help='size of chunk copied by single stream')
+parser.add_argument('--stats-fn', type=str, default='',
+                    help='file to write JSON copy statistics into')
+
+
+def load_manifest(dst):
+  """Returns {relative path: [size, mtime]} of files staged earlier."""
+  try:
+    with open(os.path.join(dst, MANIFEST_NAME)) as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return {}
+
+
+def save_manifest(dst, manifest):
+  fn = os.path.join(dst, MANIFEST_NAME)
+  with open(fn+'.tmp', 'w') as f:
+    json.dump(manifest, f)
+  os.rename(fn+'.tmp', fn)
+
+
+def list_files(src, exclude_dir=None):
+  """Returns {relative path: [size, mtime]} of all files under src, except
+  for files under exclude_dir and staging manifests."""
+  result = {}
+  for root, dirs, files in os.walk(src):
+    if exclude_dir:
+      dirs[:] = [d for d in dirs
+                 if os.path.abspath(os.path.join(root, d)) != exclude_dir]
+    for fn in files:
+      if fn == MANIFEST_NAME:
+        continue
+      path = os.path.join(root, fn)
+      stat = os.stat(path)
+      result[os.path.relpath(path, src)] = [stat.st_size, int(stat.st_mtime)]
+  return result
+
+
+def is_staged(dst, relpath, entry, manifest):
+  if manifest.get(relpath) != entry:
+    return False
+  try:
+    return os.path.getsize(os.path.join(dst, relpath)) == entry[0]
+  except OSError:
+    return False
+
+
+def copy_chunk(src_fn, dst_fn, offset, length):
+  """Copies length bytes at offset, returns number of bytes written."""
+  src_fd = os.open(src_fn, os.O_RDONLY)
+  dst_fd = os.open(dst_fn, os.O_WRONLY)
+  bytes_written = 0
+  try:
+    while length > 0:
+      data = os.pread(src_fd, min(length, 1<<24), offset)
+      assert data, "%s is shorter than expected"%(src_fn,)
+      view = memoryview(data)
+      while view:   # pwrite can write less than asked
+        num_bytes = os.pwrite(dst_fd, view, offset)
+        view = view[num_bytes:]
+        offset+=num_bytes
+        length-=num_bytes
+        bytes_written+=num_bytes
+  finally:
+    os.close(src_fd)
+    os.close(dst_fd)
+  return bytes_written
+
+
+def verify_staged(src_fn, dst_fn, entry, bytes_written):
+  """Checks that staged copy is complete and source didn't change during
+  copy. entry is [size, mtime] of source when staging started."""
+  size, mtime = entry
+  assert bytes_written == size, "Wrote %d of %d bytes of %s"%(
+    bytes_written, size, src_fn)
+  dst_size = os.path.getsize(dst_fn)
+  assert dst_size == size, "%s has %d bytes, expected %d"%(dst_fn, dst_size,
+                                                          size)
+  stat = os.stat(src_fn)
+  assert [stat.st_size, int(stat.st_mtime)] == entry, (
+    "%s changed while it was staged"%(src_fn,))
+
+
+def stage(src, dst, num_streams, chunk_bytes):
+  """Copies files of src missing in dst, returns dictionary of statistics."""
+  start_time = time.time()
+  src = os.path.normpath(src)
+  dst = os.path.normpath(dst)
+  os.makedirs(dst, exist_ok=True)
+  manifest = load_manifest(dst)
+  # dst may be inside src, don't stage staged files again
+  files = list_files(src, exclude_dir=os.path.abspath(dst))
+  to_copy = sorted(relpath for relpath, entry in files.items()
+                   if not is_staged(dst, relpath, entry, manifest))
+  # forget files removed from source or about to be overwritten
+  to_copy_set = set(to_copy)
+  manifest = {relpath: entry for relpath, entry in manifest.items()
+              if relpath in files and relpath not in to_copy_set}
+
+  # chunks of each file are written into preallocated target file, file is
+  # added to manifest once all its chunks are done
+  lock = threading.Lock()
+  chunks_left = {}
+  bytes_written = {}
+  tasks = []
+  for relpath in to_copy:
+    size = files[relpath][0]
+    src_fn = os.path.join(src, relpath)
+    dst_fn = os.path.join(dst, relpath)
+    os.makedirs(os.path.dirname(dst_fn), exist_ok=True)
+    with open(dst_fn, 'wb') as f:
+      f.truncate(size)
+    offsets = list(range(0, size, chunk_bytes)) or [0]
+    chunks_left[relpath] = len(offsets)
+    bytes_written[relpath] = 0
+    for offset in offsets:
+      tasks.append((relpath, src_fn, dst_fn, offset,
+                    min(chunk_bytes, size-offset)))
+
+  def copy(task):
+    relpath, src_fn, dst_fn, offset, length = task
+    num_bytes = copy_chunk(src_fn, dst_fn, offset, length)
+    with lock:
+      chunks_left[relpath]-=1
+      bytes_written[relpath]+=num_bytes
+      if chunks_left[relpath] == 0:
+        verify_staged(src_fn, dst_fn, files[relpath], bytes_written[relpath])
+        mtime = files[relpath][1]
+        os.utime(dst_fn, (mtime, mtime))
+        manifest[relpath] = files[relpath]
+
+  try:
+    # all chunks are copied even if some fail, so that manifest records every
+    # file that was fully staged, then the first error is raised
+    with concurrent.futures.ThreadPoolExecutor(num_streams) as executor:
+      futures = [executor.submit(copy, task) for task in tasks]
+    for future in futures:
+      future.result()
+  finally:
+    # partial progress is kept, so interrupted staging resumes
+    save_manifest(dst, manifest)
+
+  elapsed = time.time() - start_time
+  bytes_copied = sum(files[relpath][0] for relpath in to_copy)
+  return {'files_copied': len(to_copy),
+          'files_skipped': len(files)-len(to_copy),
+          'bytes_copied': bytes_copied,
+          'bytes_skipped': sum(entry[0] for entry in files.values())-bytes_copied,
+          'elapsed_sec': elapsed,
+          'mb_per_sec': bytes_copied/1e6/max(elapsed, 1e-6)}
+
+
+def main():
+  args = parser.parse_args()
+  src = os.path.expanduser(args.src)
+  dst = os.path.expanduser(args.dst)
+  assert os.path.isdir(src), "%s is not a directory"%(src,)
+  stats = stage(src, dst, args.num_streams, args.chunk_mb<<20)
+  print("Staged %(files_copied)d files (%(bytes_copied)d bytes) in "
+        "%(elapsed_sec).1f sec, %(mb_per_sec).1f MB/s, skipped "
+        "%(files_skipped)d files"%stats)
+  if args.stats_fn:
+    with open(os.path.expanduser(args.stats_fn), 'w') as f:
+      json.dump(stats, f)
+
+
+if __name__=='__main__':
+  main()
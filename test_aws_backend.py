@@ -0,0 +1,315 @@
+# Tests of aws_backend that don't need AWS, SSH connection of the task is
+# replaced with StubConnection.
+
+import os
+import shutil
+import signal
+import subprocess
+import threading
+import time
+
+import pytest
+
+import aws_backend
+import backend
+import util as u
+
+
+class StubInstance:
+  id = 'i-stub'
+  private_ip_address = '10.0.0.1'
+  public_ip_address = '1.2.3.4'
+
+  def load(self):
+    pass
+
+
+class StubConnection:
+  """Stands in for u.SshConnection, records commands instead of running
+  them."""
+
+  def __init__(self):
+    self.commands = []
+    self.sftp_calls = []
+
+  def exec_command(self, cmd, get_pty=False, stdin_func=None, binary=False,
+                   idempotent=False):
+    self.commands.append(cmd)
+    if 'display-message' in cmd:
+      return 0, '4242\n', ''
+    return 0, b'' if binary else '', ''
+
+  def sftp_call(self, method_name, *args, **kwargs):
+    self.sftp_calls.append((method_name,)+args)
+
+
+class LocalChannel:
+  """Stands in for paramiko Channel of a command running locally."""
+
+  def __init__(self, cmd):
+    self.popen = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE,
+                                  stderr=subprocess.PIPE,
+                                  start_new_session=True)
+
+  def makefile(self, mode):
+    return self.popen.stdout
+
+  def makefile_stderr(self, mode):
+    return self.popen.stderr
+
+  def recv_exit_status(self):
+    return self.popen.wait()
+
+  # used by output_streamer
+  def set_combine_stderr(self, combine):
+    pass
+
+  def fileno(self):
+    return self.popen.stdout.fileno()
+
+  def recv(self, num_bytes):
+    return os.read(self.fileno(), num_bytes)
+
+  def close(self):
+    """Stops the command, like closing the channel of a lost connection."""
+    if self.popen.poll() is None:
+      os.killpg(self.popen.pid, signal.SIGKILL)
+      self.popen.wait()
+
+
+class LocalConnection(StubConnection):
+  """Connection to "remote" host that is this machine, runs commands and
+  file transfers locally."""
+
+  def __init__(self):
+    super().__init__()
+    self.reconnect_callbacks = []
+
+  # batched operations of u.SshConnection only need exec_command
+  file_exists_many = u.SshConnection.file_exists_many
+  file_read_many = u.SshConnection.file_read_many
+
+  def exec_command(self, cmd, get_pty=False, stdin_func=None, binary=False,
+                   idempotent=False):
+    self.commands.append(cmd)
+    process = subprocess.Popen(cmd, shell=True, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if stdin_func:
+      stdin_func(process.stdin)
+    stdout, stderr = process.communicate()
+    if not binary:
+      stdout = stdout.decode()
+    return process.returncode, stdout, stderr.decode()
+
+  def is_active(self):
+    return True
+
+  def add_reconnect_callback(self, callback):
+    self.reconnect_callbacks.append(callback)
+
+  def file_read(self, remote_fn):
+    with open(remote_fn) as f:
+      return f.read()
+
+  def file_write(self, remote_fn, contents):
+    with open(remote_fn, 'w') as f:
+      f.write(contents)
+
+  def open_channel(self, cmd, idempotent=False):
+    self.commands.append(cmd)
+    return LocalChannel(cmd)
+
+  def sftp_call(self, method_name, *args, **kwargs):
+    self.sftp_calls.append((method_name,)+args)
+    if method_name == 'stat':
+      return os.stat(args[0])
+    if method_name == 'get':
+      return shutil.copyfile(args[0], args[1])
+    assert False, "%s is not supported"%(method_name,)
+
+
+class StubRun:
+  name = 'testrun'
+  logdir = '/efs/runs/testrun'
+
+
+class StubJob:
+  name = 'worker.testrun'
+  _run = StubRun()
+
+
+def make_task(task_id=0, ssh=None, taskdir='/home/ubuntu'):
+  """Returns initialized aws_backend.Task connected to StubConnection."""
+  task = aws_backend.Task.__new__(aws_backend.Task)
+  task.instance = StubInstance()
+  task.job = StubJob()
+  task.id = task_id
+  task.ssh = ssh or StubConnection()
+  task.taskdir = taskdir
+  task.tmux_session = 'tmux'
+  task.remote_scratch = '/tmp/tmux'
+  task.cached_ip = None
+  task._run_counter = 0
+  task._run_lock = threading.Lock()
+  task._run_command_available = True
+  return task
+
+
+def test_start_metrics_agent():
+  task = make_task()
+  task.start_metrics_agent(interval_sec=1)
+
+  assert task.ssh.sftp_calls[0][0] == 'put'
+  assert task.ssh.sftp_calls[0][2] == 'metrics_agent.py'
+  # started outside of tmux shell, since Task.run rejects &
+  start_cmd = task.ssh.commands[-1]
+  assert 'tmux send-keys' not in start_cmd
+  assert start_cmd.startswith('cd /home/ubuntu && nohup ')
+  assert start_cmd.endswith(' > metrics_agent.log 2>&1 < /dev/null &')
+  assert '--parent-pid=4242' in start_cmd
+  assert '--name=0.worker.testrun' in start_cmd
+
+
+def test_run_background_is_not_run_in_tmux():
+  task = make_task()
+  task.run_background('sleep 10 & sleep 20', 'sleep.log')
+  assert len(task.ssh.commands) == 1
+  assert "sh -c 'sleep 10 & sleep 20'" in task.ssh.commands[0]
+
+
+def test_download_file_and_directory(tmpdir):
+  remote = tmpdir.mkdir('remote')
+  remote.join('file.txt').write('file')
+  remote.mkdir('dir').mkdir('sub').join('a.txt').write('a')
+  remote.join('dir').join('b.txt').write('b')
+  local = tmpdir.mkdir('local')
+  task = make_task(ssh=LocalConnection(), taskdir=str(remote))
+
+  task.download('file.txt', str(local.join('file.txt')))
+  assert local.join('file.txt').read() == 'file'
+
+  task.download('dir', str(local.join('dir.downloaded')))
+  assert local.join('dir.downloaded', 'sub', 'a.txt').read() == 'a'
+  assert local.join('dir.downloaded', 'b.txt').read() == 'b'
+  # single tar stream instead of SFTP get per file
+  assert [c[0] for c in task.ssh.sftp_calls].count('get') == 1
+
+  # like cp -R, existing local directory gets a copy inside
+  task.download('dir', str(local))
+  assert local.join('dir', 'sub', 'a.txt').read() == 'a'
+
+
+def test_sync_dir(tmpdir, monkeypatch):
+  monkeypatch.setattr(u, 'UPLOAD_MANIFEST_DIR', str(tmpdir.join('manifests')))
+  local = tmpdir.mkdir('local')
+  local.join('same.txt').write('a'*100000)
+  local.mkdir('sub').join('changed.txt').write('b'*100000)
+  target = str(tmpdir.join('remote', 'target'))
+  ssh = LocalConnection()
+
+  bytes_sent, bytes_skipped = u.sync_dir(ssh, str(local), target)
+  assert bytes_skipped == 0
+  # compressed stream of repetitive files is much smaller than the files
+  assert 0 < bytes_sent < 10000
+  assert tmpdir.join('remote', 'target', 'sub', 'changed.txt').read() == (
+    'b'*100000)
+
+  local.join('sub', 'changed.txt').write('c'*100000)
+  bytes_sent, bytes_skipped = u.sync_dir(ssh, str(local), target)
+  assert bytes_skipped == 100000
+  assert 0 < bytes_sent < 10000
+  assert tmpdir.join('remote', 'target', 'sub', 'changed.txt').read() == (
+    'c'*100000)
+  # manifest is kept outside of the synced directory
+  assert sorted(os.listdir(target)) == ['same.txt', 'sub']
+
+  assert u.sync_dir(ssh, str(local), target) == (0, 200000)
+
+  # target was wiped (ie, /tmp after reboot), but manifest survived
+  os.remove(os.path.join(target, 'sub', 'changed.txt'))
+  bytes_sent, bytes_skipped = u.sync_dir(ssh, str(local), target)
+  assert bytes_skipped == 100000
+  assert bytes_sent > 0
+  assert tmpdir.join('remote', 'target', 'sub', 'changed.txt').read() == (
+    'c'*100000)
+
+  # files deleted from source are deleted from target, other files are kept
+  tmpdir.join('remote', 'target', 'other.txt').write('other')
+  local.join('same.txt').remove()
+  assert u.sync_dir(ssh, str(local), target) == (0, 100000)
+  assert sorted(os.listdir(target)) == ['other.txt', 'sub']
+
+
+def test_file_read_many(tmpdir):
+  ssh = LocalConnection()
+  task = make_task(ssh=ssh)
+  tmpdir.join('a.txt').write('a')
+  tmpdir.join('sub', 'b.txt').write('b\n', ensure=True)
+  tmpdir.join('link.txt').mksymlinkto(tmpdir.join('sub', 'b.txt'))
+  fns = [str(tmpdir.join('a.txt')), str(tmpdir.join('missing.txt')),
+         str(tmpdir.join('sub', 'b.txt')), str(tmpdir.join('sub')),
+         str(tmpdir.join('link.txt'))]
+
+  assert task.file_exists_many(fns) == [True, False, True, True, True]
+  assert task.file_read_many(fns) == ['a', None, 'b\n', None, 'b\n']
+  assert task.file_read_many([str(tmpdir.join('missing.txt'))]) == [None]
+  assert task.file_read_many([]) == []
+  # names that aren't normalized
+  assert task.file_read_many([str(tmpdir)+'/./a.txt',
+                              str(tmpdir)+'/sub/../sub/b.txt']) == ['a', 'b\n']
+  # one remote command per batch
+  assert len(ssh.commands) == 4
+
+
+def test_run_reports_send_keys_failure_and_timeout(tmpdir):
+  task = make_task(ssh=LocalConnection())
+  task.tmux_session = 'test_aws_backend_%d'%(os.getpid(),)
+  task.remote_scratch = str(tmpdir)
+
+  # no tmux session yet, so send-keys fails right away
+  with pytest.raises(AssertionError, match='Sending true to tmux failed'):
+    task.run('true', max_wait_sec=5)
+
+  subprocess.run(['tmux', 'new-session', '-s', task.tmux_session, '-d'],
+                 check=True)
+  try:
+    assert task.run('true') == 0
+    with pytest.raises(AssertionError, match='Timeout 1 exceeded'):
+      task.run('sleep 5', max_wait_sec=1)
+  finally:
+    subprocess.run(['tmux', 'kill-session', '-t', task.tmux_session])
+
+
+def wait_for_lines(output, lines, timeout_sec=5):
+  start_time = time.time()
+  while output.tail(100) != lines:
+    assert time.time() - start_time < timeout_sec, output.tail(100)
+    time.sleep(0.05)
+
+
+def test_output_stream_resumes_after_reconnect(tmpdir, monkeypatch):
+  monkeypatch.setattr(aws_backend, 'OUTPUT_RESTART_SEC', 0)
+  ssh = LocalConnection()
+  task = make_task(ssh=ssh)
+  task.remote_scratch = str(tmpdir.mkdir('remote'))
+  task.scratch = str(tmpdir.mkdir('local').join('scratch'))
+  task.output = None
+  remote_log = tmpdir.join('remote', 'output.log')
+  task._start_output_stream()
+
+  remote_log.write('a\n', mode='a')
+  wait_for_lines(task.output, ['a'])
+
+  # channel dies on a live connection, ie tail was killed
+  task._output_channel.close()
+  remote_log.write('b\n', mode='a')
+  wait_for_lines(task.output, ['a', 'b'])
+
+  # connection was lost and reestablished, stream continues without repeats
+  task._output_channel.close()
+  for callback in ssh.reconnect_callbacks:
+    callback()
+  remote_log.write('c\n', mode='a')
+  wait_for_lines(task.output, ['a', 'b', 'c'])
+  channel, task._output_channel = task._output_channel, None
+  channel.close()
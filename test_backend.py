@@ -0,0 +1,223 @@
+# Tests of backend.py features using tmux_backend, which runs tasks locally
+# in tmux sessions.
+
+import asyncio
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+import async_backend
+import backend
+import output_streamer
+import tmux_backend
+import util as u
+
+
+class StubTask:
+  def __init__(self, task_id):
+    self.id = task_id
+
+  def log(self, *args):
+    pass
+
+
+def test_fanout_limits_concurrency():
+  lock = threading.Lock()
+  running = [0]
+  max_running = [0]
+  def func(task):
+    with lock:
+      running[0]+=1
+      max_running[0] = max(max_running[0], running[0])
+    time.sleep(0.05)
+    with lock:
+      running[0]-=1
+
+  tasks = [StubTask(i) for i in range(u.MAX_CONCURRENCY+8)]
+  results = backend.fanout(tasks, func)
+  assert all(result.ok for result in results)
+  assert max_running[0] == u.MAX_CONCURRENCY
+
+  max_running[0] = 0
+  backend.fanout(tasks[:10], func, max_concurrency=3)
+  assert max_running[0] == 3
+
+
+def test_fanout_errors():
+  def func(task):
+    if task.id == 1:
+      raise ValueError("task 1 failed")
+    return 2 if task.id == 2 else None
+  tasks = [StubTask(i) for i in range(4)]
+
+  results = backend.fanout(tasks, func, best_effort=True)
+  assert [result.ok for result in results] == [True, False, False, True]
+  assert isinstance(results[1].error, ValueError)
+  assert results[2].exit_code == 2
+
+  with pytest.raises(ValueError):
+    backend.fanout(tasks[:2], func)
+  with pytest.raises(AssertionError):
+    backend.fanout(tasks[2:], func)
+
+
+@pytest.fixture
+def make_job(tmpdir):
+  """Returns function that creates tmux job, sessions are killed after the
+  test."""
+  tmux_names = []
+  def make(num_tasks, install_script='echo hi'):
+    run = tmux_backend.make_run('test%d'%(os.getpid(),))
+    job_name = 'job%d'%(len(tmux_names),)
+    tmux_names.append(run.name+'-'+job_name)
+    return run.make_job(job_name, num_tasks, install_script=install_script)
+  yield make
+  for tmux_name in tmux_names:
+    os.system('tmux kill-session -t '+tmux_name)
+
+
+def test_probe_network(make_job, tmpdir):
+  job = make_job(3)
+  network = job.probe_network(duration_sec=0.2,
+                              cache_fn=str(tmpdir.join('probe.json')))
+  for i in range(3):
+    for j in range(3):
+      if i != j:
+        assert network['mb_per_sec'][i][j] > 0
+        assert network['mb_per_sec'][i][j] == network['mb_per_sec'][j][i]
+
+  # servers are stopped at the end of the probe
+  for task in job.tasks:
+    with pytest.raises(ConnectionRefusedError):
+      for attempt in range(50):
+        socket.create_connection(('127.0.0.1', backend.PROBE_PORT+task.id),
+                                 timeout=1).close()
+        time.sleep(0.1)
+
+
+def test_broadcast_upload(make_job, tmpdir):
+  job = make_job(3)
+  local_fn = tmpdir.join('data.bin')
+  local_fn.write_binary(os.urandom(1<<20))
+  # last task can't write the file
+  os.makedirs(job.tasks[2]._task_path('data.bin'))
+
+  with pytest.raises(AssertionError):
+    job.upload(str(local_fn), broadcast=True, max_concurrency=2)
+
+  results = job.upload(str(local_fn), broadcast=True, best_effort=True)
+  assert [result.ok for result in results] == [True, True, False]
+  for task in job.tasks[:2]:
+    with open(task._task_path('data.bin'), 'rb') as f:
+      assert f.read() == local_fn.read_binary()
+
+
+def test_tmux_run_exit_codes(make_job):
+  task = make_job(1).tasks[0]
+  assert task.run('true') == 0
+  assert task.run('(exit 3)', ignore_errors=True) == 3
+  assert task.run('true', sync=False) is None
+  assert task.run('# comment', sync=False) is None
+  with pytest.raises(AssertionError):
+    task.run('false')
+  # commands run in the same shell
+  task.run('export TEST_VAR=42')
+  task.run('test "$TEST_VAR" = 42')
+  with pytest.raises(AssertionError, match='Timeout'):
+    task._wait_for_channel('never_signalled', max_wait_sec=0.5)
+
+
+def test_tmux_upload_download(make_job, tmpdir):
+  task = make_job(1).tasks[0]
+  tmpdir.join('src', 'sub', 'data.txt').write('data', ensure=True)
+  tmpdir.join('file.txt').write('file')
+
+  task.upload(str(tmpdir.join('src')))
+  task.upload(str(tmpdir.join('file.txt')), 'renamed.txt')
+  assert task.file_read('src/sub/data.txt') == 'data'
+  assert task.file_read('renamed.txt') == 'file'
+  task.run('test -f src/sub/data.txt')
+
+  # like cp -R: copied as out, then into existing out
+  out = tmpdir.join('out')
+  task.download('src', str(out))
+  task.download('src', str(out))
+  assert out.join('sub', 'data.txt').read() == 'data'
+  assert out.join('src', 'sub', 'data.txt').read() == 'data'
+
+
+def wait_for(condition, timeout_sec=10):
+  start_time = time.time()
+  while not condition():
+    assert time.time() - start_time < timeout_sec, "Timeout waiting for output"
+    time.sleep(0.05)
+
+
+def test_output_streaming(make_job):
+  job = make_job(2)
+  lines = []
+  job.add_output_callback(lambda task, line: lines.append((task.id, line)))
+  job.run('echo marker-$((40+2))')
+
+  # pane output is raw terminal output, with escape sequences before lines
+  def has_marker(task_lines):
+    return any(line.endswith('marker-42') for line in task_lines)
+  for task in job.tasks:
+    wait_for(lambda: has_marker(line for task_id, line in list(lines)
+                                if task_id == task.id))
+    assert has_marker(task.output.tail(100))
+  task.output.flush()
+  with open(task.output.log_fn) as f:
+    assert 'marker-42' in f.read()
+
+
+def test_async_handles(make_job):
+  job = async_backend.Job(make_job(2))
+
+  async def main():
+    slow = job.tasks[0].run('sleep 1')
+    failed = job.tasks[1].run('(exit 3)', ignore_errors=True)
+    assert slow.exit_code is None
+    assert await failed == 3
+    assert failed.exit_code == 3
+    assert not slow.done()
+    results = await job.run('true')
+    await slow
+    # concurrent commands on the same task don't mix up their exit codes
+    codes = await asyncio.gather(*[
+      job.tasks[0].run('(exit %d)'%(i,), ignore_errors=True)
+      for i in range(8)])
+    assert codes == list(range(8))
+    await job.tasks[1].file_write('async.txt', 'contents')
+    return results, await job.tasks[1].file_read('async.txt')
+
+  results, contents = asyncio.run(main())
+  assert [result.task_id for result in results] == [0, 1]
+  assert all(result.ok for result in results)
+  assert contents == 'contents'
+
+
+def test_fanout_output_tail_is_read_locally(tmpdir):
+  tasks = [StubTask(i) for i in range(2)]
+  for task in tasks:
+    task.output = output_streamer.TaskOutput(
+      task, str(tmpdir.join('%d.log'%(task.id,))))
+    task.output.feed(b'line1\nline2\ntask %d\n'%(task.id,))
+
+  results = backend.fanout(tasks, lambda task: None)
+  assert [result.output_tail for result in results] == ['', '']
+  results = backend.fanout(tasks, lambda task: None, output_tail_lines=2)
+  assert [result.output_tail for result in results] == ['line2\ntask 0',
+                                                        'line2\ntask 1']
+
+
+def test_stage_dataset_quotes_paths(make_job, tmpdir):
+  task = make_job(1).tasks[0]
+  tmpdir.join('my data', 'a.txt').write('a', ensure=True)
+  stats = task.stage_dataset(str(tmpdir.join('my data')),
+                             str(tmpdir.join('staged $HOME; true')))
+  assert stats['files_copied'] == 1
+  assert tmpdir.join('staged $HOME; true', 'a.txt').read() == 'a'
@@ -0,0 +1,139 @@
+# Tests of instance_pool.py against FakeEC2, which keeps instances and tags
+# in memory instead of calling AWS.
+
+import threading
+
+import pytest
+
+import instance_pool
+import util as u
+
+
+class FakeInstance:
+  def __init__(self, ec2, instance_id, tags):
+    self.ec2 = ec2
+    self.id = instance_id
+    self.tags = tags
+    self.state = {'Name': 'stopped'}
+    self.starts = 0
+
+  def reload(self):
+    pass   # tags are shared with FakeEC2, reads are always current
+
+  def start(self):
+    self.starts+=1
+    self.state = {'Name': 'pending'}
+
+  def stop(self):
+    self.state = {'Name': 'stopped'}
+
+  def terminate(self):
+    self.state = {'Name': 'terminated'}
+
+
+class FakeEC2:
+  """Implements the subset of boto3 ec2 resource and client used by
+  instance_pool. If barrier is set, listing instances waits on it, so
+  concurrent acquires see the same pool."""
+
+  def __init__(self):
+    self.instances = self
+    self.all_instances = []
+    self.barrier = None
+    self.lock = threading.Lock()
+
+  def add_pooled(self, pool_key, released_time=1000):
+    instance = FakeInstance(self, 'i-%d'%(len(self.all_instances),),
+                            u.make_name(instance_pool.get_pool_name()) +
+                            [{'Key': instance_pool.POOL_KEY_TAG,
+                              'Value': pool_key},
+                             {'Key': instance_pool.POOL_RELEASED_TAG,
+                              'Value': str(released_time)}])
+    self.all_instances.append(instance)
+    return instance
+
+  def filter(self, Filters):
+    if self.barrier:
+      self.barrier.wait()
+    result = []
+    for instance in self.all_instances:
+      tags = {tag['Key']: tag['Value'] for tag in instance.tags}
+      for f in Filters:
+        if f['Name'] == 'instance-state-name':
+          value = instance.state['Name']
+        else:
+          value = tags.get(f['Name'][len('tag:'):])
+        if value not in f['Values']:
+          break
+      else:
+        result.append(instance)
+    return result
+
+  def _instance(self, instance_id):
+    return [i for i in self.all_instances if i.id == instance_id][0]
+
+  def create_tags(self, Resources, Tags):
+    with self.lock:
+      for instance_id in Resources:
+        instance = self._instance(instance_id)
+        keys = [tag['Key'] for tag in Tags]
+        instance.tags = [tag for tag in instance.tags
+                         if tag['Key'] not in keys] + Tags
+
+  def delete_tags(self, Resources, Tags):
+    with self.lock:
+      for instance_id in Resources:
+        instance = self._instance(instance_id)
+        keys = [tag['Key'] for tag in Tags]
+        instance.tags = [tag for tag in instance.tags
+                         if tag['Key'] not in keys]
+
+
+@pytest.fixture
+def ec2(monkeypatch):
+  fake = FakeEC2()
+  monkeypatch.setattr(u, 'create_ec2_resource', lambda: fake)
+  monkeypatch.setattr(u, 'create_ec2_client', lambda: fake)
+  monkeypatch.setattr(u, 'get_resource_name', lambda: 'test')
+  monkeypatch.setattr(instance_pool, 'CLAIM_SETTLE_SEC', 0.1)
+  return fake
+
+
+def test_acquire_renames_and_starts(ec2):
+  ec2.add_pooled('key1')
+  ec2.add_pooled('key2')
+  instances = instance_pool.acquire('key1', ['0.worker.run', '1.worker.run'])
+  assert [i.id for i in instances] == ['i-0']
+  assert instances[0].starts == 1
+  assert instances[0].tags == u.make_name('0.worker.run')
+
+
+def test_release_then_acquire(ec2):
+  instance = ec2.add_pooled('key1')
+  instance_pool.acquire('key1', ['0.worker.run'])
+  instance_pool.release([instance], 'key1')
+  assert instance.state['Name'] == 'stopped'
+  assert instance_pool.acquire('key1', ['0.worker.run2']) == [instance]
+
+
+def test_concurrent_acquires_dont_share_instances(ec2):
+  for i in range(3):
+    ec2.add_pooled('key1')
+  num_clients = 4
+  ec2.barrier = threading.Barrier(num_clients)
+  results = [None]*num_clients
+  def acquire(client):
+    results[client] = instance_pool.acquire(
+      'key1', ['%d.worker.run%d'%(i, client) for i in range(2)])
+  threads = [threading.Thread(target=acquire, args=(client,))
+             for client in range(num_clients)]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+
+  acquired = [instance.id for result in results for instance in result]
+  assert len(acquired) == len(set(acquired))
+  assert acquired, "no client got an instance"
+  for instance in ec2.all_instances:
+    assert instance.starts <= 1
@@ -0,0 +1,60 @@
+# Tests of network_probe.py, servers run locally in background threads.
+
+import itertools
+import threading
+
+import portpicker
+
+import network_probe
+
+
+def test_round_robin_pairs_covers_all_pairs():
+  for num_tasks in range(1, 8):
+    rounds = network_probe.round_robin_pairs(num_tasks)
+    pairs = [pair for pairs in rounds for pair in pairs]
+    assert sorted(pairs) == list(itertools.combinations(range(num_tasks), 2))
+    for pairs in rounds:
+      ids = [i for pair in pairs for i in pair]
+      assert len(ids) == len(set(ids)), "task probed twice in round"
+
+
+def test_ring_order_avoids_slow_link():
+  # 0-1 is slow, all other links fast
+  bandwidth = [[0, 1, 100, 100],
+               [1, 0, 100, 100],
+               [100, 100, 0, 100],
+               [100, 100, 100, 0]]
+  order = network_probe.ring_order(bandwidth)
+  assert sorted(order) == [0, 1, 2, 3]
+  links = set()
+  for k in range(len(order)):
+    links.add(frozenset((order[k], order[(k+1)%len(order)])))
+  assert frozenset((0, 1)) not in links
+
+
+def start_server(timeout_sec=network_probe.IDLE_TIMEOUT_SEC):
+  port = portpicker.pick_unused_port()
+  server = threading.Thread(target=network_probe.serve,
+                            args=(port, timeout_sec), daemon=True)
+  server.start()
+  return server, '127.0.0.1:%d'%(port,)
+
+
+def test_probe_and_stop():
+  server, address = start_server()
+  latency_ms, mb_per_sec = network_probe.probe(address, duration_sec=0.1)
+  assert latency_ms > 0
+  assert mb_per_sec > 0
+  network_probe.connect(address, b'S').close()
+  server.join(timeout=5)
+  assert not server.is_alive()
+
+
+def test_server_idle_timeout():
+  # server that gets its first client late must still be there
+  server, address = start_server(timeout_sec=3)
+  server.join(timeout=1.5)
+  assert server.is_alive()
+  network_probe.probe(address, duration_sec=0.1)
+  server.join(timeout=5)
+  assert not server.is_alive(), "server didn't exit after idle timeout"
@@ -0,0 +1,80 @@
+# Tests of stage_dataset.py, staging between local directories.
+
+import os
+
+import pytest
+
+import stage_dataset
+
+
+def make_dataset(tmpdir):
+  src = tmpdir.mkdir('data')
+  src.join('a.bin').write('a'*1000)
+  src.mkdir('sub').join('b.bin').write('b'*3000)
+  return src
+
+
+def test_stage_copies_in_chunks_and_skips_staged(tmpdir, monkeypatch):
+  make_dataset(tmpdir)
+  monkeypatch.chdir(tmpdir)
+  stats = stage_dataset.stage('./data', './staged', num_streams=4,
+                              chunk_bytes=512)
+  assert stats['files_copied'] == 2
+  assert tmpdir.join('staged', 'sub', 'b.bin').read() == 'b'*3000
+
+  # same directories spelled differently
+  for src, dst in [('./data', './staged'), ('data/', 'staged'),
+                   ('./data/../data', str(tmpdir.join('staged')))]:
+    stats = stage_dataset.stage(src, dst, num_streams=4, chunk_bytes=512)
+    assert stats['files_copied'] == 0, (src, dst)
+    assert stats['files_skipped'] == 2
+
+  tmpdir.join('data', 'a.bin').write('c'*10)
+  stats = stage_dataset.stage('data', 'staged', num_streams=4, chunk_bytes=512)
+  assert stats['files_copied'] == 1
+  assert tmpdir.join('staged', 'a.bin').read() == 'c'*10
+
+
+def test_stage_into_source_subdirectory(tmpdir, monkeypatch):
+  make_dataset(tmpdir)
+  monkeypatch.chdir(tmpdir)
+  for i in range(2):
+    stats = stage_dataset.stage('./data', './data/staged', num_streams=4,
+                                chunk_bytes=512)
+    assert stats['files_copied'] + stats['files_skipped'] == 2
+  assert not tmpdir.join('data', 'staged', 'staged').exists()
+
+
+def test_stage_handles_short_writes(tmpdir, monkeypatch):
+  make_dataset(tmpdir)
+  pwrite = os.pwrite
+  # write at most 100 bytes per call
+  monkeypatch.setattr(os, 'pwrite',
+                      lambda fd, data, offset: pwrite(fd, data[:100], offset))
+  stats = stage_dataset.stage(str(tmpdir.join('data')),
+                              str(tmpdir.join('staged')), num_streams=4,
+                              chunk_bytes=512)
+  assert stats['files_copied'] == 2
+  assert tmpdir.join('staged', 'sub', 'b.bin').read() == 'b'*3000
+
+
+def test_stage_fails_when_source_changes(tmpdir, monkeypatch):
+  src = make_dataset(tmpdir)
+  copy_chunk = stage_dataset.copy_chunk
+  def copy_and_append(src_fn, dst_fn, offset, length):
+    num_bytes = copy_chunk(src_fn, dst_fn, offset, length)
+    if src_fn.endswith('a.bin'):
+      with open(src_fn, 'a') as f:
+        f.write('more')
+    return num_bytes
+  monkeypatch.setattr(stage_dataset, 'copy_chunk', copy_and_append)
+
+  with pytest.raises(AssertionError, match='a.bin changed while it was staged'):
+    stage_dataset.stage(str(src), str(tmpdir.join('staged')), num_streams=1,
+                        chunk_bytes=4096)
+  # failed file isn't recorded as staged, so next run copies it again
+  monkeypatch.setattr(stage_dataset, 'copy_chunk', copy_chunk)
+  stats = stage_dataset.stage(str(src), str(tmpdir.join('staged')),
+                              num_streams=1, chunk_bytes=4096)
+  assert stats['files_copied'] == 1
+  assert tmpdir.join('staged', 'a.bin').read() == 'a'*1000+'more'
@@ -0,0 +1,258 @@
+# Tests of util.py helpers that don't need AWS.
+
+import io
+import json
+import subprocess
+
+import pytest
+
+import util as u
+
+
+def run_install_script(tmpdir, script, steps_dir, boot_steps_dir=None):
+  """Runs script through make_install_steps_script, returns timings lines."""
+  timings_fn = str(tmpdir.join('timings'))
+  tmpdir.join('timings').write('')
+  tmpdir.join('install.sh').write(
+    u.make_install_steps_script(script, steps_dir, timings_fn, boot_steps_dir))
+  subprocess.run(['bash', '-e', 'install.sh'], cwd=str(tmpdir), check=True)
+  return tmpdir.join('timings').read().splitlines()
+
+
+def test_install_steps_skipped_after_pool_restart(tmpdir):
+  # like aws_backend.INSTALL_STEPS_BOOT_DIR, but with fake boot id
+  tmpdir.join('boot_id').write('boot1')
+  steps_dir = str(tmpdir.join('steps'))
+  boot_steps_dir = steps_dir+'/$(cat boot_id)'
+  script = 'echo install >> log\necho mount >> log # per-boot'
+
+  timings = run_install_script(tmpdir, script, steps_dir, boot_steps_dir)
+  assert [line.split()[0] for line in timings] == ['ran', 'ran']
+  assert run_install_script(tmpdir, script, steps_dir, boot_steps_dir) == [
+    'skipped 0 echo install >> log',
+    'skipped 0 echo mount >> log # per-boot']
+
+  # restarted instance from the pool only reruns steps lost on reboot
+  tmpdir.join('boot_id').write('boot2')
+  timings = run_install_script(tmpdir, script, steps_dir, boot_steps_dir)
+  assert timings[0] == 'skipped 0 echo install >> log'
+  assert timings[1].startswith('ran ')
+  assert tmpdir.join('log').read() == 'install\nmount\nmount\n'
+
+
+def test_per_boot_commands():
+  for cmd in ['sudo mount -t nfs4 fs:/ /efs', 'echo 1 >/tmp/flag',
+              'cp -r data /dev/shm/data', 'sudo sysctl -w vm.swappiness=0',
+              'sudo systemctl start docker', 'sudo nvidia-smi -pm 1',
+              'echo hi # per-boot']:
+    assert u._is_per_boot_command(cmd), cmd
+  for cmd in ['pip install tensorflow', 'sudo apt-get install -y tmux',
+              'echo mounted', 'wget http://host/tmp.tgz', 'ls /tmpfs']:
+    assert not u._is_per_boot_command(cmd), cmd
+
+
+def test_split_install_steps_joins_multiline_commands():
+  script = '''
+# comment
+cd /tmp
+sudo apt-get install -y \\
+   a b
+cat > conf <<EOF
+don't
+fi
+EOF
+if [ -f x ]; then
+  echo $#  # it's
+  for i in 1 2; do
+    echo done
+  done
+fi
+python -c 'print(1)
+print(2)'
+make &&
+  make install
+echo if fi
+'''
+  assert u.split_install_steps(script) == [
+    'cd /tmp',
+    'sudo apt-get install -y \\\n   a b',
+    "cat > conf <<EOF\ndon't\nfi\nEOF",
+    "if [ -f x ]; then\n  echo $#  # it's\n  for i in 1 2; do\n"
+    "    echo done\n  done\nfi",
+    "python -c 'print(1)\nprint(2)'",
+    'make &&\n  make install',
+    'echo if fi']
+
+
+def test_split_install_steps_rejects_unterminated_command():
+  with pytest.raises(AssertionError):
+    u.split_install_steps('if true; then\n  echo hi\n')
+
+
+def test_shell_state_commands():
+  for cmd in ['cd /tmp', 'export A=1', 'A=1', 'A=1 B="x y"', 'A+=1',
+              'source activate pytorch_p36', 'conda activate env',
+              'f() {\n  echo\n}', 'function f {\n  echo\n}']:
+    assert u._is_shell_state_command(cmd), cmd
+  for cmd in ['A=1 make', 'make', 'cat > f <<EOF\nA=1\nEOF',
+              'if true; then\n  A=1\nfi']:
+    assert not u._is_shell_state_command(cmd), cmd
+
+
+def test_install_steps_resume_after_failure(tmpdir):
+  steps_dir = str(tmpdir.join('steps'))
+  script = '''
+COUNT_FN=count
+echo x >> $COUNT_FN
+cat > out <<EOF
+  indented
+EOF
+if [ ! -f fail_once ]; then
+  touch fail_once
+  false
+fi
+echo y >> $COUNT_FN
+'''
+  with pytest.raises(subprocess.CalledProcessError):
+    run_install_script(tmpdir, script, steps_dir)
+  # heredoc body is written as is
+  assert tmpdir.join('out').read() == '  indented\n'
+
+  timings = run_install_script(tmpdir, script, steps_dir)
+  assert [line.split(' ')[0] for line in timings] == [
+    'skipped', 'skipped', 'ran', 'ran']
+  # multi-line steps are logged with their first line
+  assert timings[2].endswith(' if [ ! -f fail_once ]; then ...')
+  # NAME=value is shell state, so COUNT_FN is still set for the last step
+  assert tmpdir.join('count').read() == 'x\ny\n'
+
+
+def test_tracers_keep_separate_spans(tmpdir):
+  shared = u.Tracer()
+  with shared.span('get_vpc'):
+    pass
+  job1 = u.Tracer()
+  job2 = u.Tracer()
+  with job1.span('create_instance', 'job1', 'task 0'):
+    with shared.span('get_subnet'):
+      pass
+  with job2.span('create_instance', 'job2', 'task 0'):
+    pass
+
+  # only shared spans made while job1 was launching are copied, once
+  job1.add_spans_from(shared, job1.start_time)
+  job1.add_spans_from(shared, job1.start_time)
+  assert [span[2] for span in job1.spans] == ['create_instance', 'get_subnet']
+  assert [span[:3] for span in job2.spans] == [
+    ('job2', 'task 0', 'create_instance')]
+
+  trace_fn = str(tmpdir.join('trace.json'))
+  job1.write_chrome_trace(trace_fn)
+  events = json.load(open(trace_fn))['traceEvents']
+  assert sorted(e['name'] for e in events if e['ph'] == 'X') == [
+    'create_instance', 'get_subnet']
+  assert 'Critical path (job1 task 0)' in job1.summary()
+
+
+def test_aws_cached(monkeypatch):
+  calls = []
+  @u.aws_cached
+  def lookup(arg):
+    calls.append(arg)
+    return [arg]
+  now = [1000.]
+  monkeypatch.setattr(u.time, 'time', lambda: now[0])
+  monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-west-2')
+
+  assert lookup('a') == ['a']
+  assert lookup('a') == ['a']
+  assert lookup('b') == ['b']
+  monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+  lookup('a')
+  assert calls == ['a', 'b', 'a']
+
+  now[0]+=u.AWS_CACHE_TTL_SEC
+  lookup('a')
+  assert calls == ['a', 'b', 'a', 'a']
+  u.invalidate_aws_cache()
+  lookup('a')
+  assert calls == ['a', 'b', 'a', 'a', 'a']
+
+
+class FakeTransport:
+  """Stands in for paramiko Transport, drops connection on the first
+  open_session or exec_command, depending on fail_at."""
+
+  def __init__(self, sent, fail_at):
+    self.sent = sent
+    self.fail_at = fail_at
+    self.active = True
+
+  def is_active(self):
+    return self.active
+
+  def open_session(self):
+    if self.fail_at == 'open_session':
+      self.active = False
+      raise EOFError()
+    return FakeChannel(self)
+
+
+class FakeChannel:
+  def __init__(self, transport):
+    self.transport = transport
+
+  def exec_command(self, cmd):
+    self.transport.sent.append(cmd)
+    if self.transport.fail_at == 'exec_command':
+      self.transport.active = False
+      raise EOFError()
+
+  def makefile(self, mode):
+    return io.BytesIO(b'out')
+
+  def makefile_stderr(self, mode):
+    return io.BytesIO(b'')
+
+  def recv_exit_status(self):
+    return 0
+
+
+class FakeClient:
+  def __init__(self, transport):
+    self.transport = transport
+
+  def get_transport(self):
+    return self.transport
+
+
+def make_flaky_connection(fail_at):
+  """Returns SshConnection whose first connection drops at fail_at, and list
+  of commands that reached the remote."""
+  sent = []
+  conn = u.SshConnection('host', 'key', 'ubuntu')
+  conn.client = FakeClient(FakeTransport(sent, fail_at))
+  def connect():
+    conn.client = FakeClient(FakeTransport(sent, None))
+    return True
+  conn.connect = connect
+  return conn, sent
+
+
+def test_ssh_retries_only_commands_that_did_not_run():
+  # dropped after cmd was sent, tmux send-keys must not be typed twice
+  conn, sent = make_flaky_connection('exec_command')
+  with pytest.raises(EOFError):
+    conn.exec_command('tmux send-keys -t tmux:0 ls Enter')
+  assert sent == ['tmux send-keys -t tmux:0 ls Enter']
+
+  conn, sent = make_flaky_connection('exec_command')
+  assert conn.exec_command('cat a.txt', idempotent=True) == (0, 'out', '')
+  assert sent == ['cat a.txt', 'cat a.txt']
+
+  # dropped before channel was opened, nothing ran, so it's safe to retry
+  conn, sent = make_flaky_connection('open_session')
+  assert conn.exec_command('tmux send-keys -t tmux:0 ls Enter') == (0, 'out',
+                                                                    '')
+  assert sent == ['tmux send-keys -t tmux:0 ls Enter']
+  assert conn.reconnects == 1
@@ -1,14 +1,18 @@
 # Local implementation of backend.py using separate tmux sessions for jobs
 
+import fcntl
 import glob
 import os
-import shlex
+import shutil
+import signal
+import subprocess
 import sys
-import time
+import threading
 
 import portpicker
 
 import backend
+import output_streamer
 import util as u
 
 TASKDIR_PREFIX='/tmp/tasklogs'
@@ -16,6 +20,31 @@ LOGDIR_PREFIX='/efs/runs'
 
 # TODO: use separate session for each task, for parity with AWS job launcher
 
+FICLONE = 0x40049409  # linux/fs.h, clone file extents (reflink)
+
+def _copy_file(source, target):
+  """Copies a single file. Uses reflink on filesystems that support it
+  (btrfs, xfs), otherwise falls back to regular copy, which uses in-kernel
+  copy_file_range/sendfile where available."""
+  try:
+    with open(source, 'rb') as source_file, open(target, 'wb') as target_file:
+      fcntl.ioctl(target_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copystat(source, target)
+  except OSError:
+    shutil.copy2(source, target)
+
+
+def _copy(source, target):
+  """Equivalent of cp -R source target."""
+  if os.path.isdir(target):
+    target = os.path.join(target, os.path.basename(source.rstrip('/')))
+  if os.path.isdir(source):
+    shutil.copytree(source, target, copy_function=_copy_file,
+                    dirs_exist_ok=True)
+  else:
+    _copy_file(source, target)
+
+
 # TODO: add kwargs so that tmux backend can be drop-in replacement
 def make_run(name, install_script=None):
   return Run(name, install_script)
@@ -85,6 +114,12 @@ class Task(backend.Task):
     self._ossystem('rm -Rf '+self.scratch)
     self._ossystem('mkdir -p '+self.scratch)
     self._run_counter = 0
+    self._run_lock = threading.Lock()
+    self._start_output_stream()
+    # PROMPT_COMMAND hooks from .bashrc (ie, pyenv-virtualenv) run after
+    # every command and delay the next one by tens of ms
+    subprocess.run(['tmux', 'send-keys', '-t', self.tmux_window,
+                    'unset PROMPT_COMMAND', 'Enter'], check=True)
 
     # At this point, ".run" command is available so can use that
     # install things
@@ -95,53 +130,77 @@ class Task(backend.Task):
         self._upload_handler(line)
       else:
         self.run(line)
-
-
-  def _wait_for_file(self, fn, max_wait_sec=600, check_interval=0.02):
-    start_time = time.time()
-    while True:
-      if time.time() - start_time > max_wait_sec:
-        assert False, "Timeout %s exceeded for %s" %(max_wait_sec, cmd)
-      if not self.file_exists(fn):
-        # print("check for %s returned %s, sleeping for %s"%(fn,
-        #                                                    self.file_exists(fn),
-        #                                                    check_interval))
-        time.sleep(check_interval)
-        continue
-      else:
-        break
+    self.start_metrics_agent()
+
+
+  def _start_output_stream(self):
+    """Mirrors tmux window into a fifo, which is streamed into
+    taskdir/output.log."""
+    fifo_fn = self.scratch+'/output.fifo'
+    os.mkfifo(fifo_fn)
+    # open read-write so that open doesn't block waiting for writer, and
+    # stream doesn't end if writer restarts
+    fd = os.open(fifo_fn, os.O_RDWR)
+    self.output = output_streamer.TaskOutput(self, self.taskdir+'/output.log')
+    output_streamer.get_streamer().add_fd(fd, self.output)
+    self._ossystem("tmux pipe-pane -t %s 'cat > %s'"%(self.tmux_window,
+                                                       fifo_fn))
+
+  def _wait_for_channel(self, channel, max_wait_sec=600, keys=None):
+    """Blocks until command signals given tmux wait-for channel. If the
+    signal was sent before we started waiting, returns immediately. If keys
+    are given, they are sent to the task's window first, by the same tmux
+    client."""
+    tmux_cmd = ['tmux']
+    if keys:
+      tmux_cmd+=['send-keys', '-t', self.tmux_window] + keys + [';']
+    tmux_cmd+=['wait-for', channel]
+    # subprocess timeout is implemented by polling with growing sleeps, which
+    # would add milliseconds to every command, so kill client from a timer
+    # instead
+    process = subprocess.Popen(tmux_cmd)
+    timer = threading.Timer(max_wait_sec, process.kill)
+    timer.start()
+    try:
+      status = process.wait()
+    finally:
+      timer.cancel()
+    assert status != -signal.SIGKILL, "Timeout %s exceeded for %s" %(
+      max_wait_sec, channel)
+    assert status == 0, "tmux wait-for %s failed with %s"%(channel, status)
 
 
   def run(self, cmd, sync=True, ignore_errors=False):
-    self._run_counter+=1
+    # run can be called from several threads, ie by async_backend handles
+    with self._run_lock:
+      self._run_counter+=1
+      run_id = self._run_counter
     self.log(cmd)
     cmd = cmd.strip()
     if not cmd:  # ignore empty command lines
-      return
+      return 0 if sync else None
 
     if cmd.startswith('#'):  # ignore commented out lines
-      return
+      return 0 if sync else None
     
-    cmd_in_fn  = '%s/%d.in'%(self.scratch, self._run_counter)
-    cmd_out_fn  = '%s/%d.out'%(self.scratch, self._run_counter)
+    cmd_in_fn  = '%s/%d.in'%(self.scratch, run_id)
+    cmd_out_fn  = '%s/%d.out'%(self.scratch, run_id)
 
     assert not os.path.exists(cmd_out_fn)
     
     open(cmd_in_fn, 'w').write(cmd+'\n')
+    channel = 'cmd.%s.%d.%d'%(self.tmux_window, run_id, u.now_micros())
     modified_cmd = '%s ; echo $? > %s'%(cmd, cmd_out_fn)
-    start_time = time.time()
-    #    time.sleep(0.01) # tmux gets confused when too many messages get sent at
-    # once
-    tmux_cmd = 'tmux send-keys -t {} {} Enter'.format(self.tmux_window, shlex.quote(modified_cmd))
-    self._ossystem(tmux_cmd)
+    if sync:
+      modified_cmd += '; tmux wait-for -S %s'%(channel,)
+    keys = [modified_cmd, 'Enter']
     if not sync:
-      return
-    
-    self._wait_for_file(cmd_out_fn)
-    contents = open(cmd_out_fn).read()
-    
-    # if empty wait a bit to allow for race condition
-    if len(contents) == 0: time.sleep(0.1)
+      subprocess.run(['tmux', 'send-keys', '-t', self.tmux_window] + keys,
+                     check=True)
+      return None
+
+    # status file is fully written before channel is signalled
+    self._wait_for_channel(channel, keys=keys)
     contents = open(cmd_out_fn).read().strip()
 
     if contents != '0':
@@ -149,41 +208,50 @@ class Task(backend.Task):
         assert False, "Command %s returned status %s"%(cmd, contents)
       else:
         self.log("Warning: command %s returned status %s"%(cmd, contents))
+    return int(contents)
+
+  def run_background(self, cmd, log_fn):
+    self.log("background> %s", cmd)
+    with open(self._task_path(log_fn), 'w') as log_file:
+      subprocess.Popen(cmd, shell=True, cwd=self.taskdir, stdout=log_file,
+                       stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL,
+                       start_new_session=True)
+
+  def shell_pid(self):
+    output = subprocess.check_output(['tmux', 'display-message', '-p', '-t',
+                                      self.tmux_window, '#{pane_pid}'])
+    return int(output)
 
  
+  def _task_path(self, fn):
+    """Resolves fn relative to task directory, which is the current directory
+    of the task's shell."""
+    return os.path.join(self.taskdir, os.path.expanduser(fn))
+
   def upload(self, source_fn, target_fn='.'):
-    #    self.log("uploading %s to %s"%(source_fn, target_fn))
-    source_fn_full = os.path.abspath(source_fn)
-    self.run("cp -R %s %s" %(source_fn_full, target_fn))
-    #os.system("cp %s %s" %(source_fn_full, target_fn))
+    """Copies local file or directory into the task, like cp -R."""
+    self.log("uploading %s to %s"%(source_fn, target_fn))
+    _copy(os.path.abspath(source_fn), self._task_path(target_fn))
 
 
   def download(self, source_fn, target_fn='.'):
-    raise NotImplementedError()
-    # self.log("downloading %s to %s"%(source_fn, target_fn))
-    # source_fn_full = os.path.abspath(source_fn)
-    # os.system("cp %s %s" %(source_fn_full, target_fn))
+    """Copies file or directory from the task to local file, like cp -R."""
+    self.log("downloading %s to %s"%(source_fn, target_fn))
+    _copy(self._task_path(source_fn), os.path.abspath(target_fn))
 
   
   def file_exists(self, remote_fn):
-    #    print("Checking "+remote_fn+" , "+str(os.path.exists(remote_fn)))
-    return os.path.exists(remote_fn)
-
+    return os.path.exists(self._task_path(remote_fn))
 
-  def _make_temp_fn(self):
-    """Returns temporary filename for this task."""
-    return self.scratch+'/file_write.'+str(u.now_micros())
 
   def file_write(self, remote_fn, contents):
-    tmp_fn = self._make_temp_fn()
-    open(tmp_fn, 'w').write(contents)
-    self.upload(tmp_fn, remote_fn)
+    with open(self._task_path(remote_fn), 'w') as f:
+      f.write(contents)
   
 
   def file_read(self, remote_fn):
-    tmp_fn = self._make_temp_fn()
-    self.download(remote_fn, tmp_fn)
-    return open(tmp_fn).read()
+    with open(self._task_path(remote_fn)) as f:
+      return f.read()
 
   def wait_until_ready(self):
     return
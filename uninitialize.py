@@ -53,6 +53,7 @@ def main():
                                ssh_key=key_file,
                                username=username)
       ssh_client.run('rm /tmp/is_initialized')
+      ssh_client.run('rm -Rf /var/tmp/install_steps')  # rerun all install steps
       ssh_client.run('rm *.sh')  # remove install scripts
 
 
@@ -2,20 +2,28 @@
 import os
 import argparse
 import boto3
+import concurrent.futures
+import contextlib
+import functools
+import gzip
+import hashlib
+import io
+import json
 import shlex
 import paramiko
 import re
 import sys
+import tarfile
+import threading
 import time
 import paramiko
 import os
 
+from collections import Counter
 from collections import OrderedDict
 from collections import defaultdict
 
 
-import tensorflow as tf
-
 # shortcuts to refer to util module, this lets move external code into
 # this module unmodified
 util = sys.modules[__name__]   
@@ -23,6 +31,8 @@ u = util
 
 WAIT_INTERVAL_SEC=1  # how long to use for wait period
 WAIT_TIMEOUT_SEC=20 # timeout after this many seconds
+AWS_CACHE_TTL_SEC=60 # how long to reuse results of AWS inventory lookups
+MAX_CONCURRENCY=32   # default limit of concurrent SSH/AWS calls
 
 
 def now_micros():
@@ -114,19 +124,91 @@ def get_keypair_name():
   assert len(username)<30     # to avoid exceeding AWS 127 char limit
   return u.get_resource_name() +'-'+username
 
-def create_ec2_client():
+# boto3 default session is not thread-safe, so client/resource creation is
+# serialized for tasks that initialize concurrently. Calls on created clients
+# are thread-safe, so clients are created once per region and shared.
+_boto3_lock = threading.Lock()
+_boto3_clients = {}
+
+# number of AWS API calls made by this process, ie {'ec2.DescribeVpcs': 2}
+api_call_counts = Counter()
+
+def _count_api_call(event_name, **kwargs):
+  # event_name looks like before-call.ec2.DescribeVpcs
+  api_call_counts[event_name.split('.', 1)[1]]+=1
+
+def _create_client(service):
   REGION = os.environ['AWS_DEFAULT_REGION']
-  return boto3.client('ec2', region_name=REGION)
+  with _boto3_lock:
+    key = (service, REGION)
+    if key not in _boto3_clients:
+      client = boto3.client(service, region_name=REGION)
+      client.meta.events.register('before-call', _count_api_call)
+      _boto3_clients[key] = client
+    return _boto3_clients[key]
+
+def create_ec2_client():
+  return _create_client('ec2')
 
 
 def create_efs_client():
-  REGION = os.environ['AWS_DEFAULT_REGION']
-  return boto3.client('efs', region_name=REGION)
+  return _create_client('efs')
 
 
 def create_ec2_resource():
   REGION = os.environ['AWS_DEFAULT_REGION']
-  return boto3.resource('ec2',region_name=REGION)
+  with _boto3_lock:
+    resource = boto3.resource('ec2',region_name=REGION)
+  resource.meta.client.meta.events.register('before-call', _count_api_call)
+  return resource
+
+
+_aws_cache = {}
+_aws_cache_lock = threading.Lock()
+
+def aws_cached(func):
+  """Decorator for AWS inventory lookups. Reuses result of previous call
+  with the same arguments in the same region for AWS_CACHE_TTL_SEC seconds.
+  Call invalidate_aws_cache after creating or deleting resources."""
+
+  @functools.wraps(func)
+  def wrapper(*args):
+    key = (func.__name__, get_region(), args)
+    with _aws_cache_lock:
+      entry = _aws_cache.get(key)
+    if entry and time.time() - entry[0] < AWS_CACHE_TTL_SEC:
+      return entry[1]
+    with tracer.span(func.__name__, thread=threading.current_thread().name):
+      result = func(*args)
+    with _aws_cache_lock:
+      _aws_cache[key] = (time.time(), result)
+    return result
+  return wrapper
+
+
+def invalidate_aws_cache():
+  """Drops all cached AWS lookups."""
+  with _aws_cache_lock:
+    _aws_cache.clear()
+
+
+def describe_all(client, operation_name, result_key, **kwargs):
+  """Calls describe operation, following pagination if the operation
+  supports it, ie
+  describe_all(client, 'describe_vpcs', 'Vpcs') => [{'VpcId':..}, ...]"""
+  if not client.can_paginate(operation_name):
+    response = getattr(client, operation_name)(**kwargs)
+    assert is_good_response(response)
+    return response[result_key]
+
+  result = []
+  for page in client.get_paginator(operation_name).paginate(**kwargs):
+    assert is_good_response(page)
+    result.extend(page[result_key])
+  return result
+
+# server-side filter to only return resources that have Name tag
+NAMED_FILTER = [{'Name': 'tag-key', 'Values': ['Name']}]
 
 
 def is_good_response(response):
@@ -146,39 +228,40 @@ def wait_until_available(resource):
       assert False, "Timeout exceeded waiting for %s"%(resource,)
     time.sleep(WAIT_TIMEOUT_SEC)
 
+@aws_cached
 def get_vpc_dict():
   """Returns dictionary of named VPCs {name: vpc}
 
   Assert fails if there's more than one VPC with same name."""
 
   client = create_ec2_client()
-  response = client.describe_vpcs()
-  assert is_good_response(response)
+  vpcs = describe_all(client, 'describe_vpcs', 'Vpcs', Filters=NAMED_FILTER)
 
   result = OrderedDict()
   ec2 = create_ec2_resource()
-  for vpc_response in response['Vpcs']:
+  for vpc_response in vpcs:
     key = get_name(vpc_response.get('Tags', []))
     if not key:  # skip VPC's that don't have a name assigned
       continue
     
     assert key not in result, ("Duplicate VPC group %s in %s" %(key,
-                                                                response))
+                                                                vpcs))
     result[key] = ec2.Vpc(vpc_response['VpcId'])
 
   return result
 
 
+@aws_cached
 def get_security_group_dict():
   """Returns dictionary of named security groups {name: securitygroup}."""
 
   client = create_ec2_client()
-  response = client.describe_security_groups()
-  assert is_good_response(response)
+  security_groups = describe_all(client, 'describe_security_groups',
+                                 'SecurityGroups', Filters=NAMED_FILTER)
 
   result = OrderedDict()
   ec2 = create_ec2_resource()
-  for security_group_response in response['SecurityGroups']:
+  for security_group_response in security_groups:
     key = get_name(security_group_response.get('Tags', []))
     if not key:
       continue  # ignore unnamed security groups
@@ -208,6 +291,7 @@ def get_placement_group_dict():
   return result
 
 
+@aws_cached
 def get_keypair_dict():
   """Returns dictionary of {keypairname: keypair}"""
   
@@ -224,27 +308,78 @@ def get_keypair_dict():
   return result
   
 
+@aws_cached
 def get_efs_dict():
   """Returns dictionary of {efs_name: efs_id}"""
   # there's no EC2 resource for EFS objects, so return EFS_ID instead
   # https://stackoverflow.com/questions/47870342/no-ec2-resource-for-efs-objects
 
   efs_client = u.create_efs_client()
-  response = efs_client.describe_file_systems()
-  assert u.is_good_response(response)
+  file_systems = describe_all(efs_client, 'describe_file_systems',
+                              'FileSystems')
+  tags_list = get_efs_tags_list(efs_client, file_systems)
   result = OrderedDict()
-  for efs_response in response['FileSystems']:
-    fs_id = efs_response['FileSystemId']
-    tag_response = efs_client.describe_tags(FileSystemId=fs_id)
-    assert u.is_good_response(tag_response)
-    key = u.get_name(tag_response['Tags'])
+  for efs_response, tags in zip(file_systems, tags_list):
+    key = u.get_name(tags)
     if not key:   # skip EFS's without a name
       continue
     assert key not in result
-    result[key] = fs_id
+    result[key] = efs_response['FileSystemId']
 
   return result
 
+
+def get_efs_tags_list(efs_client, file_systems):
+  """Returns list of tags for each entry of describe_file_systems response.
+  Newer EFS API includes tags in the response, for older responses tags are
+  fetched with concurrent describe_tags calls."""
+
+  def get_tags(efs_response):
+    if 'Tags' in efs_response:
+      return efs_response['Tags']
+    response = efs_client.describe_tags(FileSystemId=
+                                        efs_response['FileSystemId'])
+    assert u.is_good_response(response)
+    return response['Tags']
+
+  if not file_systems:
+    return []
+  with concurrent.futures.ThreadPoolExecutor(
+      min(len(file_systems), MAX_CONCURRENCY)) as executor:
+    return list(executor.map(get_tags, file_systems))
+
+
+# name->id mapping doesn't change for the lifetime of EFS, so it's kept
+# for the lifetime of the process instead of AWS_CACHE_TTL_SEC
+_efs_id_cache = {}
+_efs_id_lock = threading.Lock()
+
+def get_efs_id(name):
+  """Returns id of EFS with given name. Concurrent callers share a single
+  lookup."""
+  key = (get_region(), name)
+  with _efs_id_lock:
+    if key not in _efs_id_cache:
+      efs_dict = get_efs_dict()
+      assert name in efs_dict, "EFS %s not found in %s"%(name,
+                                                         list(efs_dict.keys()))
+      _efs_id_cache[key] = efs_dict[name]
+    return _efs_id_cache[key]
+
+
+def get_subnet_zones(subnet_ids, ec2_client=None):
+  """Returns {subnet_id: availability_zone} for given subnets using single
+  describe_subnets call."""
+  subnet_ids = sorted(set(subnet_ids))
+  if not subnet_ids:
+    return {}
+  if ec2_client is None:
+    ec2_client = create_ec2_client()
+  response = ec2_client.describe_subnets(SubnetIds=subnet_ids)
+  assert is_good_response(response)
+  return {subnet['SubnetId']: subnet['AvailabilityZone']
+          for subnet in response['Subnets']}
+
 def get_available_zones():
   client = create_ec2_client()
   response = client.describe_availability_zones()
@@ -296,6 +431,7 @@ def create_efs(name):
   assert is_good_response(response)
 
   # make sure EFS is now visible
+  invalidate_aws_cache()
   efs_dict = get_efs_dict()
   assert name in efs_dict
   return efs_dict[name]
@@ -309,6 +445,8 @@ def delete_efs_id(efs_id):
     try:
       response = efs_client.delete_file_system(FileSystemId=efs_id)
       if is_good_response(response):
+        invalidate_aws_cache()
+        _efs_id_cache.clear()
         print("succeeded")
         break
       time.sleep(WAIT_INTERVAL_SEC)
@@ -388,6 +526,107 @@ class timeit:
     print("%s took %.2f seconds"%(self.tag, interval_sec))
 
 
+class Tracer:
+  """Records timed spans of launch phases, ie
+
+  with job.tracer.span('mount_efs', 'worker', 'task 0'):
+    ...
+
+  Spans are grouped into tracks by (process, thread), and can be exported as
+  Chrome trace JSON (chrome://tracing or ui.perfetto.dev)."""
+
+  def __init__(self):
+    self.spans = []  # (process, thread, name, start_sec, end_sec, args)
+    self.start_time = time.time()
+    self._lock = threading.Lock()
+
+  @contextlib.contextmanager
+  def span(self, name, process='launcher', thread='main', **args):
+    """Records span around the block. Yields args dictionary, which can be
+    updated inside the block, ie to record number of retries."""
+    start = time.time()
+    try:
+      yield args
+    finally:
+      with self._lock:
+        self.spans.append((process, thread, name, start, time.time(), args))
+
+  def add_spans_from(self, other, start_sec):
+    """Copies spans of other tracer that started after start_sec and aren't
+    recorded here yet."""
+    with other._lock:
+      spans = [span for span in other.spans if span[3] >= start_sec]
+    with self._lock:
+      self.spans.extend(span for span in spans if span not in self.spans)
+
+  def write_chrome_trace(self, fn):
+    """Writes spans recorded so far as Chrome trace JSON."""
+    with self._lock:
+      spans = list(self.spans)
+    events = []
+    pids = OrderedDict()
+    tids = OrderedDict()
+    for process, thread, name, start, end, args in spans:
+      if process not in pids:
+        pids[process] = len(pids)+1
+        events.append({'ph': 'M', 'name': 'process_name', 'pid': pids[process],
+                       'args': {'name': process}})
+      if (process, thread) not in tids:
+        tids[process, thread] = len(tids)+1
+        events.append({'ph': 'M', 'name': 'thread_name', 'pid': pids[process],
+                       'tid': tids[process, thread], 'args': {'name': thread}})
+      events.append({'ph': 'X', 'name': name, 'cat': process,
+                     'pid': pids[process], 'tid': tids[process, thread],
+                     'ts': int(start*1e6), 'dur': int((end-start)*1e6),
+                     'args': {k: str(v) for k, v in args.items()}})
+    with open(fn, 'w') as f:
+      json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+  def critical_path(self):
+    """Returns spans of the track that finished last, preceded by spans on
+    'launcher' tracks that ran before it started, sorted by start time."""
+    with self._lock:
+      spans = list(self.spans)
+    task_spans = [span for span in spans if span[0] != 'launcher']
+    if not task_spans:
+      return sorted(spans, key=lambda span: span[3])
+    last_span = max(task_spans, key=lambda span: span[4])
+    track = last_span[:2]
+    track_spans = [span for span in spans if span[:2] == track]
+    track_start = min(span[3] for span in track_spans)
+    launcher_spans = [span for span in spans if span[0] == 'launcher' and
+                      span[4] <= track_start]
+    return sorted(launcher_spans+track_spans, key=lambda span: span[3])
+
+  def summary(self):
+    """Returns table of phases on the critical path, with duration of the same
+    phase on other tracks for comparison."""
+    path = self.critical_path()
+    if not path:
+      return "no spans recorded"
+    with self._lock:
+      spans = list(self.spans)
+    durations = defaultdict(list)
+    for process, thread, name, start, end, args in spans:
+      durations[name].append(end-start)
+
+    origin = path[0][3]
+    lines = ["Critical path (%s %s), %.1f seconds total:"%(
+      path[-1][0], path[-1][1], path[-1][4]-origin)]
+    lines.append("%8s %8s %8s %8s  %s"%('start', 'duration', 'mean', 'max',
+                                        'phase'))
+    for process, thread, name, start, end, args in path:
+      lines.append("%8.1f %8.1f %8.1f %8.1f  %s"%(
+        start-origin, end-start, sum(durations[name])/len(durations[name]),
+        max(durations[name]), name))
+    return '\n'.join(lines)
+
+
+# spans of AWS lookups shared by all jobs of the process, aws_backend jobs
+# record their launch phases in their own Job.tracer
+tracer = Tracer()
+
+
 def get_instance_ip_map():
   """Return instance_id->private_ip map for all running instances."""
   
@@ -426,22 +665,17 @@ def get_instance_dict():
 def get_mount_targets_list(efs_id):
   """Returns list of all mount targets for given EFS id."""
   efs_client = u.create_efs_client()
-  ec2 = u.create_ec2_resource()
   
   response = efs_client.describe_mount_targets(FileSystemId=efs_id)
   assert u.is_good_response(response)
 
   result = []
   for mount_response in response['MountTargets']:
-    subnet = ec2.Subnet(mount_response['SubnetId'])
-    zone = subnet.availability_zone
-    state = mount_response['LifeCycleState']
-    id = mount_response['MountTargetId']
-    ip = mount_response['IpAddress']
-    result.append(id)
+    result.append(mount_response['MountTargetId'])
     
   return result
 
+@aws_cached
 def get_subnet_dict(vpc):
   """Returns dictionary of "availability zone" -> subnet for given VPC."""
   subnet_dict = {}
@@ -455,15 +689,16 @@ def get_subnet_dict(vpc):
 def get_mount_targets_dict(efs_id):
   """Returns dict of {zone: mount_target_id} for given EFS id."""
   efs_client = u.create_efs_client()
-  ec2 = u.create_ec2_resource()
   
   response = efs_client.describe_mount_targets(FileSystemId=efs_id)
   assert u.is_good_response(response)
 
+  subnet_zones = get_subnet_zones(mount_response['SubnetId'] for
+                                  mount_response in response['MountTargets'])
   result = OrderedDict()
   for mount_response in response['MountTargets']:
-    subnet = ec2.Subnet(mount_response['SubnetId'])
-    zone = subnet.availability_zone
+    zone = mount_response.get('AvailabilityZoneName',
+                              subnet_zones[mount_response['SubnetId']])
     state = mount_response['LifeCycleState']
     id = mount_response['MountTargetId']
     ip = mount_response['IpAddress']
@@ -551,6 +786,169 @@ def _add_echo(script):
     new_script+=cmd+"\n"
   return new_script
 
+# commands that only change state of the shell running the install script.
+# These are cheap and later steps depend on them, so they are never skipped
+_SHELL_STATE_COMMANDS = {'cd', 'export', 'source', '.', 'alias', 'set',
+                         'unset', 'pushd', 'popd', 'shopt', 'ulimit'}
+
+_SHELL_OPENERS = {'if': 'fi', 'case': 'esac', 'for': 'done', 'while': 'done',
+                  'until': 'done', 'select': 'done', '{': '}'}
+# after these, next word is a command again, so it can be a keyword
+_SHELL_COMMAND_PREFIXES = {'then', 'do', 'else', 'elif', '{', '!', 'time'}
+_HEREDOC_RE = re.compile(r"(?<!<)<<-?(?!<)\s*(['\"]?)([A-Za-z_]\w*)\1")
+_ASSIGNMENT_RE = re.compile(r'^[A-Za-z_]\w*(\[[^]]*\])?\+?=')
+# effects of commands matching this don't survive reboot (mounts, files
+# under /tmp or /dev/shm, kernel settings, started services), so their steps
+# run again on every boot. Other steps can opt in with trailing "# per-boot"
+_PER_BOOT_RE = re.compile(
+  r"(^|[\s;&|(`'\"=:<>])("
+  r"(u?mount|swapon|modprobe|sysctl|nvidia-smi)\b"
+  r"|/(tmp|dev/shm|run)(/|\b)"
+  r"|(systemctl|service)\s.*\b(start|restart|enable\s+--now)\b)"
+  r"|#\s*per-boot\s*$", re.MULTILINE)
+# line ends with \, |, && or ||, so command continues on next line
+_CONTINUED_LINE_RE = re.compile(r'(\\|\||&&)\s*$')
+_SEPARATOR_CHARS = set(';&|()\n')
+
+
+def _shell_tokens(text):
+  """Splits shell text into words and operator tokens, comments are dropped.
+  Raises ValueError if text ends inside quotes."""
+  # shlex drops newline that ends a comment, keep a separator after it
+  lexer = shlex.shlex(text.replace('\n', '\n;'), posix=True,
+                      punctuation_chars=';&|()<>\n')
+  lexer.whitespace = ' \t\r'
+  lexer.whitespace_split = True
+  return list(lexer)
+
+
+def _unclosed_blocks(tokens):
+  """Returns stack of closing keywords of compound commands (if, for, while,
+  case, {) opened but not closed by tokens."""
+  closers = []
+  command_position = True
+  for tok in tokens:
+    if command_position and tok in _SHELL_OPENERS:
+      closers.append(_SHELL_OPENERS[tok])
+    elif command_position and closers and tok == closers[-1]:
+      closers.pop()
+    command_position = (set(tok) <= _SEPARATOR_CHARS or
+                        (command_position and tok in _SHELL_COMMAND_PREFIXES))
+  return closers
+
+
+def split_install_steps(script):
+  """Splits install script into steps, one command per step. A command spans
+  several lines when lines end with \\, strings or heredocs continue over
+  line breaks, or for compound commands like if ... fi, for ... done and
+  function definitions. Comment lines between commands are dropped."""
+  steps = []
+  lines = []        # lines of current command
+  shell_text = ''   # current command without heredoc bodies
+  heredocs = []     # delimiters of heredocs whose body comes next
+  for line in script.split('\n'):
+    if not lines:
+      line = line.strip()
+      if not line or line.startswith('#'):
+        continue
+    lines.append(line)
+    if heredocs:
+      if line.strip() == heredocs[0]:
+        heredocs.pop(0)
+      if heredocs:
+        continue
+    else:
+      shell_text+=line+'\n'
+      heredocs = [match.group(2) for match in _HEREDOC_RE.finditer(line)]
+      if heredocs or _CONTINUED_LINE_RE.search(line):
+        continue
+    try:
+      tokens = _shell_tokens(shell_text)
+    except ValueError:   # open quote or trailing \
+      continue
+    if _unclosed_blocks(tokens):
+      continue
+    steps.append('\n'.join(lines).strip())
+    lines = []
+    shell_text = ''
+  assert not lines, "Install script ends inside a command: %s"%(
+    '\n'.join(lines),)
+  return steps
+
+
+def _is_shell_state_command(cmd):
+  """True for commands that change state of the shell running the install
+  script, rather than state of the machine."""
+  if _HEREDOC_RE.search(cmd):   # body isn't shell syntax
+    return False
+  toks = [tok for tok in _shell_tokens(cmd)
+          if not set(tok) <= _SEPARATOR_CHARS or tok == '()']
+  if toks[0] in _SHELL_STATE_COMMANDS or toks[:2] == ['conda', 'activate']:
+    return True
+  # NAME=value, without a command to run with it
+  if all(_ASSIGNMENT_RE.match(tok) for tok in toks):
+    return True
+  # function definition
+  return toks[0] == 'function' or toks[1:2] == ['()']
+
+
+def _is_per_boot_command(cmd):
+  """True for commands whose effects are lost on reboot, see _PER_BOOT_RE."""
+  return bool(_PER_BOOT_RE.search(cmd))
+
+
+def make_install_steps_script(script, steps_dir, timings_fn,
+                              boot_steps_dir=None):
+  """Turns install script into a bash script where each line is a
+  checkpointed step.
+
+  Each step is identified by hash of its command chained with hash of the
+  previous step, so editing a line changes ids of that step and all steps
+  after it. After step succeeds, an empty marker file named by step id is
+  created in steps_dir, and steps with existing markers are skipped on next
+  run. Shell state commands (cd, export, NAME=value, source activate,
+  function definitions) always run. Commands spanning several lines are a
+  single step, see split_install_steps.
+
+  If boot_steps_dir is given, markers of steps whose effects don't survive a
+  reboot (see _is_per_boot_command) go there instead. It should be a
+  directory that changes with every boot, so those steps run again after
+  restart while other steps stay skipped.
+
+  Each step appends "<ran|skipped> <millis> <cmd>" to timings_fn, with only
+  the first line of multi-line commands."""
+
+  new_script = "mkdir -p %s %s\n"%(steps_dir, boot_steps_dir or '')
+  step_hash = ''
+  for cmd in split_install_steps(script):
+    step_hash = hashlib.sha1((step_hash+'\n'+cmd).encode()).hexdigest()
+    if boot_steps_dir and _is_per_boot_command(cmd):
+      marker_fn = boot_steps_dir+'/'+step_hash
+    else:
+      marker_fn = steps_dir+'/'+step_hash
+    if '\n' in cmd:
+      quoted_cmd = shlex.quote(cmd.split('\n', 1)[0]+' ...')
+    else:
+      quoted_cmd = shlex.quote(cmd)
+    if _is_shell_state_command(cmd):
+      new_script+="echo \\* %s\n"%(quoted_cmd,)
+      new_script+=cmd+"\n"
+      continue
+
+    new_script+="if [ -f %s ]; then\n"%(marker_fn,)
+    new_script+="  echo skipped 0 %s >> %s\n"%(quoted_cmd, timings_fn)
+    new_script+="else\n"
+    new_script+="  step_start=$(date +%s%N)\n"
+    new_script+="  echo \\* %s\n"%(quoted_cmd,)
+    # not indented, since that would change heredoc bodies
+    new_script+="%s\n"%(cmd,)
+    new_script+="  touch %s\n"%(marker_fn,)
+    new_script+=("  echo ran $(( ($(date +%%s%%N) - step_start)/1000000 )) "
+                 "%s >> %s\n")%(quoted_cmd, timings_fn)
+    new_script+="fi\n"
+  return new_script
+
+
 def lookup_aws_instances(job_name):
   """Returns all AWS instances for given AWS job name, like
    simple.worker"""
@@ -560,9 +958,13 @@ def lookup_aws_instances(job_name):
   # todo: assert fail when there are multiple instances with same name?
   ec2 = u.create_ec2_resource()
 
-  # TODO: add waiting so that instances in state "initializing" are supported
+  # pending instances are included, aws_backend tasks wait for them to be
+  # running during initialization.
+  # task names look like 0.worker.run, so filter on name suffix server-side,
+  # and check exact match below
   instances = ec2.instances.filter(
-    Filters=[{'Name': 'instance-state-name', 'Values': ['running']}])
+    Filters=[{'Name': 'instance-state-name', 'Values': ['pending', 'running']},
+             {'Name': 'tag:Name', 'Values': ['*.'+job_name]}])
 
   result = []
   for i in instances.all():
@@ -668,6 +1070,216 @@ def ssh_to_host(hostname,
 
   return ssh_client
 
+
+class SshConnection:
+  """Persistent SSH connection to a single host.
+
+  Keeps one SSH transport and one SFTP session alive for the lifetime of the
+  task, and limits number of simultaneously open exec channels to
+  max_channels. If the transport dies, reconnects and retries the failed
+  operation once. Commands that may have already run on the remote are only
+  retried if the caller marks them idempotent.
+
+  channels_opened and sftp_sessions_opened count how many channels were
+  created over the lifetime of the connection."""
+
+  def __init__(self, hostname, ssh_key, username, max_channels=4):
+    self.hostname = hostname
+    self.ssh_key = ssh_key
+    self.username = username
+    self.client = None
+    self._sftp = None
+    self._lock = threading.RLock()
+    self._channel_semaphore = threading.BoundedSemaphore(max_channels)
+
+    self.channels_opened = 0
+    self.sftp_sessions_opened = 0
+    self.reconnects = 0
+    self._reconnect_callbacks = []
+
+  def is_active(self):
+    if self.client is None:
+      return False
+    transport = self.client.get_transport()
+    return transport is not None and transport.is_active()
+
+  def connect(self):
+    """Opens SSH connection, returns True on success."""
+    with self._lock:
+      self.close()
+      self.client = ssh_to_host(self.hostname, self.ssh_key, self.username)
+      return self.client is not None
+
+  def reconnect(self):
+    print("Reconnecting to %s@%s"%(self.username, self.hostname))
+    self.reconnects+=1
+    assert self.connect(), "Failed to reconnect to "+self.hostname
+    for callback in list(self._reconnect_callbacks):
+      try:
+        callback()
+      except Exception as e:
+        print("Reconnect callback %s failed with %s"%(callback, e))
+
+  def add_reconnect_callback(self, callback):
+    """Calls callback() after every reconnect, ie to reopen long-running
+    channels, which don't survive loss of the connection."""
+    self._reconnect_callbacks.append(callback)
+
+  def close(self):
+    with self._lock:
+      if self._sftp is not None:
+        try:
+          self._sftp.close()
+        except Exception:
+          pass
+        self._sftp = None
+      if self.client is not None:
+        self.client.close()
+        self.client = None
+
+  def _retry_on_disconnect(self, func, sent=None):
+    """Runs func(), reconnecting and retrying once if the connection was
+    lost. Errors on a live connection (ie, missing remote file) are
+    propagated as is.
+
+    For commands that are not safe to run twice, pass sent list that func
+    appends to right before the command is sent. Once it's non-empty, the
+    command may have already run on the remote, so it's not retried."""
+    try:
+      return func()
+    except Exception:
+      if self.is_active() or sent:
+        raise
+    self.reconnect()
+    return func()
+
+  @property
+  def sftp(self):
+    """Returns shared SFTP session, opening one if needed."""
+    with self._lock:
+      if self._sftp is None or not self.is_active():
+        if not self.is_active():
+          self.reconnect()
+        self._sftp = self.client.open_sftp()
+        self.sftp_sessions_opened+=1
+      return self._sftp
+
+  def sftp_call(self, method_name, *args, **kwargs):
+    """Calls method of shared SFTP session, ie
+    sftp_call('put', local_fn, remote_fn). Transfers from several threads
+    run concurrently over the same session."""
+    def func():
+      return getattr(self.sftp, method_name)(*args, **kwargs)
+    return self._retry_on_disconnect(func)
+
+  def open_channel(self, cmd, idempotent=False):
+    """Starts long-running cmd in a new exec channel and returns the channel
+    without waiting for the command to finish.
+
+    If connection is lost after cmd was sent, cmd is only started again when
+    idempotent is True."""
+    sent = None if idempotent else []
+    def func():
+      if not self.is_active():
+        self.reconnect()
+      self.channels_opened+=1
+      channel = self.client.get_transport().open_session()
+      if sent is not None:
+        sent.append(cmd)
+      channel.exec_command(cmd)
+      return channel
+    return self._retry_on_disconnect(func, sent)
+
+  def file_read(self, remote_fn):
+    """Returns contents of remote file as string, without going through
+    local scratch file."""
+    def func():
+      with self.sftp.open(remote_fn, 'r') as f:
+        return f.read().decode()
+    return self._retry_on_disconnect(func)
+
+  def file_write(self, remote_fn, contents):
+    """Writes string contents to remote file."""
+    def func():
+      with self.sftp.open(remote_fn, 'w') as f:
+        f.write(contents)
+    return self._retry_on_disconnect(func)
+
+  def exec_command(self, cmd, get_pty=False, stdin_func=None, binary=False,
+                   idempotent=False):
+    """Runs cmd in a new exec channel and waits for it to finish. Returns
+    exit_status, stdout, stderr with output decoded as strings, or stdout as
+    bytes if binary is True.
+
+    If stdin_func is given, it's called with file object connected to stdin
+    of the command, and stdin is closed after it returns.
+
+    If connection is lost before the channel is opened, cmd is retried on a
+    new connection. If it's lost after cmd was sent, cmd is only retried when
+    idempotent is True, since it may have already run on the remote (ie,
+    tmux send-keys)."""
+    sent = None if idempotent else []
+    def func():
+      with self._channel_semaphore:
+        if not self.is_active():
+          self.reconnect()
+        self.channels_opened+=1
+        channel = self.client.get_transport().open_session()
+        if get_pty:
+          channel.get_pty()
+        if sent is not None:
+          sent.append(cmd)
+        channel.exec_command(cmd)
+        stdin = channel.makefile('wb')
+        stdout = channel.makefile('r')
+        stderr = channel.makefile_stderr('r')
+        if stdin_func:
+          stdin_func(stdin)
+          channel.shutdown_write()
+        stdout_str = stdout.read()
+        if not binary:
+          stdout_str = stdout_str.decode()
+        stderr_str = stderr.read().decode()
+        exit_status = channel.recv_exit_status()
+        return exit_status, stdout_str, stderr_str
+    return self._retry_on_disconnect(func, sent)
+
+  def file_exists_many(self, remote_fns):
+    """Returns list of booleans telling which of remote files exist, using
+    single remote command."""
+    if not remote_fns:
+      return []
+    cmd = 'for fn in %s; do [ -e "$fn" ] && echo 1 || echo 0; done'%(
+      ' '.join(shlex.quote(fn) for fn in remote_fns),)
+    status, stdout, stderr = self.exec_command(cmd, idempotent=True)
+    result = [line == '1' for line in stdout.split()]
+    assert len(result) == len(remote_fns), "stat failed with "+stderr
+    return result
+
+  def file_read_many(self, remote_fns):
+    """Returns list with contents of remote files as strings, None for files
+    that don't exist. Files are fetched as single tar stream from one remote
+    command."""
+    if not remote_fns:
+      return []
+    # tar strips names up to .. components, so they are normalized first,
+    # symlinks are archived as the files they point to
+    remote_fns = [os.path.normpath(fn) for fn in remote_fns]
+    cmd = 'tar -cf - --dereference --ignore-failed-read -- %s 2>/dev/null'%(
+      ' '.join(shlex.quote(fn) for fn in remote_fns),)
+    status, stdout, stderr = self.exec_command(cmd, binary=True,
+                                               idempotent=True)
+    contents = {}
+    if not stdout:   # none of the files exist
+      return [None]*len(remote_fns)
+    with tarfile.open(fileobj=io.BytesIO(stdout), mode='r:') as tar:
+      for member in tar:
+        # file archived earlier under another name is stored as hard link
+        if member.isfile() or member.islnk():
+          contents[member.name] = tar.extractfile(member).read().decode()
+    # tar strips leading / from names
+    return [contents.get(fn.lstrip('/')) for fn in remote_fns]
+
 # TODO: inversion procedure is incorrect
 # TODO: probably want to be seconds in local time zone instead
 def seconds_from_datetime(dt):
@@ -710,3 +1322,150 @@ def put_dir(sftp, source, target):
       _safe_mkdir(sftp, '%s/%s' % (target, item))
       put_dir(sftp, os.path.join(source, item), '%s/%s' % (target, item))
 
+
+
+# cache of file hashes, keyed on (path, size, mtime) so that unchanged files
+# aren't rehashed on every upload
+_file_hash_cache = {}
+
+def make_manifest(source):
+  """Returns manifest of directory as {relative_path: [size, mtime, sha1]}"""
+  manifest = {}
+  for root, dirs, files in os.walk(source):
+    for fn in files:
+      full_fn = os.path.join(root, fn)
+      if os.path.islink(full_fn) or not os.path.isfile(full_fn):
+        continue
+      stat = os.stat(full_fn)
+      key = (full_fn, stat.st_size, stat.st_mtime)
+      digest = _file_hash_cache.get(key)
+      if digest is None:
+        sha1 = hashlib.sha1()
+        with open(full_fn, 'rb') as f:
+          for chunk in iter(lambda: f.read(1<<20), b''):
+            sha1.update(chunk)
+        digest = sha1.hexdigest()
+        _file_hash_cache[key] = digest
+      relative_fn = os.path.relpath(full_fn, source)
+      manifest[relative_fn] = [stat.st_size, stat.st_mtime, digest]
+  return manifest
+
+
+# remote manifests of synced directories, kept outside of the directories so
+# they don't show up among the synced files
+UPLOAD_MANIFEST_DIR = '/var/tmp/upload_manifests'
+
+
+class _CountingWriter:
+  """Wraps file object, counting bytes written through it."""
+
+  def __init__(self, f):
+    self.f = f
+    self.num_bytes = 0
+
+  def write(self, data):
+    self.num_bytes+=len(data)
+    return self.f.write(data)
+
+  def flush(self):
+    self.f.flush()
+
+
+def _remote_stat_many(ssh, target, fns):
+  """Returns dict with (size, mtime) of files under remote directory target,
+  files that don't exist are left out. Uses single remote stat command, file
+  names are passed through stdin."""
+  def write_fns(stdin):
+    stdin.write(''.join(fn+'\n' for fn in fns).encode())
+  status, stdout, stderr = ssh.exec_command(
+    "cd %s 2>/dev/null && xargs -r -d '\\n' stat -c '%%s %%Y %%n' --"%(
+      shlex.quote(target),), stdin_func=write_fns, idempotent=True)
+  stats = {}
+  for line in stdout.split('\n'):
+    if line:
+      size, mtime, fn = line.split(' ', 2)
+      stats[fn] = (int(size), int(mtime))
+  return stats
+
+
+def sync_dir(ssh, source, target):
+  """Incremental version of put_dir over SshConnection. Compares manifest of
+  source with manifest cached on remote machine during previous sync, and
+  sends only new or changed files, as a single compressed tar stream that is
+  unpacked into target remotely.
+
+  Since target may be wiped while the manifest survives (ie, target under
+  /tmp of a restarted instance), files the manifest lists as current are
+  checked with one batched remote stat, and are sent again if they are
+  missing or their size or mtime changed. Files that were synced before but
+  were since deleted from source are deleted from target. Other files in
+  target are left alone.
+
+  Returns bytes_sent (compressed size of the stream), bytes_skipped
+  (uncompressed size of unchanged files)."""
+
+  assert os.path.isdir(source)
+  local_manifest = make_manifest(source)
+  manifest_fn = '%s/%s.json'%(UPLOAD_MANIFEST_DIR,
+                              hashlib.sha1(target.encode()).hexdigest())
+  try:
+    remote_manifest = json.loads(ssh.file_read(manifest_fn))
+  except Exception:   # first upload, or manifest is corrupted
+    remote_manifest = {}
+
+  unchanged = []
+  for fn, (size, mtime, digest) in sorted(local_manifest.items()):
+    remote_entry = remote_manifest.get(fn)
+    if remote_entry and remote_entry[2] == digest:
+      unchanged.append(fn)
+  remote_stats = _remote_stat_many(ssh, target, unchanged) if unchanged else {}
+
+  changed = []
+  bytes_skipped = 0
+  for fn, (size, mtime, digest) in sorted(local_manifest.items()):
+    # tar keeps whole seconds of mtime
+    if remote_stats.get(fn) == (size, int(mtime)):
+      bytes_skipped+=size
+    else:
+      changed.append(fn)
+  deleted = sorted(set(remote_manifest) - set(local_manifest))
+
+  stream = None
+  def write_tar(stdin):
+    nonlocal stream
+    stream = _CountingWriter(stdin)
+    # fast compression level, the bottleneck is usually uplink latency
+    with gzip.GzipFile(fileobj=stream, mode='wb', compresslevel=1) as gz:
+      with tarfile.open(fileobj=gz, mode='w|') as tar:
+        for fn in changed:
+          tar.add(os.path.join(source, fn), arcname=fn, recursive=False)
+
+  quoted_target = shlex.quote(target)
+  sync_cmd = 'mkdir -p %s %s'%(quoted_target, UPLOAD_MANIFEST_DIR)
+  if deleted:
+    sync_cmd+=' && cd %s && rm -f -- %s'%(
+      quoted_target, ' '.join(shlex.quote(fn) for fn in deleted))
+  if changed:
+    status, stdout, stderr = ssh.exec_command(
+      '%s && tar xzf - -C %s'%(sync_cmd, quoted_target), stdin_func=write_tar,
+      idempotent=True)
+    assert status == 0, "Unpacking %s into %s failed with %s"%(source, target,
+                                                             stderr)
+  else:
+    ssh.exec_command(sync_cmd, idempotent=True)
+  ssh.file_write(manifest_fn, json.dumps(local_manifest))
+  return (stream.num_bytes if stream else 0), bytes_skipped
+
+
+def get_dir(ssh, source, target):
+  """Downloads remote directory source into local directory target over
+  SshConnection, as a single compressed tar stream instead of a SFTP round
+  trip per file. Creates target if it doesn't exist."""
+  os.makedirs(target, exist_ok=True)
+  channel = ssh.open_channel('tar czf - -C %s .'%(shlex.quote(source),),
+                             idempotent=True)
+  with tarfile.open(fileobj=channel.makefile('rb'), mode='r|gz') as tar:
+    tar.extractall(target)
+  status = channel.recv_exit_status()
+  assert status == 0, "Packing %s failed with %s"%(
+    source, channel.makefile_stderr('rb').read().decode())